@@ -19,7 +19,6 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from psychopy import visual, core, event, gui, monitors
-import shelve
 import random
 import codecs
 import os
@@ -29,7 +28,15 @@ import numbers
 from datetime import datetime
 from io import StringIO
 import threading
-import copy
+import numpy as np
+import gaze_store
+from background_writer import BackgroundWriter
+import trial_journal
+import storage
+from stim_cache import StimulusCache
+from response_input import ResponseKeyboard
+from gaze import FixationDetector, GazeSampleColumns, gaze_position, fixated_AOI
+import gaze_replay
 
 try:
     import tobii_research as tobii
@@ -39,6 +46,173 @@ except:
 
 g_blocks_in_feedback = 5
 
+# write the eye-tracking samples also into a columnar HDF5 file per session (needs PyTables, see gaze_store.py)
+g_gaze_store = False
+
+# storage of the settings and subject states: 'files' (shelve files) or 'sqlite' (one SQLite database in WAL mode,
+# which also stores the output rows, see storage.py), the text logs are written with both
+g_storage_backend = 'files'
+# store also the eye-tracking samples in the SQLite database (g_storage_backend == 'sqlite')
+g_database_gaze_samples = False
+
+# seconds wait_for_eye_response() waits for a new gaze sample before checking the quit key again
+g_gaze_wait_timeout = 0.05
+
+# replay the samples of this ET log or gaze store file instead of using an eye-tracker (None: use the eye-tracker, see gaze_replay.py)
+g_gaze_replay_file_path = None
+# speed of the replay (1: the recorded pace)
+g_gaze_replay_speed = 1.0
+
+# names of the output columns (reaction-time exp. type)
+g_RT_column_names = ['computer_name',
+                     'subject_group',
+                     'subject_name',
+                     'subject_number',
+                     'subject_sex',
+                     'subject_age',
+                     'asrt_type',
+                     'PCode',
+
+                     'output_line',
+
+                     'session',
+                     'epoch',
+                     'block',
+                     'trial',
+
+                     'RSI_time',
+                     'frame_rate',
+                     'frame_time',
+                     'frame_sd',
+                     'date',
+                     'time',
+
+                     'stimulus_color',
+                     'trial_type_pr',
+                     'triplet_type_hl',
+                     'RT',
+                     'error',
+                     'stimulus',
+                     'response']
+
+# names of the output columns (eye-tracking exp. type)
+g_ET_column_names = ['computer_name',
+                     'monitor_width_pixel',
+                     'monitor_height_pixel',
+                     'subject_group',
+                     'subject_name',
+                     'subject_number',
+                     'subject_sex',
+                     'subject_age',
+                     'asrt_type',
+                     'PCode',
+
+                     'session',
+                     'epoch',
+                     'block',
+                     'trial',
+
+                     'RSI_time',
+                     'frame_rate',
+                     'frame_time',
+                     'frame_sd',
+
+                     'stimulus_color',
+                     'trial_type_pr',
+                     'triplet_type_hl',
+                     'stimulus',
+                     'trial_phase',
+                     'left_gaze_data_X_ADCS',
+                     'left_gaze_data_Y_ADCS',
+                     'right_gaze_data_X_ADCS',
+                     'right_gaze_data_Y_ADCS',
+                     'left_gaze_data_X_PCMCS',
+                     'left_gaze_data_Y_PCMCS',
+                     'right_gaze_data_X_PCMCS',
+                     'right_gaze_data_Y_PCMCS',
+                     'left_gaze_validity',
+                     'right_gaze_validity',
+                     'left_pupil_diameter',
+                     'right_pupil_diameter',
+                     'left_pupil_validity',
+                     'right_pupil_validity',
+                     'gaze_data_time_stamp',
+                     'stimulus_1_position_X_PCMCS',
+                     'stimulus_1_position_Y_PCMCS',
+                     'stimulus_2_position_X_PCMCS',
+                     'stimulus_2_position_Y_PCMCS',
+                     'stimulus_3_position_X_PCMCS',
+                     'stimulus_3_position_Y_PCMCS',
+                     'stimulus_4_position_X_PCMCS',
+                     'stimulus_4_position_Y_PCMCS']
+
+# journal the output of every trial for crash-safe resume (reaction-time experiments, see trial_journal.py)
+g_trial_journal = True
+
+# one journal record per output row of a reaction-time trial
+g_journal_dtype = np.dtype([('kind', np.int8), ('N', np.int32), ('RSI_time', np.float64), ('time', 'S15'), ('date', 'S10'),
+                            ('RT', np.float64), ('error', np.int8), ('response', np.int8), ('stimulus_color', 'S64'),
+                            ('output_line', np.int32)])
+
+# trial types stored in the trial table as their index in this tuple
+g_trial_types = ('random', 'pattern')
+g_random = 0
+g_pattern = 1
+
+# one row per trial (index is the global trial number, row 0 is unused)
+#   session, epoch, block, trial: position of the trial in the experiment (trial is counted inside the block)
+#   end_at: first trial of the next session
+#   stim: stimulus number, type: g_random or g_pattern
+g_trial_dtype = np.dtype([('session', np.int16), ('epoch', np.int16), ('block', np.int16), ('trial', np.int16),
+                          ('end_at', np.int32), ('stim', np.int8), ('type', np.int8)])
+
+
+def trial_table_from_dicts(this_person_settings):
+    """Convert the per-trial dictionaries saved by older versions into a trial table."""
+
+    stim_sessionN = this_person_settings['stim_sessionN']
+    trials = np.zeros(max(stim_sessionN.keys()) + 1, dtype=g_trial_dtype)
+    for N in stim_sessionN.keys():
+        trials[N] = (stim_sessionN[N],
+                     this_person_settings['stimepoch'][N],
+                     this_person_settings['stimblock'][N],
+                     this_person_settings['stimtrial'][N],
+                     this_person_settings['end_at'][N],
+                     this_person_settings['stimlist'][N],
+                     g_trial_types.index(this_person_settings['stimpr'][N]))
+    return trials
+
+
+# raw pattern codes (series of stimulus numbers) of the pattern code names
+g_raw_pattern_codes = {'1st - 1234': '1234',
+                       '2nd - 1243': '1243',
+                       '3rd - 1324': '1324',
+                       '4th - 1342': '1342',
+                       '5th - 1423': '1423',
+                       '6th - 1432': '1432'}
+
+# triplet types stored in the triplet type column as their index in this tuple
+g_triplet_types = ('none', 'high', 'low')
+g_triplet_none = 0
+g_triplet_high = 1
+g_triplet_low = 2
+
+# boundary flags indexed by the global trial number (see ExperimentSettings.get_trial_flags())
+g_trial_flags_dtype = np.dtype([('block_start', np.bool_), ('session_start', np.bool_)])
+
+
+def output_columns(values):
+    """Format values as tab terminated output columns (numbers are written with decimal comma)."""
+
+    columns = ''
+    for value in values:
+        if isinstance(value, numbers.Number):
+            value = str(value).replace('.', ',')
+        else:
+            value = str(value)
+        columns += value + '\t'
+    return columns
+
 
 def ensure_dir(dirpath):
     if not os.path.exists(dirpath):
@@ -61,7 +235,7 @@ class ExperimentSettings:
        These settings apply to all subjects in the specific experiment.
     """
 
-    def __init__(self, settings_file_path, reminder_file_path):
+    def __init__(self, settings_file_path, reminder_file_path, data_storage=None):
         # type of the experiment (reaction time or eyetracking
         self.experiment_type = None
         # number of sessions (e.g. 10)
@@ -129,9 +303,15 @@ class ExperimentSettings:
         self.sessionstarts = None
         # list of trial numbers indicating the first trials of the different blocks (calulcated number, e.g [1, 86, 171])
         self.blockstarts = None
+        # block and session start flags of all trials (calculated array, see get_trial_flags())
+        self.trial_flags = None
 
         # settings shelve file's path
         self.settings_file_path = settings_file_path
+        # storage backend the settings are read from and written into (see storage.py)
+        if data_storage is None:
+            data_storage = storage.FileStorage()
+        self.storage = data_storage
         # settings reminder text file's path
         self.reminder_file_path = reminder_file_path
 
@@ -143,7 +323,7 @@ class ExperimentSettings:
            an exception is raised.
         """
         try:
-            with shelve.open(self.settings_file_path, 'r') as settings_file:
+            with self.storage.open(self.settings_file_path, 'r') as settings_file:
                 self.experiment_type = settings_file['experiment_type']
                 self.numsessions = settings_file['numsessions']
                 self.groups = settings_file['groups']
@@ -183,13 +363,13 @@ class ExperimentSettings:
                 elif self.experiment_type == 'eye-tracking':
                     self.key_quit = 'q'
         except Exception as exception:
-            self.__init__(self.settings_file_path, self.reminder_file_path)
+            self.__init__(self.settings_file_path, self.reminder_file_path, data_storage=self.storage)
             raise exception
 
     def write_to_file(self):
         """Create a new settings file and write all settings into it."""
 
-        with shelve.open(self.settings_file_path, 'n') as settings_file:
+        with self.storage.open(self.settings_file_path, 'n') as settings_file:
             settings_file['experiment_type'] = self.experiment_type
             settings_file['numsessions'] = self.numsessions
             settings_file['groups'] = self.groups
@@ -312,6 +492,18 @@ class ExperimentSettings:
                 
         return self.sessionstarts
 
+    def get_trial_flags(self):
+        """Return with an array indexed by the global trial number (from 0 to get_maxtrial() + 1),
+           flagging the first trials of the different blocks and sessions."""
+
+        if self.trial_flags is None:
+            self.trial_flags = np.zeros(self.get_maxtrial() + 2, dtype=g_trial_flags_dtype)
+            for field, starts in (('block_start', self.get_block_starts()), ('session_start', self.get_session_starts())):
+                starts = np.asarray(starts)
+                self.trial_flags[field][starts[starts < len(self.trial_flags)]] = True
+
+        return self.trial_flags
+
     def get_key_list(self):
         if self.experiment_type == 'reaction-time':
             return [self.key1, self.key2, self.key3, self.key4, self.key_quit]
@@ -341,7 +533,7 @@ class ExperimentSettings:
                 self.experiment_type = 'reaction-time'
             else:
                 self.experiment_type = 'eye-tracking'
-                if not g_tobii_available:
+                if not g_tobii_available and g_gaze_replay_file_path is None:
                     print("For running the eye-tracking version of the experiment,"
                           " we need tobii_research module to be installed!")
                     core.quit()
@@ -509,6 +701,8 @@ class InstructionHelper:
         self.unexp_quit = []
 
         self.instructions_file_path = instructions_file_path
+        # text stimulus of the messages, reused by every message (created with the first one)
+        self.stim_cache = None
 
     def read_insts_from_file(self):
         """Read instruction strings from the instruction file using the special structure of this file.
@@ -569,7 +763,9 @@ class InstructionHelper:
     def __print_to_screen(self, mytext, mywindow):
         """Display given string in the given window."""
 
-        text_stim = visual.TextStim(mywindow, text=mytext, units='cm', height=0.8, wrapWidth=20, color='black')
+        if self.stim_cache is None or self.stim_cache.window is not mywindow:
+            self.stim_cache = StimulusCache(mywindow)
+        text_stim = self.stim_cache.text('message', mytext, units='cm', height=0.8, wrapWidth=20, color='black')
         text_stim.draw()
         mywindow.flip()
 
@@ -587,7 +783,7 @@ class InstructionHelper:
                 experiment.fixation_cross.draw()
                 self.__print_to_screen(inst, experiment.mywindow)
                 core.wait(2.0)
-                response = experiment.wait_for_eye_response(experiment.fixation_cross_pos, experiment.settings.instruction_fixation_threshold)
+                response = experiment.wait_for_eye_response(experiment.fixation_cross_pos)
                 if response == -1:
                     core.quit()
 
@@ -670,7 +866,7 @@ class InstructionHelper:
         """
         feedback = "Most pihenhetsz egy kicsit.\n\n"
         feedback += "Az előző blokkokban mért átlagos reakcióidők:\n\n"
-        blocknumber = experiment.stimblock[experiment.last_N] - min(4, len(experiment.last_block_RTs) - 1)
+        blocknumber = experiment.trials['block'][experiment.last_N] - min(4, len(experiment.last_block_RTs) - 1)
         for rt in experiment.last_block_RTs[-g_blocks_in_feedback:]:
             feedback += str(blocknumber) + ". blokk: " + rt + " másodperc.\n\n"
             blocknumber += 1
@@ -681,7 +877,8 @@ class InstructionHelper:
 class PersonDataHandler:
     """Class for handle subject related settings and data."""
 
-    def __init__(self, subject_id, all_settings_file_path, all_IDs_file_path, subject_list_file_path, output_file_path, output_file_type):
+    def __init__(self, subject_id, all_settings_file_path, all_IDs_file_path, subject_list_file_path, output_file_path, output_file_type,
+                 gaze_store_file_prefix=None, journal_file_path=None, data_storage=None):
         # generated, unique ID of the subject (consist of a name, a number and an optional group name
         self.subject_id = subject_id
         # path to the settings file of the current subject storing the state of the experiment
@@ -696,102 +893,143 @@ class PersonDataHandler:
         self.output_file_type = output_file_type
         # we store all neccessary data in this list of lists to be able to generate the output at the end of all blocks
         self.output_data_buffer = []
+        # gaze samples recorded since the last flush (eye-tracking exp. type)
+        self.gaze_samples = GazeSampleColumns()
+        # path prefix of the gaze sample store files (the session number and extension are added to it), None if there is no store
+        self.gaze_store_file_prefix = gaze_store_file_prefix
+        # I/O thread writing the output and settings files, so the presentation does not wait for the disk
+        self.writer = BackgroundWriter()
+        # storage backend of the subject's state and output rows (see storage.py)
+        if data_storage is None:
+            data_storage = storage.FileStorage()
+        self.storage = data_storage
+        # journal of the trials since the last settings save (used only on the I/O thread), None if there is no journal
+        if journal_file_path is not None:
+            self.journal = trial_journal.TrialJournal(journal_file_path, g_journal_dtype)
+        else:
+            self.journal = None
+        # journaled records of the completed trials read on startup (the presentation continues its block's feedback with them)
+        self.journaled_records = np.zeros(0, dtype=g_journal_dtype)
 
     def load_person_settings(self, experiment):
         """Open settings file of the current subject and read the current state."""
 
         try:
-            with shelve.open(self.all_settings_file_path, 'r') as this_person_settings:
+            with self.storage.open(self.all_settings_file_path, 'r') as this_person_settings:
 
                 experiment.PCodes = this_person_settings['PCodes']
                 experiment.subject_age = this_person_settings['subject_age']
                 experiment.subject_sex = this_person_settings['subject_sex']
                 experiment.stim_output_line = this_person_settings['stim_output_line']
 
-                experiment.stim_sessionN = this_person_settings['stim_sessionN']
-                experiment.stimepoch = this_person_settings['stimepoch']
-                experiment.stimblock = this_person_settings['stimblock']
-                experiment.stimtrial = this_person_settings['stimtrial']
+                if 'trials' in this_person_settings:
+                    experiment.trials = this_person_settings['trials']
+                else:
+                    experiment.trials = trial_table_from_dicts(this_person_settings)
 
-                experiment.stimlistPersonDataHandler = this_person_settings['stimlist']
-                experiment.stimpr = this_person_settings['stimpr']
                 experiment.last_N = this_person_settings['last_N']
-                experiment.end_at = this_person_settings['end_at']
         except:
             experiment.PCodes = {}
             experiment.subject_age = None
             experiment.subject_sex = None
             experiment.stim_output_line = 0
-            experiment.stim_sessionN = {}
-            experiment.stimepoch = {}
-            experiment.stimblock = {}
-            experiment.stimtrial = {}
-            experiment.stimlist = {}
-            experiment.stimpr = {}
+            experiment.trials = None
             experiment.last_N = 0
-            experiment.end_at = {}
+            return
+
+        if self.journal is not None:
+            self.replay_journal(experiment)
+
+    def replay_journal(self, experiment):
+        """Continue from the last journaled trial, the rows which did not reach the output file are buffered again."""
+
+        (trial_records, unwritten_records) = trial_journal.read_journal(self.journal.file_path, g_journal_dtype)
+        if len(trial_records) == 0:
+            return
+
+        completed_N = trial_records['N'][trial_records['error'] == 0]
+        if len(completed_N) > 0:
+            experiment.last_N = max(experiment.last_N, int(completed_N[-1]))
+
+        # the wrong responses of an unfinished trial are dropped, the trial is repeated
+        if np.any(trial_records['N'] > experiment.last_N):
+            trial_journal.drop_trials_after(self.journal.file_path, g_journal_dtype, experiment.last_N)
+            (trial_records, unwritten_records) = trial_journal.read_journal(self.journal.file_path, g_journal_dtype)
+            if len(trial_records) == 0:
+                return
+        self.journaled_records = trial_records
+        experiment.stim_output_line = max(experiment.stim_output_line, int(trial_records['output_line'][-1]))
+
+        self.output_data_buffer = [[int(record['N']), float(record['RSI_time']), record['time'].decode(), record['date'].decode(),
+                                    float(record['RT']), int(record['error']), int(record['response']),
+                                    record['stimulus_color'].decode(), int(record['output_line'])] for record in unwritten_records]
+
+    def add_trial_output(self, output_data):
+        """Buffer the output data of a trial (reaction-time exp. type), and append it to the journal on the I/O thread."""
+
+        self.output_data_buffer.append(output_data)
+        if self.journal is not None:
+            (N, stim_RSI, stim_RT_time, stim_RT_date, stimRT, stimACC, response, stimcolor, stim_output_line) = output_data
+            self.writer.submit(self.journal.append, (N, stim_RSI, stim_RT_time.encode(), stim_RT_date.encode(), stimRT,
+                                                     stimACC, response, str(stimcolor).encode(), stim_output_line))
+
+    def checkpoint(self, experiment):
+        """Write out the buffered output data at the end of a block and record the progress.
+
+           With a journal the progress is already journaled trial by trial, otherwise the settings are saved.
+        """
+
+        self.flush_data_to_output(experiment)
+        if self.journal is None:
+            self.save_person_settings(experiment)
 
     def save_person_settings(self, experiment):
         """Write out the current state of the experiment run with current subject,
-           so we can continue the experiment from that point where the subject finished it."""
+           so we can continue the experiment from that point where the subject finished it.
+
+           The state is taken now and written on the I/O thread, returns with the write's Future.
+        """
+
+        person_settings = {'PCodes': experiment.PCodes,
+                           'subject_sex': experiment.subject_sex,
+                           'subject_age': experiment.subject_age,
+                           'stim_output_line': experiment.stim_output_line,
+                           'trials': experiment.trials,
+                           'last_N': experiment.last_N}
+        return self.writer.submit(self.write_person_settings, person_settings)
 
-        with shelve.open(self.all_settings_file_path, 'n') as this_person_settings:
-            this_person_settings['PCodes'] = experiment.PCodes
-            this_person_settings['subject_sex'] = experiment.subject_sex
-            this_person_settings['subject_age'] = experiment.subject_age
-            this_person_settings['stim_output_line'] = experiment.stim_output_line
+    def write_person_settings(self, person_settings):
+        with self.storage.open(self.all_settings_file_path, 'n') as this_person_settings:
+            for key, value in person_settings.items():
+                this_person_settings[key] = value
 
-            this_person_settings['stim_sessionN'] = experiment.stim_sessionN
-            this_person_settings['stimepoch'] = experiment.stimepoch
-            this_person_settings['stimblock'] = experiment.stimblock
-            this_person_settings['stimtrial'] = experiment.stimtrial
+        # the saved settings contain the journaled progress
+        if self.journal is not None:
+            self.journal.reset()
 
-            this_person_settings['stimlist'] = experiment.stimlist
-            this_person_settings['stimpr'] = experiment.stimpr
-            this_person_settings['last_N'] = experiment.last_N
-            this_person_settings['end_at'] = experiment.end_at
+    def wait_for_writes(self):
+        """Wait until everything submitted to the I/O thread is written out."""
+
+        if self.journal is not None:
+            self.writer.submit(self.journal.sync)
+        self.writer.drain()
 
     def update_all_subject_attributes_files(self, subject_sex, subject_age, subject_PCodes):
-        """Add the new subject's attributes into the list of all subject data and save it into file.
-           Also generate a text file with the list of all subjects participating in the experiment.
+        """Add the new subject's attributes into the registry of all subjects (see storage.SubjectRegistry).
+           Also append the subject to the text file with the list of all subjects participating in the experiment.
         """
 
-        all_IDs = []
-        with shelve.open(self.all_IDs_file_path) as all_subject_file:
-            try:
-                all_IDs = all_subject_file['ids']
-            except:
-                all_IDs = []
-
-            if self.subject_id not in all_IDs:
-                all_IDs.append(self.subject_id)
-                all_subject_file['ids'] = all_IDs
-                all_subject_file[self.subject_id] = [subject_sex, subject_age, subject_PCodes]
-
-        with shelve.open(self.all_IDs_file_path, 'r') as all_subject_file:
-            with codecs.open(self.subject_list_file_path, 'w', encoding='utf-8') as subject_list_file:
-                subject_list_IO = StringIO()
-                # write header
-                subject_list_IO.write('subject_name\tsubject_id\tsubject_group\tsubject_sex\tsubject_age\tsubject_PCodes\n')
-
-                # write subject data
-                for id in all_IDs:
-                    id_segmented = id.replace('_', '\t', 2)
-                    subject_list_IO.write(id_segmented)
-                    subject_list_IO.write('\t')
-                    subject_list_IO.write(all_subject_file[id][0])
-                    subject_list_IO.write('\t')
-                    subject_list_IO.write(all_subject_file[id][1])
-                    subject_list_IO.write('\t')
-                    subject_list_IO.write(str(all_subject_file[id][2]))
-                    subject_list_IO.write('\n')
-
-                subject_list_file.write(subject_list_IO.getvalue())
-                subject_list_IO.close()
+        registry = storage.SubjectRegistry(self.all_IDs_file_path + '.sqlite3', self.subject_list_file_path,
+                                           'subject_name\tsubject_id\tsubject_group\tsubject_sex\tsubject_age\tsubject_PCodes',
+                                           self.all_IDs_file_path)
+        registry.register(self.subject_id, [str(subject_sex), str(subject_age), str(subject_PCodes)])
 
     def append_to_output_file(self, string_to_append):
-        """ Append a string to the end on the output text file."""
+        """ Append a string to the end on the output text file (on the I/O thread), returns with the write's Future."""
+
+        return self.writer.submit(self.write_to_output_file, string_to_append)
 
+    def write_to_output_file(self, string_to_append):
         if not os.path.isfile(self.output_file_path):
             with codecs.open(self.output_file_path, 'w', encoding='utf-8') as output_file:
                 if self.output_file_type == 'reaction-time':
@@ -799,21 +1037,48 @@ class PersonDataHandler:
                 else:
                     self.add_ET_heading_to_output(output_file)
                 output_file.write(string_to_append)
+                output_file.flush()
+                os.fsync(output_file.fileno())
         else:
             with codecs.open(self.output_file_path, 'a+', encoding='utf-8') as output_file:
                 output_file.write(string_to_append)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+
+    def flush_data_to_output(self, experiment):
+        """Hand the buffered output data over to the I/O thread, returns with the write's Future.
+
+           The buffers are replaced by empty ones, so the eye-tracker can go on recording during the write.
+        """
+
+        with experiment.shared_data_lock:
+            output_data_buffer = self.output_data_buffer
+            self.output_data_buffer = []
+            gaze_samples = self.gaze_samples
+            self.gaze_samples = GazeSampleColumns()
+
+        if self.output_file_type == 'reaction-time':
+            flushed = self.writer.submit(self.flush_RT_data_to_output, experiment, output_data_buffer)
+        else:
+            flushed = self.writer.submit(self.flush_ET_data_to_output, experiment, gaze_samples)
 
-    def flush_RT_data_to_output(self, experiment):
+        if self.journal is not None:
+            self.writer.submit(self.journal.checkpoint)
+        return flushed
+
+    def flush_RT_data_to_output(self, experiment, output_data_buffer):
         """ Write out the ouptut date of the current trial into the output text file (reaction-time exp. type)."""
         assert self.output_file_type == 'reaction-time'
 
         output_buffer = StringIO()
-        for data in self.output_data_buffer:
+        rows = []
+        for data in output_data_buffer:
             N = data[0]
-            session = experiment.stim_sessionN[N]
+            trial = experiment.trials[N]
+            session = trial['session']
             PCode = experiment.which_code(session)
             asrt_type = experiment.settings.asrt_types[session]
-            trial_type_high_low = experiment.calulate_trial_type_high_low(N)
+            trial_type_high_low = g_triplet_types[experiment.triplet_types[N]]
 
             output_data = [experiment.settings.computer_name,
                            experiment.subject_group,
@@ -826,10 +1091,10 @@ class PersonDataHandler:
 
                            data[8],
 
-                           experiment.stim_sessionN[N],
-                           experiment.stimepoch[N],
-                           experiment.stimblock[N],
-                           experiment.stimtrial[N],
+                           trial['session'],
+                           trial['epoch'],
+                           trial['block'],
+                           trial['trial'],
 
                            data[1],
                            experiment.frame_rate,
@@ -839,13 +1104,14 @@ class PersonDataHandler:
                            data[3],
 
                            data[7],
-                           experiment.stimpr[N],
+                           g_trial_types[trial['type']],
                            trial_type_high_low,
                            data[4],
                            data[5],
 
-                           experiment.stimlist[N],
+                           trial['stim'],
                            data[6]]
+            rows.append(output_data)
             output_buffer.write("\n")
             for data in output_data:
                 if isinstance(data, numbers.Number):
@@ -855,212 +1121,194 @@ class PersonDataHandler:
                     data = str(data)
                 output_buffer.write(data + '\t')
 
-        self.append_to_output_file(output_buffer.getvalue())
+        self.write_to_output_file(output_buffer.getvalue())
         output_buffer.close()
-        self.output_data_buffer.clear()
+        self.storage.append_rows('RT_output', self.subject_id, g_RT_column_names, rows)
 
     def add_RT_heading_to_output(self, output_file):
         """Add the first line to the ouput with the names of the different variables (reaction-time exp. type)."""
         assert self.output_file_type == 'reaction-time'
 
-        heading_list = ['computer_name',
-                        'subject_group',
-                        'subject_name',
-                        'subject_number',
-                        'subject_sex',
-                        'subject_age',
-                        'asrt_type',
-                        'PCode',
-
-                        'output_line',
-
-                        'session',
-                        'epoch',
-                        'block',
-                        'trial',
-
-                        'RSI_time',
-                        'frame_rate',
-                        'frame_time',
-                        'frame_sd',
-                        'date',
-                        'time',
-
-                        'stimulus_color',
-                        'trial_type_pr',
-                        'triplet_type_hl',
-                        'RT',
-                        'error',
-                        'stimulus',
-                        'response',
-                        'quit_log']
+        heading_list = g_RT_column_names + ['quit_log']
 
         for h in heading_list:
             output_file.write(h + '\t')
 
-    def flush_ET_data_to_output(self, experiment):
+    def flush_ET_data_to_output(self, experiment, gaze_samples):
         """ Write out the ouptut data of the current trial into the output text file (eye-tracking exp. type)."""
         assert self.output_file_type == 'eye-tracking'
 
         output_buffer = StringIO()
         max_trial = experiment.settings.get_maxtrial()
-        data_len = len(self.output_data_buffer)
-        for data in self.output_data_buffer:
 
-            N = data[0] + 1
-            if N > max_trial:
-                break
-            session = experiment.stim_sessionN[N]
-            PCode = experiment.which_code(session)
-            asrt_type = experiment.settings.asrt_types[session]
-            if experiment.stimpr[N] == 'pattern':
-                if experiment.settings.asrt_types[session] == 'explicit':
+        # samples after the last trial are not written out
+        samples = gaze_samples.to_array()
+        after_last_trial = np.flatnonzero(samples['trial'] > max_trial)
+        if len(after_last_trial) > 0:
+            samples = samples[:after_last_trial[0]]
+
+        # gaze positions of the whole buffer as (samples x 2) arrays, converted with whole-array operations
+        left_gaze_data_ADCS = samples['left_gaze_ADCS']
+        right_gaze_data_ADCS = samples['right_gaze_ADCS']
+        left_gaze_validity = samples['left_gaze_validity']
+        right_gaze_validity = samples['right_gaze_validity']
+
+        left_gaze_data_PCMCS = experiment.ADCS_array_to_PCMCS(left_gaze_data_ADCS)
+        left_gaze_data_PCMCS[~left_gaze_validity] = float('nan')
+        right_gaze_data_PCMCS = experiment.ADCS_array_to_PCMCS(right_gaze_data_ADCS)
+        right_gaze_data_PCMCS[~right_gaze_validity] = float('nan')
+        samples['left_gaze_PCMCS'] = left_gaze_data_PCMCS
+        samples['right_gaze_PCMCS'] = right_gaze_data_PCMCS
+
+        if len(samples) > 0:
+            if self.gaze_store_file_prefix is not None:
+                self.append_to_gaze_store(experiment, samples)
+            if g_database_gaze_samples and isinstance(self.storage, storage.SQLiteStorage):
+                self.append_gaze_samples_to_database(experiment, samples)
+
+        # the columns of the samples, sample by sample
+        sample_columns = zip(samples['trial'].tolist(), samples['RSI_time'].tolist(), samples['trial_phase'].tolist(),
+                             left_gaze_data_ADCS.tolist(), right_gaze_data_ADCS.tolist(),
+                             left_gaze_data_PCMCS.tolist(), right_gaze_data_PCMCS.tolist(),
+                             left_gaze_validity.tolist(), right_gaze_validity.tolist(),
+                             samples['left_pupil_diameter'].tolist(), samples['right_pupil_diameter'].tolist(),
+                             samples['left_pupil_validity'].tolist(), samples['right_pupil_validity'].tolist(),
+                             samples['time_stamp'].tolist())
+
+        # the same for all samples of the block
+        monitor_size = experiment.mymonitor.getSizePix()
+        subject_columns = output_columns([experiment.settings.computer_name,
+                                          monitor_size[0],
+                                          monitor_size[1],
+                                          experiment.subject_group,
+                                          experiment.subject_name,
+                                          experiment.subject_number,
+                                          experiment.subject_sex,
+                                          experiment.subject_age])
+        frame_columns = output_columns([experiment.frame_rate,
+                                        experiment.frame_time,
+                                        experiment.frame_sd])
+        stim_pos_columns = output_columns([experiment.dict_pos[1][0],
+                                           experiment.dict_pos[1][1],
+                                           experiment.dict_pos[2][0],
+                                           experiment.dict_pos[2][1],
+                                           experiment.dict_pos[3][0],
+                                           experiment.dict_pos[3][1],
+                                           experiment.dict_pos[4][0],
+                                           experiment.dict_pos[4][1]])
+
+        # the same for all samples of a trial (global trial number -> (columns before RSI, columns after frame data))
+        trial_columns = {}
+
+        for (N, RSI_time, trial_phase, left_ADCS, right_ADCS, left_PCMCS, right_PCMCS, left_validity, right_validity,
+             left_pupil_diameter, right_pupil_diameter, left_pupil_validity, right_pupil_validity, time_stamp) in sample_columns:
+
+            if N not in trial_columns:
+                trial = experiment.trials[N]
+                session = trial['session']
+                asrt_type = experiment.settings.asrt_types[session]
+                if trial['type'] == g_pattern and asrt_type == 'explicit':
                     stimcolor = experiment.colors['stimp']
                 else:
                     stimcolor = experiment.colors['stimr']
-            else:
-                stimcolor = experiment.colors['stimr']
-
-            trial_type_high_low = experiment.calulate_trial_type_high_low(N)
-            left_gaze_data_ADCS = data[3]['left_gaze_point_on_display_area']
-            right_gaze_data_ADCS = data[3]['right_gaze_point_on_display_area']
-            left_gaze_validity = bool(data[3]['left_gaze_point_validity'])
-            right_gaze_validity = bool(data[3]['right_gaze_point_validity'])
-
-            if left_gaze_validity:
-                left_gaze_data_PCMCS = experiment.ADCS_to_PCMCS(left_gaze_data_ADCS)
-            else:
-                left_gaze_data_PCMCS = (float('nan'), float('nan'))
 
-            if right_gaze_validity:
-                right_gaze_data_PCMCS = experiment.ADCS_to_PCMCS(right_gaze_data_ADCS)
-            else:
-                right_gaze_data_PCMCS = (float('nan'), float('nan'))
+                trial_columns[N] = (output_columns([asrt_type,
+                                                    experiment.which_code(session),
 
-            left_pupil_diameter = data[3]['left_pupil_diameter']
-            right_pupil_diameter = data[3]['right_pupil_diameter']
-            left_pupil_validity = bool(data[3]['left_pupil_validity'])
-            right_pupil_validity = bool(data[3]['right_pupil_validity'])
-
-            output_data = [experiment.settings.computer_name,
-                           experiment.mymonitor.getSizePix()[0],
-                           experiment.mymonitor.getSizePix()[1],
-                           experiment.subject_group,
-                           experiment.subject_name,
-                           experiment.subject_number,
-                           experiment.subject_sex,
-                           experiment.subject_age,
-                           asrt_type,
-                           PCode,
-
-                           experiment.stim_sessionN[N],
-                           experiment.stimepoch[N],
-                           experiment.stimblock[N],
-                           experiment.stimtrial[N],
-
-                           data[1],
-                           experiment.frame_rate,
-                           experiment.frame_time,
-                           experiment.frame_sd,
-
-                           stimcolor,
-                           experiment.stimpr[N],
-                           trial_type_high_low,
-                           experiment.stimlist[N],
-                           data[2],
-                           left_gaze_data_ADCS[0],
-                           left_gaze_data_ADCS[1],
-                           right_gaze_data_ADCS[0],
-                           right_gaze_data_ADCS[1],
-                           left_gaze_data_PCMCS[0],
-                           left_gaze_data_PCMCS[1],
-                           right_gaze_data_PCMCS[0],
-                           right_gaze_data_PCMCS[1],
-                           left_gaze_validity,
-                           right_gaze_validity,
-                           left_pupil_diameter,
-                           right_pupil_diameter,
-                           left_pupil_validity,
-                           right_pupil_validity,
-                           data[4],
-                           experiment.dict_pos[1][0],
-                           experiment.dict_pos[1][1],
-                           experiment.dict_pos[2][0],
-                           experiment.dict_pos[2][1],
-                           experiment.dict_pos[3][0],
-                           experiment.dict_pos[3][1],
-                           experiment.dict_pos[4][0],
-                           experiment.dict_pos[4][1]]
+                                                    trial['session'],
+                                                    trial['epoch'],
+                                                    trial['block'],
+                                                    trial['trial']]),
+                                    output_columns([stimcolor,
+                                                    g_trial_types[trial['type']],
+                                                    g_triplet_types[experiment.triplet_types[N]],
+                                                    trial['stim']]))
 
             output_buffer.write("\n")
-            for data in output_data:
-                if isinstance(data, numbers.Number):
-                    data = str(data)
-                    data = data.replace('.', ',')
-                else:
-                    data = str(data)
-                output_buffer.write(data + '\t')
-
-        self.append_to_output_file(output_buffer.getvalue())
+            output_buffer.write(subject_columns)
+            output_buffer.write(trial_columns[N][0])
+            # the RSI is -1 before the stimulus, written as an integer
+            output_buffer.write(output_columns([RSI_time if RSI_time != -1 else -1]))
+            output_buffer.write(frame_columns)
+            output_buffer.write(trial_columns[N][1])
+            output_buffer.write(output_columns([gaze_store.g_trial_phases[trial_phase],
+                                                left_ADCS[0],
+                                                left_ADCS[1],
+                                                right_ADCS[0],
+                                                right_ADCS[1],
+                                                left_PCMCS[0],
+                                                left_PCMCS[1],
+                                                right_PCMCS[0],
+                                                right_PCMCS[1],
+                                                left_validity,
+                                                right_validity,
+                                                left_pupil_diameter,
+                                                right_pupil_diameter,
+                                                left_pupil_validity,
+                                                right_pupil_validity,
+                                                time_stamp]))
+            output_buffer.write(stim_pos_columns)
+
+        self.write_to_output_file(output_buffer.getvalue())
         output_buffer.close()
-        # make sure we don't get more data here durig writing it out
-        assert data_len == len(self.output_data_buffer)
-        self.output_data_buffer.clear()
+
+    def append_to_gaze_store(self, experiment, gaze_samples):
+        """Append the gaze samples of the last block to the sample store file of the current session."""
+
+        trials = experiment.trials
+        # the first sample of the buffer belongs to the first trial of the block
+        block_N = gaze_samples['trial'][0]
+        session = trials['session'][block_N]
+        in_session = trials['session'] == session
+
+        metadata = {'computer_name': experiment.settings.computer_name,
+                    'monitor_size': tuple(experiment.mymonitor.getSizePix()),
+                    'subject_group': experiment.subject_group,
+                    'subject_name': experiment.subject_name,
+                    'subject_number': experiment.subject_number,
+                    'subject_sex': experiment.subject_sex,
+                    'subject_age': experiment.subject_age,
+                    'asrt_type': experiment.settings.asrt_types[session],
+                    'PCode': experiment.which_code(session),
+                    'frame_rate': experiment.frame_rate,
+                    'frame_time': experiment.frame_time,
+                    'frame_sd': experiment.frame_sd,
+                    'stimulus_positions': np.array([experiment.dict_pos[stim] for stim in range(1, 5)]),
+                    'trial_types': g_trial_types,
+                    'triplet_types': g_triplet_types,
+                    'trial_phases': gaze_store.g_trial_phases,
+                    'first_trial': np.flatnonzero(in_session)[0]}
+
+        # trial rows of the session together with their triplet types
+        session_trials = np.zeros(np.count_nonzero(in_session), dtype=trials.dtype.descr + [('triplet_type', np.int8)])
+        for name in trials.dtype.names:
+            session_trials[name] = trials[name][in_session]
+        session_trials['triplet_type'] = experiment.triplet_types[in_session]
+
+        store = gaze_store.GazeSampleStore(self.gaze_store_file_prefix + '_session' + str(session) + '_gaze.h5')
+        store.append_block(trials['block'][block_N], gaze_samples, session_trials, metadata)
+
+    def append_gaze_samples_to_database(self, experiment, gaze_samples):
+        """Insert the gaze samples of the last block into the SQLite database (one column per coordinate)."""
+
+        trials = experiment.trials[gaze_samples['trial']]
+        columns = {'session': trials['session'], 'block': trials['block']}
+        for name in gaze_store.g_sample_dtype.names:
+            if gaze_samples[name].ndim == 2:
+                columns[name + '_X'] = gaze_samples[name][:, 0]
+                columns[name + '_Y'] = gaze_samples[name][:, 1]
+            else:
+                columns[name] = gaze_samples[name]
+
+        column_names = list(columns.keys())
+        rows = list(zip(*[columns[name].tolist() for name in column_names]))
+        self.storage.append_rows('ET_samples', self.subject_id, column_names, rows)
 
     def add_ET_heading_to_output(self, output_file):
         """Add the first line to the ouput with the names of the different variables (eye-tracking exp. type)."""
         assert self.output_file_type == 'eye-tracking'
 
-        heading_list = ['computer_name',
-                        'monitor_width_pixel',
-                        'monitor_height_pixel',
-                        'subject_group',
-                        'subject_name',
-                        'subject_number',
-                        'subject_sex',
-                        'subject_age',
-                        'asrt_type',
-                        'PCode',
-
-                        'session',
-                        'epoch',
-                        'block',
-                        'trial',
-
-                        'RSI_time',
-                        'frame_rate',
-                        'frame_time',
-                        'frame_sd',
-
-                        'stimulus_color',
-                        'trial_type_pr',
-                        'triplet_type_hl',
-                        'stimulus',
-                        'trial_phase',
-                        'left_gaze_data_X_ADCS',
-                        'left_gaze_data_Y_ADCS',
-                        'right_gaze_data_X_ADCS',
-                        'right_gaze_data_Y_ADCS',
-                        'left_gaze_data_X_PCMCS',
-                        'left_gaze_data_Y_PCMCS',
-                        'right_gaze_data_X_PCMCS',
-                        'right_gaze_data_Y_PCMCS',
-                        'left_gaze_validity',
-                        'right_gaze_validity',
-                        'left_pupil_diameter',
-                        'right_pupil_diameter',
-                        'left_pupil_validity',
-                        'right_pupil_validity',
-                        'gaze_data_time_stamp',
-                        'stimulus_1_position_X_PCMCS',
-                        'stimulus_1_position_Y_PCMCS',
-                        'stimulus_2_position_X_PCMCS',
-                        'stimulus_2_position_Y_PCMCS',
-                        'stimulus_3_position_X_PCMCS',
-                        'stimulus_3_position_Y_PCMCS',
-                        'stimulus_4_position_X_PCMCS',
-                        'stimulus_4_position_Y_PCMCS',
-                        'quit_log']
+        heading_list = g_ET_column_names + ['quit_log']
 
         for h in heading_list:
             output_file.write(h + '\t')
@@ -1087,21 +1335,31 @@ class Experiment:
         # positions of the four stimulus circle
         self.dict_pos = None
 
-        # tobii EyeTracker object for handling eye-tracker input
+        # tobii EyeTracker object for handling eye-tracker input (or a gaze_replay.ReplayEyeTracker)
         self.eye_tracker = None
-        self.gaze_data_list = []
-        self.current_sampling_window = None
+        # gaze data stream of the eye-tracker and the function returning the system time stamp (in microseconds)
+        self.gaze_data_stream = None
+        self.get_system_time_stamp = None
+        # fixation detection over the newest gaze positions (ADCS), fed by the eye-tracker's callback (see gaze.py)
+        self.gaze_detector = None
         self.last_block_RTs = []
 
         self.fixation_cross_pos = None
         self.fixation_cross = None
 
         self.shared_data_lock = threading.Lock()
-        self.main_loop_lock = threading.Lock()
+        # notified by the eye-tracker's callback after every gaze sample (it shares the lock of the shared data)
+        self.new_gaze_sample = threading.Condition(self.shared_data_lock)
+        # sequence number of the last gaze sample, counted by the callback
+        self.gaze_sample_count = 0
 
         # visual.Window object for displaying experiment
         self.mywindow = None
         self.mymonitor = None
+        # stimuli built once for the window: pre-rendered layers and the message texts (see stim_cache.py)
+        self.stim_cache = None
+        # key presses with hardware timestamps, RTs are measured from the stimulus onset flip (see response_input.py)
+        self.response_keyboard = None
         # avarage time of displaying one frame on the screen in ms (e.g. 15.93 for 50 Hz)
         self.frame_time = None
         # standard deviation of displaying one frame on the screen in ms (e.g. 0.02)
@@ -1125,20 +1383,13 @@ class Experiment:
         self.PCodes = None
         # serial number of the next line in the output file (e.g. 10)
         self.stim_output_line = None
-        # global trial number -> session number mapping (e.g. {1 : 1, 2 : 1, 3 : 2, 4 : 2} - two sessions with two trials in each)
-        self.stim_sessionN = None
-        # global trial number -> epoch number mapping (e.g. {1 : 1, 2 : 2, 3 : 2, 4 : 2} - two epochs with two trials in each)
-        self.stimepoch = None
-        # global trial number -> block number mapping (e.g. {1 : 1, 2 : 2, 3 : 2, 4 : 2} - two blocks with two trials in each)
-        self.stimblock = None
-        # global trial number -> trial number inside the block mapping (e.g. {1 : 1, 2 : 2, 3 : 1, 4 : 2} - two blocks with two trials in each)
-        self.stimtrial = None
-        # global trial number -> stimulus number mapping (e.g. {1 : 1, 2 : 2, 3 : 2, 4 : 4})
-        self.stimlist = None
-        # global trial number -> first trial of the next session mapping (e. g.{1 : 3, 2 : 3, 3 : 5, 4 : 5} - two sessions with two trials in each)
-        self.end_at = None
-        # global trial number -> pattern or random stimulus mapping (e. g.{1 : 'pattern', 2 : 'random', 3 : 'pattern', 4 : 'random'} - two sessions with two trials in each)
-        self.stimpr = None
+        # trial table (numpy structured array of g_trial_dtype), global trial number -> session, epoch, block,
+        # trial number inside the block, first trial of the next session, stimulus number and trial type (e.g. self.trials['stim'][N])
+        self.trials = None
+        # global trial number -> triplet type code (g_triplet_none, g_triplet_high or g_triplet_low), see calculate_triplet_types()
+        self.triplet_types = None
+        # session number -> successor of every stimulus in the session's pattern (0 for sessions without pattern), see get_successor_table()
+        self.successor_table = None
         # number of the last trial (it is 0 in the beggining and it is always equal with the last displayed stimulus's serial number
         self.last_N = None
         # this variable has a meaning during presentation, showing the phase of displaying the current stimulus
@@ -1228,9 +1479,9 @@ class Experiment:
             expstart11 = gui.Dlg(title=u'Feladat indítása...')
             expstart11.addText(u'A személy adatait beolvastam.')
             expstart11.addText(u'Folytatás innen...')
-            expstart11.addText('Session: ' + str(self.stim_sessionN[self.last_N + 1]))
-            expstart11.addText('Epoch: ' + str(self.stimepoch[self.last_N + 1]))
-            expstart11.addText('Block: ' + str(self.stimblock[self.last_N + 1]))
+            expstart11.addText('Session: ' + str(self.trials['session'][self.last_N + 1]))
+            expstart11.addText('Epoch: ' + str(self.trials['epoch'][self.last_N + 1]))
+            expstart11.addText('Block: ' + str(self.trials['block'][self.last_N + 1]))
             expstart11.show()
             if not expstart11.OK:
                 core.quit()
@@ -1300,106 +1551,92 @@ class Experiment:
     def which_code(self, session_number):
         """Convert sessions pattern code to a raw code containing only the series of stimulus numbers."""
 
-        pcode_raw = self.PCodes[session_number]
-        PCode = 'noPattern'
-
-        if pcode_raw == '1st - 1234':
-            PCode = '1234'
-        elif pcode_raw == '2nd - 1243':
-            PCode = '1243'
-        elif pcode_raw == '3rd - 1324':
-            PCode = '1324'
-        elif pcode_raw == '4th - 1342':
-            PCode = '1342'
-        elif pcode_raw == '5th - 1423':
-            PCode = '1423'
-        elif pcode_raw == '6th - 1432':
-            PCode = '1432'
-        return PCode
+        return g_raw_pattern_codes.get(self.PCodes[session_number], 'noPattern')
+
+    def get_successor_table(self):
+        """Return with an array of the pattern successor of all stimuli in all sessions (e.g. table[session][stimulus]).
+
+           The table is compiled once from the pattern codes, the row of a session without pattern is all zeros.
+        """
+
+        if self.successor_table is None:
+            table = np.zeros((max(self.PCodes.keys()) + 1, 5), dtype=np.int8)
+            for session_number in self.PCodes.keys():
+                PCode = self.which_code(session_number)
+                if PCode != "noPattern":
+                    for i in range(4):
+                        table[session_number][int(PCode[i])] = int(PCode[(i + 1) % 4])
+            self.successor_table = table
+
+        return self.successor_table
 
     def next_stim(self, session_number, stimulus):
-        PCode = self.which_code(session_number)
-        assert PCode != "noPattern"
-
-        dict_next_stimulus = {}
-        dict_next_stimulus[PCode[0]] = PCode[1]
-        dict_next_stimulus[PCode[1]] = PCode[2]
-        dict_next_stimulus[PCode[2]] = PCode[3]
-        dict_next_stimulus[PCode[3]] = PCode[0]
-        return int(dict_next_stimulus[str(stimulus)])
-
-    def calulate_trial_type_high_low(self, N):
-        session = self.stim_sessionN[N]
-        PCode = self.which_code(session)
-        if PCode == "noPattern" or self.stimtrial[N] < 3:
-            return "none"
-        elif self.next_stim(session, self.stimlist[N - 2]) == self.stimlist[N]:
-            return "high"
-        else:
-            return "low"
+        next_stimulus = self.get_successor_table()[session_number][stimulus]
+        assert next_stimulus != 0
 
-    def calculate_stim_properties(self):
-        """Calculate all variables used during the trials before the presentation starts."""
+        return int(next_stimulus)
 
-        all_trial_Nr = 0
-        block_num = 0
+    def calculate_triplet_types(self):
+        """Label all trials of the trial table as high or low triplet (or none) in one pass."""
 
-        sessionsstarts = self.settings.get_session_starts()
-        for trial_num in range(1, self.settings.get_maxtrial() + 1):
-            for session_num in range(1, len(sessionsstarts)):
-                if trial_num >= sessionsstarts[session_num - 1] and trial_num < sessionsstarts[session_num]:
-                    self.stim_sessionN[trial_num] = session_num
-                    self.end_at[trial_num] = sessionsstarts[session_num]
+        trials = self.trials
+        session = trials['session']
+        successor_table = self.get_successor_table()
+        triplet_types = np.full(len(trials), g_triplet_none, dtype=np.int8)
 
-        for epoch in range(1, self.settings.epochN + 1):
+        # a trial is a high triplet if its stimulus is the pattern successor of the stimulus two trials before
+        expected = successor_table[session[2:], trials['stim'][:-2]]
+        labelled = (successor_table[session[2:]].any(axis=1)) & (trials['trial'][2:] >= 3)
+        triplet_types[2:][labelled] = np.where(expected[labelled] == trials['stim'][2:][labelled], g_triplet_high, g_triplet_low)
+        self.triplet_types = triplet_types
 
-            for block in range(1, self.settings.block_in_epochN + 1):
-                block_num += 1
-                current_trial_num = 0
+    def calculate_stim_properties(self):
+        """Calculate all variables used during the trials before the presentation starts."""
 
-                # practice
-                for practice in range(1, self.settings.blockprepN + 1):
-                    current_trial_num += 1
+        maxtrial = self.settings.get_maxtrial()
+        block_length = self.settings.blockprepN + self.settings.blocklengthN
+        trials = np.zeros(maxtrial + 1, dtype=g_trial_dtype)
 
-                    all_trial_Nr += 1
-                    asrt_type = self.settings.asrt_types[self.stim_sessionN[all_trial_Nr]]
+        # session of a trial: the last session which starts at or before the trial
+        sessionsstarts = np.asarray(self.settings.get_session_starts())
+        trial_nums = np.arange(1, maxtrial + 1)
+        session = np.searchsorted(sessionsstarts, trial_nums, side='right')
+        in_session = session < len(sessionsstarts)
+        trials['session'][1:] = np.where(in_session, session, 0)
+        trials['end_at'][1:] = np.where(in_session, sessionsstarts[np.minimum(session, len(sessionsstarts) - 1)], 0)
 
-                    current_stim = random.choice([1, 2, 3, 4])
-                    self.stimlist[all_trial_Nr] = current_stim
-                    self.stimpr[all_trial_Nr] = "random"
-                    self.stimtrial[all_trial_Nr] = current_trial_num
-                    self.stimblock[all_trial_Nr] = block_num
-                    self.stimepoch[all_trial_Nr] = epoch
+        trials['trial'][1:] = (trial_nums - 1) % block_length + 1
+        trials['block'][1:] = (trial_nums - 1) // block_length + 1
+        trials['epoch'][1:] = (trial_nums - 1) // (block_length * self.settings.block_in_epochN) + 1
 
-                # real
-                for real in range(1, self.settings.blocklengthN + 1):
+        if self.settings.blockprepN % 2 == 1:
+            mod_pattern = 0
+        else:
+            mod_pattern = 1
 
-                    current_trial_num += 1
-                    all_trial_Nr += 1
+        # stimuli are drawn in trial order, pattern trials depend on the stimulus two trials before
+        stimlist = trials['stim']
+        for all_trial_Nr in range(1, maxtrial + 1):
+            current_trial_num = trials['trial'][all_trial_Nr]
 
-                    asrt_type = self.settings.asrt_types[self.stim_sessionN[all_trial_Nr]]
+            # practice
+            if current_trial_num <= self.settings.blockprepN:
+                stimlist[all_trial_Nr] = random.choice([1, 2, 3, 4])
+                trials['type'][all_trial_Nr] = g_random
+                continue
 
-                    if self.settings.blockprepN % 2 == 1:
-                        mod_pattern = 0
-                    else:
-                        mod_pattern = 1
-
-                    if current_trial_num % 2 == mod_pattern and asrt_type != "noASRT":
-                        if current_trial_num > 2:
-                            current_stim = self.next_stim(self.stim_sessionN[all_trial_Nr], self.stimlist[all_trial_Nr - 2])
-                            self.stimpr[all_trial_Nr] = "pattern"
-                        else:
-                            # first pattern stim is random
-                            current_stim = random.choice([1, 2, 3, 4])
-                            self.stimpr[all_trial_Nr] = "random"
-                    else:
-                        current_stim = random.choice([1, 2, 3, 4])
-                        self.stimpr[all_trial_Nr] = "random"
+            # real
+            asrt_type = self.settings.asrt_types[trials['session'][all_trial_Nr]]
+
+            if current_trial_num % 2 == mod_pattern and asrt_type != "noASRT" and current_trial_num > 2:
+                stimlist[all_trial_Nr] = self.next_stim(trials['session'][all_trial_Nr], stimlist[all_trial_Nr - 2])
+                trials['type'][all_trial_Nr] = g_pattern
+            else:
+                # the first pattern stim is random too
+                stimlist[all_trial_Nr] = random.choice([1, 2, 3, 4])
+                trials['type'][all_trial_Nr] = g_random
 
-                    self.stimlist[all_trial_Nr] = current_stim
-                    self.stimtrial[all_trial_Nr] = current_trial_num
-                    self.stimblock[all_trial_Nr] = block_num
-                    self.stimepoch[all_trial_Nr] = epoch
+        self.trials = trials
 
     def participant_id(self):
         """Find out the current subject and read subject settings / progress if he/she already has any data."""
@@ -1415,9 +1652,23 @@ class Experiment:
         subject_list_file_path = os.path.join(self.workdir_path, "settings",
                                               "participants_in_experiment.txt")
         output_file_path = os.path.join(self.workdir_path, "logs", subject_id + '_log.txt')
+        if self.settings.experiment_type == 'eye-tracking' and g_gaze_store:
+            if not gaze_store.g_tables_available:
+                print("For writing the gaze sample store (g_gaze_store),"
+                      " we need tables (PyTables) module to be installed!")
+                core.quit()
+            gaze_store_file_prefix = os.path.join(self.workdir_path, "logs", subject_id)
+        else:
+            gaze_store_file_prefix = None
+        # eye-tracking samples are not journaled, an interrupted block is repeated
+        if self.settings.experiment_type == 'reaction-time' and g_trial_journal:
+            journal_file_path = all_settings_file_path + '_journal'
+        else:
+            journal_file_path = None
         self.person_data = PersonDataHandler(subject_id, all_settings_file_path,
                                              all_IDs_file_path, subject_list_file_path,
-                                             output_file_path, self.settings.experiment_type)
+                                             output_file_path, self.settings.experiment_type,
+                                             gaze_store_file_prefix, journal_file_path, self.storage)
 
         # try to load settings and progress for the given subject ID
         self.person_data.load_person_settings(self)
@@ -1436,7 +1687,17 @@ class Experiment:
             # save data of the new subject
             self.person_data.save_person_settings(self)
 
+        # high / low triplet labels used in the output
+        self.calculate_triplet_types()
+
     def init_eyetracker(self):
+        if g_gaze_replay_file_path is not None:
+            (samples, stimulus_positions) = gaze_replay.read_samples(g_gaze_replay_file_path)
+            self.eye_tracker = gaze_replay.ReplayEyeTracker(samples, g_gaze_replay_speed)
+            self.gaze_data_stream = gaze_replay.g_gaze_data_stream
+            self.get_system_time_stamp = gaze_replay.get_system_time_stamp
+            return
+
         allTrackers = tobii.find_all_eyetrackers()
         if not allTrackers:
             self.print_to_screen("Eye-tracker eszköz keresése...")
@@ -1454,47 +1715,20 @@ class Experiment:
             core.quit()
 
         self.eye_tracker = allTrackers[0]
+        self.gaze_data_stream = tobii.EYETRACKER_GAZE_DATA
+        self.get_system_time_stamp = tobii.get_system_time_stamp
 
-    def eye_data_callback(self, origGazeData):
-        gazeData = copy.deepcopy(origGazeData)
-        time_stamp = tobii.get_system_time_stamp()
-        left_gaze_XY = gazeData['left_gaze_point_on_display_area']
-        right_gaze_XY = gazeData['right_gaze_point_on_display_area']
-        left_gaze_valid = gazeData['left_gaze_point_validity']
-        right_gaze_valid = gazeData['right_gaze_point_validity']
-
-        x_coord = None
-        y_coord = None
-        if left_gaze_valid and right_gaze_valid:
-            x_coord = (left_gaze_XY[0] + right_gaze_XY[0]) / 2
-            y_coord = (left_gaze_XY[1] + right_gaze_XY[1]) / 2
-        elif left_gaze_valid:
-            x_coord = left_gaze_XY[0]
-            y_coord = left_gaze_XY[1]
-        elif right_gaze_valid:
-            x_coord = right_gaze_XY[0]
-            y_coord = right_gaze_XY[1]
+    def eye_data_callback(self, gazeData):
+        time_stamp = self.get_system_time_stamp()
+        (x_coord, y_coord, valid) = gaze_position(gazeData)
 
         with self.shared_data_lock:
-            if x_coord != None and y_coord != None:
-                self.gaze_data_list.append((x_coord, y_coord))
-            else:
-                self.gaze_data_list.append((None, None))
-
-            if len(self.gaze_data_list) > self.current_sampling_window:
-                self.gaze_data_list.pop(0)
-                assert len(self.gaze_data_list) == self.current_sampling_window
+            self.gaze_detector.append(x_coord, y_coord, valid)
 
-            self.person_data.output_data_buffer.append([self.last_N, self.last_RSI, self.trial_phase, gazeData, time_stamp])
+            self.person_data.gaze_samples.append(self.last_N + 1, self.last_RSI, self.trial_phase, gazeData, time_stamp)
 
-        if self.main_loop_lock.locked():
-            self.main_loop_lock.release()
-
-    def point_is_in_rectangle(self, point, rect_center, rect_size):
-        if abs(point[0] - rect_center[0]) <= rect_size / 2.0 and abs(point[1] - rect_center[1]) <= rect_size / 2.0:
-            return True
-        else:
-            return False
+            self.gaze_sample_count += 1
+            self.new_gaze_sample.notify()
 
     def ADCS_to_PCMCS(self, pos_ADCS):
         ''' Convert position from tobii active display coordinate system (ADCS) to PsychoPy coordinate system with cm unit (PCMCS).
@@ -1516,6 +1750,20 @@ class Experiment:
                      ((pos_ADCS[1] * monitor_height_cm) - shift_y) * - 1)
         return pos_PCMCS
 
+    def ADCS_array_to_PCMCS(self, positions_ADCS):
+        ''' Convert an array of positions (one row per position) from tobii active display coordinate system (ADCS)
+            to PsychoPy coordinate system with cm unit (PCMCS), see ADCS_to_PCMCS().
+        '''
+        monitor_size = self.mymonitor.getSizePix()
+        aspect_ratio = monitor_size[1] / monitor_size[0]
+        monitor_width_cm = self.settings.monitor_width
+        monitor_height_cm = monitor_width_cm * aspect_ratio
+
+        positions_PCMCS = np.empty_like(positions_ADCS, dtype=float)
+        positions_PCMCS[:, 0] = (positions_ADCS[:, 0] * monitor_width_cm) - monitor_width_cm / 2
+        positions_PCMCS[:, 1] = ((positions_ADCS[:, 1] * monitor_height_cm) - monitor_height_cm / 2) * - 1
+        return positions_PCMCS
+
     def distance_ADCS_to_PCMCS(self, distance_ADCS):
         ''' Convert distance from tobii active display coordinate system (ADCS) to PsychoPy coordinate system with cm unit (PCMCS).
 
@@ -1531,120 +1779,28 @@ class Experiment:
                           distance_ADCS[1] * monitor_height_cm)
         return distance_PCMCS
 
-    def linear_interpolation(self, gaze_data_list, invalid_index):
-        # Do we have an actual invalid data here?
-        assert (gaze_data_list[invalid_index][0] == None or gaze_data_list[invalid_index][1] == None)
-
-        # Find first valid data before the missing data sample
-        valid_before = invalid_index - 1
-        while (valid_before >= 0 and
-               (gaze_data_list[valid_before][0] == None or gaze_data_list[valid_before][1] == None)):
-            valid_before -= 1
-
-        if valid_before < 0:
-            return None
-
-        # Find first valid data after the missing data sample
-        valid_after = invalid_index + 1
-        while (valid_after < len(gaze_data_list) and
-               (gaze_data_list[valid_after][0] == None or gaze_data_list[valid_after][1] == None)):
-            valid_after += 1
-
-        if valid_after >= len(gaze_data_list):
-            return None
-
-        # We calulate distances in sample count
-        full_distance = valid_after - valid_before
-        before_distance = invalid_index - valid_before
-        after_distance = valid_after - invalid_index
-        before_scale_factor = after_distance / full_distance
-        after_scale_factor = before_distance / full_distance
+    def wait_for_eye_response(self, expected_eye_pos):
+        """Wait for a fixation inside the AOI around the expected position (the fixation window is set by gaze_detector.reset()).
 
-        new_x = (gaze_data_list[valid_before][0] * before_scale_factor +
-                 gaze_data_list[valid_after][0] * after_scale_factor)
-        new_y = (gaze_data_list[valid_before][1] * before_scale_factor +
-                 gaze_data_list[valid_after][1] * after_scale_factor)
-
-        return (new_x, new_y)
-
-    def wait_for_eye_response(self, expected_eye_pos, fixation_threshold):
+           The thread sleeps until the callback notifies a new sample, the window is checked once for every
+           new sample (or for the newest one, if several arrived since the last check).
+        """
 
+        # sequence number of the last sample checked (None: check the samples already there first)
+        checked_sample_count = None
         while (True):
             if 'q' in event.getKeys():
-                if self.main_loop_lock.locked():
-                    self.main_loop_lock.release()
                 return -1
 
-            self.main_loop_lock.acquire()
-
-            with self.shared_data_lock:
-                if len(self.gaze_data_list) < fixation_threshold:
-                    continue
-
-                last_item = self.gaze_data_list[-1]
-
-                # calculate avarage and max distance
-                count = 0
-                sum_x = 0
-                sum_y = 0
-                max_x = -10.0
-                max_y = -10.0
-                min_x = 10.0
-                min_y = 10.0
-                count = 0
-                invalid_count = 0
-                for i in range(len(self.gaze_data_list)):
-                    pos_x = self.gaze_data_list[i][0]
-                    pos_y = self.gaze_data_list[i][1]
-
-                    # We interpolate the invalid data lineary
-                    if pos_x == None or pos_y == None:
-                        invalid_count += 1
-                        interpolated_data = self.linear_interpolation(self.gaze_data_list, i)
-                        if interpolated_data == None:
-                            break
-                        else:
-                            pos_x = interpolated_data[0]
-                            pos_y = interpolated_data[1]
-
-                    if pos_x != None and pos_y != None:
-                        sum_x += pos_x
-                        sum_y += pos_y
-                        max_x = max(max_x, pos_x)
-                        max_y = max(max_y, pos_y)
-                        min_x = min(min_x, pos_x)
-                        min_y = min(min_y, pos_y)
-                        count += 1
-
-                    if count >= fixation_threshold:
-                        break
-
-                    if invalid_count > fixation_threshold * 0.2:
-                        break
-
-                # We have too many invalid data (we allow maximum 20% to be invalid)
-                if invalid_count > fixation_threshold * 0.2:
-                    continue
-
-                # Do we have engough data for a fixation?
-                if count < fixation_threshold:
-                    continue
-
-                # Is the eye data within the given dispersion?
-                dispersion_vector_norm = ((max_x - min_x), (max_y - min_y))
-                dispersion_vector_cm = self.distance_ADCS_to_PCMCS(dispersion_vector_norm)
-                dispersion_cm = dispersion_vector_cm[0] + dispersion_vector_cm[1]
-                if dispersion_cm > self.settings.dispersion_threshold:
+            with self.new_gaze_sample:
+                if not self.new_gaze_sample.wait_for(lambda: self.gaze_sample_count != checked_sample_count, g_gaze_wait_timeout):
                     continue
+                checked_sample_count = self.gaze_sample_count
+                fixation = self.gaze_detector.fixation()
 
-                # Calculate fixation position
-                avg_pos_norm = (sum_x / fixation_threshold, sum_y / fixation_threshold)
-                avg_pos_cm = self.ADCS_to_PCMCS(avg_pos_norm)
-
-                if self.point_is_in_rectangle(avg_pos_cm, expected_eye_pos, self.settings.AOI_size):
-                    if self.main_loop_lock.locked():
-                        self.main_loop_lock.release()
-                    return 1
+            if fixated_AOI(fixation, [expected_eye_pos], self.settings.AOI_size, self.settings.dispersion_threshold,
+                           self.ADCS_to_PCMCS, self.distance_ADCS_to_PCMCS) is not None:
+                return 1
 
     def monitor_settings(self):
         """Specify monitor settings."""
@@ -1661,7 +1817,7 @@ class Experiment:
     def print_to_screen(self, mytext):
         """Display any string on the screen."""
 
-        xtext = visual.TextStim(self.mywindow, text=mytext, units="cm", height=0.8, wrapWidth=20, color="black")
+        xtext = self.stim_cache.text('message', mytext, units="cm", height=0.8, wrapWidth=20, color="black")
         xtext.draw()
         self.mywindow.flip()
 
@@ -1677,13 +1833,6 @@ class Experiment:
         self.frame_sd = ms_per_frame[1]
         self.frame_rate = self.mywindow.getActualFrameRate()
 
-    def stim_bg(self, stimbg):
-        """Draw empty stimulus circles."""
-
-        for i in range(1, 5):
-            stimbg.pos = self.dict_pos[i]
-            stimbg.draw()
-
     def show_feedback_RT(self, N, number_of_patterns, patternERR, responses_in_block, accs_in_block, RT_all_list, RT_pattern_list):
         """ Display feedback in the end of the blocks, showing some data about speed and accuracy."""
 
@@ -1694,7 +1843,7 @@ class Experiment:
         rt_mean = float(sum(RT_all_list)) / len(RT_all_list)
         rt_mean_str = str(rt_mean)[:5].replace('.', ',')
 
-        if self.settings.asrt_types[self.stim_sessionN[N - 1]] == 'explicit':
+        if self.settings.asrt_types[self.trials['session'][N - 1]] == 'explicit':
 
             try:
                 rt_mean_p = float(sum(RT_pattern_list)) / len(RT_pattern_list)
@@ -1732,7 +1881,7 @@ class Experiment:
         if not end_of_session:
             self.fixation_cross.draw()
             self.print_to_screen("A következő blokkra lépéshez néz a keresztre!")
-            response = self.wait_for_eye_response(self.fixation_cross_pos, self.settings.instruction_fixation_threshold)
+            response = self.wait_for_eye_response(self.fixation_cross_pos)
             if response == -1:
                 return 'quit'
             else:
@@ -1742,14 +1891,13 @@ class Experiment:
 
     def wait_for_response(self, expected_response, response_clock):
         if self.settings.experiment_type == 'reaction-time':
-            press = event.waitKeys(keyList=self.settings.get_key_list(),
-                                   timeStamped=response_clock)
-            if press[0][0] == 'q':
-                return (-1, press[0][1])
-            return (self.pressed_dict[press[0][0]], press[0][1])
+            press = self.response_keyboard.wait_for_press()
+            if press[0] == 'q':
+                return (-1, press[1])
+            return (self.pressed_dict[press[0]], press[1])
         # for ET version we wait for getting the right response (there is no wrong answer)
         else:
-            response = self.wait_for_eye_response(self.dict_pos[expected_response], self.settings.stim_fixation_threshold)
+            response = self.wait_for_eye_response(self.dict_pos[expected_response])
             # this RT is not precise, but good enough to give a feedback for the subject
             if response == 1:
                 return (expected_response, response_clock.getTime())
@@ -1760,9 +1908,10 @@ class Experiment:
         self.print_to_screen("Kilépés...\nAdatok mentése...")
 
         if self.eye_tracker is not None:
-            self.eye_tracker.unsubscribe_from(tobii.EYETRACKER_GAZE_DATA, self.eye_data_callback)
+            self.eye_tracker.unsubscribe_from(self.gaze_data_stream, self.eye_data_callback)
 
         self.person_data.append_to_output_file('userquit')
+        self.person_data.wait_for_writes()
         core.wait(3.0)
         core.quit()
 
@@ -1774,8 +1923,11 @@ class Experiment:
                               fillColor=self.colors['stimp'], lineColor=self.colors['linecolor'], pos=self.dict_pos[1])
         stimR = visual.Circle(win=self.mywindow, radius=self.settings.asrt_size, units="cm",
                               fillColor=self.colors['stimr'], lineColor=self.colors['linecolor'], pos=self.dict_pos[1])
-        stimbg = visual.Circle(win=self.mywindow, radius=self.settings.asrt_size, units="cm",
-                               fillColor=None, lineColor=self.colors['linecolor'])
+        # four empty circles where the actual stimulus can be placed, pre-rendered into one layer
+        self.stim_cache.add_layer('stimulus_circles',
+                                  [visual.Circle(win=self.mywindow, radius=self.settings.asrt_size, units="cm", pos=self.dict_pos[i],
+                                                 fillColor=None, lineColor=self.colors['linecolor']) for i in range(1, 5)])
+        stim_bg = self.stim_cache.layer('stimulus_circles')
         if self.settings.experiment_type == 'eye-tracking':
             # place the fixation cross to the bottom-right corner of the screen
             aspect_ratio = self.mymonitor.getSizePix()[1] / self.mymonitor.getSizePix()[0]
@@ -1798,7 +1950,8 @@ class Experiment:
 
         RSI = core.StaticPeriod(screenHz=self.frame_rate)
         RSI_clock = core.Clock()
-        trial_clock = core.Clock()
+        # reset at the stimulus onset flip
+        trial_clock = self.response_keyboard.clock
 
         first_trial_in_block = True
 
@@ -1807,11 +1960,31 @@ class Experiment:
 
         # start recording gaze data
         if self.eye_tracker is not None:
-            self.current_sampling_window = self.settings.instruction_fixation_threshold
-            self.eye_tracker.subscribe_to(tobii.EYETRACKER_GAZE_DATA, self.eye_data_callback, as_dictionary=True)
+            self.gaze_detector = FixationDetector(max(self.settings.instruction_fixation_threshold,
+                                                      self.settings.stim_fixation_threshold))
+            self.gaze_detector.reset(self.settings.instruction_fixation_threshold)
+            self.eye_tracker.subscribe_to(self.gaze_data_stream, self.eye_data_callback, as_dictionary=True)
+
+        trial_flags = self.settings.get_trial_flags()
+
+        # a block interrupted by a crash goes on with the counters of its journaled responses (they are in its feedback)
+        block_starts = np.flatnonzero(trial_flags['session_start'][:N + 1] | trial_flags['block_start'][:N + 1])
+        journaled_records = self.person_data.journaled_records
+        if len(block_starts) > 0:
+            journaled_records = journaled_records[journaled_records['N'] >= block_starts[-1]]
+        for record in journaled_records:
+            stimRT = float(record['RT'])
+            stimACC = int(record['error'])
+            responses_in_block += 1
+            accs_in_block.append(stimACC)
+            if self.trials['type'][record['N']] == g_pattern:
+                patternERR += stimACC
+                number_of_patterns += 1
+                RT_pattern_list.append(stimRT)
+            RT_all_list.append(stimRT)
 
         # show instructions or continuation message
-        if N in self.settings.get_session_starts():
+        if trial_flags['session_start'][N]:
             self.instructions.show_instructions(self)
 
         else:
@@ -1820,27 +1993,29 @@ class Experiment:
         RSI.start(self.settings.RSI_time)
         while True:
             # four empty circles where the actual stimulus can be placed
-            self.stim_bg(stimbg)
+            stim_bg.draw()
             self.mywindow.flip()
             with self.shared_data_lock:
                 if self.eye_tracker is not None:
-                    self.current_sampling_window = self.settings.stim_fixation_threshold
-                    self.gaze_data_list.clear()
+                    self.gaze_detector.reset(self.settings.stim_fixation_threshold)
                 self.last_N = N - 1
                 self.trial_phase = "before_stimulus"
                 self.last_RSI = -1
 
+            stim_num = int(self.trials['stim'][N])
+            is_pattern = self.trials['type'][N] == g_pattern
+
             # set the actual stimulus' position and fill color
-            if self.stimpr[N] == 'pattern':
-                if self.settings.asrt_types[self.stim_sessionN[N]] == 'explicit':
+            if is_pattern:
+                if self.settings.asrt_types[self.trials['session'][N]] == 'explicit':
                     stimP.fillColor = self.colors['stimp']
                 else:
                     stimP.fillColor = self.colors['stimr']
                 stimcolor = stimP.fillColor
-                stimP.setPos(self.dict_pos[self.stimlist[N]])
+                stimP.setPos(self.dict_pos[stim_num])
             else:
                 stimcolor = self.colors['stimr']
-                stimR.setPos(self.dict_pos[self.stimlist[N]])
+                stimR.setPos(self.dict_pos[stim_num])
 
             # wait before the next stimulus to have the set RSI
             RSI.complete()
@@ -1849,14 +2024,15 @@ class Experiment:
 
             while True:
                 cycle += 1
-                self.stim_bg(stimbg)
+                stim_bg.draw()
 
                 # display the actual stimulus
-                if self.stimpr[N] == 'pattern':
+                if is_pattern:
                     stimP.draw()
                 else:
                     stimR.draw()
-                self.mywindow.flip()
+                # the RT is measured from the first onset of the stimulus (repeated after wrong responses)
+                self.response_keyboard.flip(self.mywindow, reset_clock=(cycle == 1))
 
                 # we measure the actual RSI
                 if cycle == 1:
@@ -1869,9 +2045,7 @@ class Experiment:
                     self.trial_phase = "stimulus_on_screen"
                     self.last_RSI = stim_RSI
 
-                if cycle == 1:
-                    trial_clock.reset()
-                (response, time_stamp) = self.wait_for_response(self.stimlist[N], trial_clock)
+                (response, time_stamp) = self.wait_for_response(stim_num, trial_clock)
 
                 with self.shared_data_lock:
                     self.trial_phase = "after_reaction"
@@ -1899,11 +2073,11 @@ class Experiment:
                     self.quit_presentation()
 
                 # right response
-                elif response == self.stimlist[N]:
+                elif response == stim_num:
                     stimACC = 0
                     accs_in_block.append(0)
 
-                    if self.stimpr[N] == 'pattern':
+                    if is_pattern:
                         number_of_patterns += 1
                         RT_pattern_list.append(stimRT)
                     RT_all_list.append(stimRT)
@@ -1913,7 +2087,7 @@ class Experiment:
                     stimACC = 1
                     accs_in_block.append(1)
 
-                    if self.stimpr[N] == 'pattern':
+                    if is_pattern:
                         patternERR += 1
                         number_of_patterns += 1
                         RT_pattern_list.append(stimRT)
@@ -1921,8 +2095,8 @@ class Experiment:
 
                 # save data of the last trial (for ET we save data for every sample)
                 if self.settings.experiment_type == 'reaction-time':
-                    self.person_data.output_data_buffer.append([N, stim_RSI, stim_RT_time, stim_RT_date,
-                                                                stimRT, stimACC, response, stimcolor, self.stim_output_line])
+                    self.person_data.add_trial_output([N, stim_RSI, stim_RT_time, stim_RT_date,
+                                                       stimRT, stimACC, response, stimcolor, self.stim_output_line])
 
                 if stimACC == 0:
                     N += 1
@@ -1930,7 +2104,7 @@ class Experiment:
                     break
 
             # end of the block (show feedback and reinit variables for the next block)
-            if N in self.settings.get_block_starts():
+            if trial_flags['block_start'][N]:
 
                 self.print_to_screen(u"Adatok mentése és visszajelzés előkészítése...")
                 with self.shared_data_lock:
@@ -1938,25 +2112,16 @@ class Experiment:
                     self.trial_phase = "before_stimulus"
                     self.last_RSI = -1
                     if self.eye_tracker is not None:
-                        self.current_sampling_window = self.settings.instruction_fixation_threshold
-                        self.gaze_data_list.clear()
-
-                if self.settings.experiment_type == 'reaction-time':
-                    self.person_data.flush_RT_data_to_output(self)
-                else:
-                    # stop registering more eye-tracking data
-                    self.eye_tracker.unsubscribe_from(tobii.EYETRACKER_GAZE_DATA, self.eye_data_callback)
-                    self.person_data.flush_ET_data_to_output(self)
-                    # continue eye-tracking
-                    self.eye_tracker.subscribe_to(tobii.EYETRACKER_GAZE_DATA, self.eye_data_callback, as_dictionary=True)
+                        self.gaze_detector.reset(self.settings.instruction_fixation_threshold)
 
-                self.person_data.save_person_settings(self)
+                # the output is written on the I/O thread, the eye-tracker goes on recording
+                self.person_data.checkpoint(self)
 
                 if self.settings.experiment_type == 'reaction-time':
                     whatnow = self.show_feedback_RT(N, number_of_patterns, patternERR, responses_in_block,
                                                     accs_in_block, RT_all_list, RT_pattern_list)
                 else:
-                    whatnow = self.show_feedback_ET(RT_all_list, N == self.end_at[N - 1])
+                    whatnow = self.show_feedback_ET(RT_all_list, N == self.trials['end_at'][N - 1])
 
                 if whatnow == 'quit':
                     if N >= 1:
@@ -1976,10 +2141,10 @@ class Experiment:
                 first_trial_in_block = True
 
             # end of the sessions (one run of the experiment script stops at the end of the current session)
-            if N == self.end_at[N - 1]:
+            if N == self.trials['end_at'][N - 1]:
                 # stop recoring gaze data
                 if self.eye_tracker is not None:
-                    self.eye_tracker.unsubscribe_from(tobii.EYETRACKER_GAZE_DATA, self.eye_data_callback)
+                    self.eye_tracker.unsubscribe_from(self.gaze_data_stream, self.eye_data_callback)
                 break
 
     def run(self, full_screen=True, mouse_visible=False, window_gammaErrorPolicy='raise'):
@@ -1989,7 +2154,8 @@ class Experiment:
         # load experiment settings if exist or ask the user to specify them
         all_settings_file_path = os.path.join(self.workdir_path, "settings", "settings")
         reminder_file_path = os.path.join(self.workdir_path, "settings", "settings_reminder.txt")
-        self.settings = ExperimentSettings(all_settings_file_path, reminder_file_path)
+        self.storage = storage.open_storage(g_storage_backend, os.path.join(self.workdir_path, "settings", "experiment.sqlite3"))
+        self.settings = ExperimentSettings(all_settings_file_path, reminder_file_path, self.storage)
         self.all_settings_def()
 
         # specify predefined dictionaries
@@ -2026,6 +2192,8 @@ class Experiment:
         with visual.Window(size=self.mymonitor.getSizePix(), color=self.colors['wincolor'], fullscr=False,
                            monitor=self.mymonitor, units="cm", gammaErrorPolicy=window_gammaErrorPolicy) as self.mywindow:
             self.mywindow.mouseVisible = mouse_visible
+            self.stim_cache = StimulusCache(self.mywindow)
+            self.response_keyboard = ResponseKeyboard(self.settings.get_key_list())
 
             # init eye-tracker if needed
             if self.settings.experiment_type == 'eye-tracking':
@@ -2040,6 +2208,7 @@ class Experiment:
             # save user data
             self.person_data.save_person_settings(self)
             self.person_data.append_to_output_file('sessionend_planned_quit')
+            self.person_data.wait_for_writes()
 
             # show ending screen
             self.instructions.show_ending(self)
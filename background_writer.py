@@ -0,0 +1,72 @@
+"""Background I/O thread for the output and settings files of the experiment scripts.
+
+The presentation thread hands write jobs (output flushes, settings saves) to a
+BackgroundWriter instead of doing the disk I/O itself, so block breaks do not wait
+for the disk. Jobs are run one after the other in the order they were submitted.
+Every job gets a Future which is resolved when the job finished writing (the output
+file appends are fsync-ed), and the writer is drained before the script exits.
+"""
+
+from concurrent.futures import Future
+import atexit
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """A single I/O thread fed by a bounded job queue."""
+
+    def __init__(self, max_pending_jobs=16):
+        # submitted and not yet finished jobs, submit() blocks when there are max_pending_jobs of them
+        self.jobs = queue.Queue(maxsize=max_pending_jobs)
+        # the first exception raised by a job, it is re-raised on the submitting thread
+        self.error = None
+        self.thread = threading.Thread(target=self.__run, name='BackgroundWriter', daemon=True)
+        self.thread.start()
+        # psychopy's core.quit() exits through sys.exit(), so nothing queued is lost on quit
+        atexit.register(self.close)
+
+    def submit(self, function, *args):
+        """Queue function(*args) to run on the I/O thread, returns with a Future acknowledging the write."""
+
+        self.raise_error()
+        future = Future()
+        self.jobs.put((future, function, args))
+        return future
+
+    def drain(self):
+        """Wait until all the submitted jobs are finished."""
+
+        self.jobs.join()
+        self.raise_error()
+
+    def close(self):
+        """Drain the queue and stop the I/O thread."""
+
+        if self.thread.is_alive():
+            self.jobs.join()
+            self.jobs.put(None)
+            self.thread.join()
+
+    def raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def __run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            (future, function, args) = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except BaseException as error:
+                    if self.error is None:
+                        self.error = error
+                    future.set_exception(error)
+            self.jobs.task_done()
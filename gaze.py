@@ -0,0 +1,299 @@
+"""Gaze samples of the eye-tracking ASRT, shared between the eye-tracker's callback thread and the presentation.
+
+GazeRingBuffer keeps the newest gaze positions (tobii active display coordinate system)
+with their validity in fixed-size NumPy arrays: an append is O(1) and does not allocate,
+and the newest samples are read as views of the arrays, without copying.
+
+FixationDetector keeps such a buffer and updates the fixation statistics of the newest
+samples with every sample, so checking for a fixation costs the same for any window size.
+
+GazeSampleColumns collects the samples of a block for the output: the callback copies only
+the scalar fields needed into preallocated typed columns (see gaze_store.g_sample_dtype),
+which grow by whole chunks, so recording a sample does not build any Python object.
+
+gaze_position() and fixated_AOI() are the steps of the gaze-contingent logic around the
+detector (the gaze position of a sample and the decision on a fixation), shared by asrt.py
+and the benchmark of gaze_replay.py.
+"""
+
+from collections import deque
+from operator import ge, le
+import numpy as np
+import gaze_store
+
+# number of samples in a chunk of GazeSampleColumns (almost a minute of samples at 1200 Hz)
+g_sample_chunk_size = 65536
+
+# columns recorded by the callback, the PCMCS positions are calculated when the samples are written out
+g_recorded_columns = [name for name in gaze_store.g_sample_dtype.names if not name.endswith('_PCMCS')]
+
+# trial phase -> its code in the trial_phase column
+g_trial_phase_codes = {phase: code for code, phase in enumerate(gaze_store.g_trial_phases)}
+
+
+class GazeRingBuffer:
+    """Fixed-capacity ring buffer of gaze positions (x, y) and their validity.
+
+       Every sample is written twice, at its slot and at slot + capacity, so the newest samples
+       are always a contiguous part of the arrays. Use it under the lock shared with the writer.
+    """
+
+    def __init__(self, capacity):
+        # maximum number of samples kept
+        self.capacity = capacity
+        # gaze position and validity of the samples, two copies of the ring one after the other
+        self.x = np.full(2 * capacity, np.nan)
+        self.y = np.full(2 * capacity, np.nan)
+        self.valid = np.zeros(2 * capacity, dtype=bool)
+        # slot of the next sample
+        self.next_slot = 0
+        # number of samples appended since the last clear() (it is not limited by the capacity)
+        self.count = 0
+
+    def append(self, x, y, valid):
+        """Append a sample (x and y are ignored for an invalid sample)."""
+
+        slot = self.next_slot
+        if not valid:
+            x = y = np.nan
+        self.x[slot] = self.x[slot + self.capacity] = x
+        self.y[slot] = self.y[slot + self.capacity] = y
+        self.valid[slot] = self.valid[slot + self.capacity] = valid
+
+        self.next_slot = slot + 1 if slot + 1 < self.capacity else 0
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def newest(self, sample_count):
+        """Return with views (x, y, valid) of the newest sample_count samples (fewer if there are not so many),
+           the oldest one first. The views change with the next appends.
+        """
+
+        sample_count = min(sample_count, len(self))
+        end = self.next_slot + self.capacity
+        return (self.x[end - sample_count:end], self.y[end - sample_count:end], self.valid[end - sample_count:end])
+
+
+class FixationDetector:
+    """Incremental dispersion-threshold (I-DT) fixation detection over the newest samples.
+
+       A window of window_size samples is a fixation candidate if its first and last samples
+       are valid and at most 20% of its samples are invalid; the invalid samples are replaced
+       by the linear interpolation of the valid samples around them. The running sums, the
+       monotonic deques of the minimum / maximum positions and the interpolated sums of the
+       gaps are updated with every sample (O(1) amortized), so fixation() does not scan the window.
+    """
+
+    def __init__(self, capacity):
+        # largest window size, the buffer keeps one sample more (the sample leaving the window)
+        self.buffer = GazeRingBuffer(capacity + 1)
+        self.reset(capacity)
+
+    def reset(self, window_size):
+        """Drop all the samples and use the given window size from now on."""
+
+        self.window_size = window_size
+        self.buffer.clear()
+        # serial number of the next sample (since the reset)
+        self.next_serial = 0
+        # sums of the valid positions and number of invalid samples in the window
+        self.valid_sum_x = 0.0
+        self.valid_sum_y = 0.0
+        self.invalid_count = 0
+        # (serial, position) of valid samples with increasing / decreasing positions, the window's min and max are the first ones
+        self.min_x = deque()
+        self.max_x = deque()
+        self.min_y = deque()
+        self.max_y = deque()
+        # interpolated gaps: (serial of the last invalid sample, sum of the interpolated x, sum of the interpolated y)
+        self.gaps = deque()
+        self.gap_sum_x = 0.0
+        self.gap_sum_y = 0.0
+        # last valid position and the number of invalid samples after it
+        self.last_valid = None
+        self.invalid_run = 0
+
+    def append(self, x, y, valid):
+        """Add the next sample and update the window."""
+
+        serial = self.next_serial
+        self.next_serial += 1
+        self.buffer.append(x, y, valid)
+
+        # the sample leaving the window
+        leaving_serial = serial - self.window_size
+        if leaving_serial >= 0:
+            (leaving_x, leaving_y, leaving_valid) = self.buffer.newest(self.window_size + 1)
+            if leaving_valid[0]:
+                self.valid_sum_x -= leaving_x[0]
+                self.valid_sum_y -= leaving_y[0]
+            else:
+                self.invalid_count -= 1
+            for extremes in (self.min_x, self.max_x, self.min_y, self.max_y):
+                if len(extremes) > 0 and extremes[0][0] <= leaving_serial:
+                    extremes.popleft()
+            while len(self.gaps) > 0 and self.gaps[0][0] <= leaving_serial:
+                (gap_end, gap_sum_x, gap_sum_y) = self.gaps.popleft()
+                self.gap_sum_x -= gap_sum_x
+                self.gap_sum_y -= gap_sum_y
+
+        if not valid:
+            self.invalid_count += 1
+            self.invalid_run += 1
+            return
+
+        self.valid_sum_x += x
+        self.valid_sum_y += y
+        push_extreme(self.min_x, serial, x, ge)
+        push_extreme(self.max_x, serial, x, le)
+        push_extreme(self.min_y, serial, y, ge)
+        push_extreme(self.max_y, serial, y, le)
+
+        # the linear interpolation of a gap of n samples between a and b sums up to n * (a + b) / 2
+        # (a gap which is already out of the window, e.g. with a window of one sample, is not recorded)
+        if self.invalid_run > 0 and self.last_valid is not None and serial - 1 > serial - self.window_size:
+            gap_sum_x = self.invalid_run * (self.last_valid[0] + x) / 2
+            gap_sum_y = self.invalid_run * (self.last_valid[1] + y) / 2
+            self.gaps.append((serial - 1, gap_sum_x, gap_sum_y))
+            self.gap_sum_x += gap_sum_x
+            self.gap_sum_y += gap_sum_y
+        self.last_valid = (x, y)
+        self.invalid_run = 0
+
+    def fixation(self):
+        """Return with (average x, average y, dispersion x, dispersion y) of the window, or None if the window
+           is not full or it has too many invalid samples (the dispersion is checked by the caller).
+        """
+
+        if self.next_serial < self.window_size:
+            return None
+        # the gaps at the edges of the window can not be interpolated
+        if self.invalid_run > 0 or not self.buffer.newest(self.window_size)[2][0]:
+            return None
+        # we allow maximum 20% of the samples to be invalid
+        if self.invalid_count > self.window_size * 0.2:
+            return None
+
+        return ((self.valid_sum_x + self.gap_sum_x) / self.window_size,
+                (self.valid_sum_y + self.gap_sum_y) / self.window_size,
+                self.max_x[0][1] - self.min_x[0][1],
+                self.max_y[0][1] - self.min_y[0][1])
+
+
+def gaze_position(gaze_data):
+    """Return with (x, y, valid) of a tobii gaze data dictionary: the average position of the valid eyes (ADCS),
+       x and y are None if neither eye is valid.
+    """
+
+    left_gaze_XY = gaze_data['left_gaze_point_on_display_area']
+    right_gaze_XY = gaze_data['right_gaze_point_on_display_area']
+    left_gaze_valid = gaze_data['left_gaze_point_validity']
+    right_gaze_valid = gaze_data['right_gaze_point_validity']
+
+    if left_gaze_valid and right_gaze_valid:
+        return ((left_gaze_XY[0] + right_gaze_XY[0]) / 2, (left_gaze_XY[1] + right_gaze_XY[1]) / 2, True)
+    elif left_gaze_valid:
+        return (left_gaze_XY[0], left_gaze_XY[1], True)
+    elif right_gaze_valid:
+        return (right_gaze_XY[0], right_gaze_XY[1], True)
+    return (None, None, False)
+
+
+def fixated_AOI(fixation, AOI_centers, AOI_size, dispersion_threshold, ADCS_to_PCMCS, distance_ADCS_to_PCMCS):
+    """Return with the index of the AOI containing a fixation of FixationDetector.fixation(), or None.
+
+       The AOIs are squares of AOI_size cm around the AOI_centers (PsychoPy cm coordinates). There is no
+       decision if the fixation is None or its dispersion (x + y, in cm) is above the dispersion threshold.
+       The conversion functions of the screen map the ADCS positions and distances to cm.
+    """
+
+    # not enough valid data for a fixation
+    if fixation is None:
+        return None
+
+    # Is the eye data within the given dispersion?
+    (avg_x, avg_y, dispersion_x, dispersion_y) = fixation
+    dispersion_vector_cm = distance_ADCS_to_PCMCS((dispersion_x, dispersion_y))
+    if dispersion_vector_cm[0] + dispersion_vector_cm[1] > dispersion_threshold:
+        return None
+
+    # Calculate fixation position
+    avg_pos_cm = ADCS_to_PCMCS((avg_x, avg_y))
+    for index, AOI_center in enumerate(AOI_centers):
+        if abs(avg_pos_cm[0] - AOI_center[0]) <= AOI_size / 2.0 and abs(avg_pos_cm[1] - AOI_center[1]) <= AOI_size / 2.0:
+            return index
+    return None
+
+
+def push_extreme(extremes, serial, value, dominated):
+    """Push a sample into a monotonic deque, dropping the samples which can not be the window's extreme anymore
+       (dominated(last value, new value) is true for them).
+    """
+
+    while len(extremes) > 0 and dominated(extremes[-1][1], value):
+        extremes.pop()
+    extremes.append((serial, value))
+
+
+class GazeSampleColumns:
+    """Recorded gaze samples in typed columns, filled by the eye-tracker's callback.
+
+       The columns are allocated in chunks of chunk_size samples; a full chunk is kept as it
+       is and a new one is started, so an append never copies the earlier samples.
+       Use it under the lock shared with the reader.
+    """
+
+    def __init__(self, chunk_size=g_sample_chunk_size):
+        # number of samples in a chunk
+        self.chunk_size = chunk_size
+        # full chunks: column name -> array of chunk_size samples
+        self.full_chunks = []
+        # chunk being filled and the number of samples in it
+        self.chunk = self.__new_chunk()
+        self.chunk_count = 0
+
+    def __len__(self):
+        return len(self.full_chunks) * self.chunk_size + self.chunk_count
+
+    def append(self, trial, RSI_time, trial_phase, gaze_data, time_stamp):
+        """Append a sample: the global trial number, the RSI, the trial phase (see gaze_store.g_trial_phases),
+           the gaze data dictionary of tobii_research and the system time stamp of the sample.
+        """
+
+        if self.chunk_count == self.chunk_size:
+            self.full_chunks.append(self.chunk)
+            self.chunk = self.__new_chunk()
+            self.chunk_count = 0
+
+        row = self.chunk_count
+        chunk = self.chunk
+        chunk['trial'][row] = trial
+        chunk['RSI_time'][row] = RSI_time
+        chunk['trial_phase'][row] = g_trial_phase_codes[trial_phase]
+        chunk['left_gaze_ADCS'][row] = gaze_data['left_gaze_point_on_display_area']
+        chunk['right_gaze_ADCS'][row] = gaze_data['right_gaze_point_on_display_area']
+        chunk['left_gaze_validity'][row] = gaze_data['left_gaze_point_validity']
+        chunk['right_gaze_validity'][row] = gaze_data['right_gaze_point_validity']
+        chunk['left_pupil_diameter'][row] = gaze_data['left_pupil_diameter']
+        chunk['right_pupil_diameter'][row] = gaze_data['right_pupil_diameter']
+        chunk['left_pupil_validity'][row] = gaze_data['left_pupil_validity']
+        chunk['right_pupil_validity'][row] = gaze_data['right_pupil_validity']
+        chunk['time_stamp'][row] = time_stamp
+        self.chunk_count = row + 1
+
+    def to_array(self):
+        """Return with the samples as an array of gaze_store.g_sample_dtype (the PCMCS positions are not filled in)."""
+
+        samples = np.zeros(len(self), dtype=gaze_store.g_sample_dtype)
+        for name in g_recorded_columns:
+            samples[name] = np.concatenate([chunk[name] for chunk in self.full_chunks] + [self.chunk[name][:self.chunk_count]])
+        return samples
+
+    def __new_chunk(self):
+        return {name: np.empty((self.chunk_size,) + gaze_store.g_sample_dtype[name].shape, dtype=gaze_store.g_sample_dtype[name].base)
+                for name in g_recorded_columns}
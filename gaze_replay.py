@@ -0,0 +1,519 @@
+"""Replay of recorded or synthetic gaze samples, to run the gaze-contingent logic without an eye-tracker.
+
+The samples are arrays of g_replay_dtype (one row per sample), read from our recordings or generated:
+
+    read_ET_log()            the tab-separated output of asrt.py (eye-tracking exp. type)
+    read_gaze_store()        a session file of gaze_store.py (needs PyTables)
+    synthetic_fixations()    fixations on the stimulus positions with noise, saccades and blinks between them
+
+A replay feeds the samples into the interface of the eye-tracker, at the recorded pace multiplied
+by the speed (0: as fast as possible):
+
+    ReplayEyeTracker         stands in for tobii_research's EyeTracker: subscribe_to() calls the callback
+                             from its own thread with gaze data dictionaries, like the tobii SDK does
+                             (asrt.py uses it if g_gaze_replay_file_path is set, tobii_research is not needed then)
+    ReplayEyeLink            stands in for pylink's EyeLink in the sample loops of main.py (getNewestSample())
+
+FixationBenchmark runs the callback and the fixation check of asrt.py on a replay and measures
+the wakeup latency of the check, the CPU cost of the callback and the decisions' accuracy
+against the targets of the samples:
+
+    python gaze_replay.py                               (synthetic samples, 600 Hz)
+    python gaze_replay.py subject_log.txt --speed 10    (a recorded ET log, ten times faster)
+"""
+
+import argparse
+import codecs
+import threading
+import time
+import numpy as np
+import gaze_store
+from gaze import FixationDetector, gaze_position, fixated_AOI
+
+# one row per gaze sample
+#   time: seconds since the first sample, target: stimulus number the subject is expected to look at (0: none or unknown)
+#   the other columns are the same as in gaze_store.g_sample_dtype
+g_replay_dtype = np.dtype([('time', np.float64),
+                           ('left_gaze_ADCS', np.float64, (2,)),
+                           ('right_gaze_ADCS', np.float64, (2,)),
+                           ('left_gaze_validity', np.bool_),
+                           ('right_gaze_validity', np.bool_),
+                           ('left_pupil_diameter', np.float64),
+                           ('right_pupil_diameter', np.float64),
+                           ('left_pupil_validity', np.bool_),
+                           ('right_pupil_validity', np.bool_),
+                           ('target', np.int8)])
+
+# stream of ReplayEyeTracker.subscribe_to(), the same as tobii_research.EYETRACKER_GAZE_DATA
+g_gaze_data_stream = 'gaze_data'
+
+# seconds the benchmark waits for a new sample before checking whether the replay is over (it is not notified at the end)
+g_benchmark_wait_timeout = 0.05
+
+
+def get_system_time_stamp():
+    """The current time in microseconds (time.monotonic()), stands in for tobii_research.get_system_time_stamp()."""
+
+    return int(time.monotonic() * 1000000)
+
+
+class ScreenGeometry:
+    """Conversions between the tobii active display coordinate system (ADCS) and the PsychoPy cm coordinates (PCMCS),
+       the same as asrt.Experiment's ADCS_to_PCMCS() and distance_ADCS_to_PCMCS().
+    """
+
+    def __init__(self, monitor_width_cm, monitor_size_pix):
+        self.monitor_width_cm = monitor_width_cm
+        self.monitor_height_cm = monitor_width_cm * monitor_size_pix[1] / monitor_size_pix[0]
+
+    def ADCS_to_PCMCS(self, pos_ADCS):
+        return ((pos_ADCS[0] * self.monitor_width_cm) - self.monitor_width_cm / 2,
+                ((pos_ADCS[1] * self.monitor_height_cm) - self.monitor_height_cm / 2) * - 1)
+
+    def PCMCS_to_ADCS(self, pos_PCMCS):
+        return ((pos_PCMCS[0] + self.monitor_width_cm / 2) / self.monitor_width_cm,
+                (self.monitor_height_cm / 2 - pos_PCMCS[1]) / self.monitor_height_cm)
+
+    def distance_ADCS_to_PCMCS(self, distance_ADCS):
+        return (distance_ADCS[0] * self.monitor_width_cm, distance_ADCS[1] * self.monitor_height_cm)
+
+
+def read_ET_log(file_path):
+    """Read the samples of an output file of asrt.py (eye-tracking exp. type).
+
+       The target of a sample is the stimulus of its trial while the stimulus is on the screen.
+       Returns with the samples and the stimulus positions (stimulus number -> PCMCS position of the first row).
+    """
+
+    with codecs.open(file_path, 'r', encoding='utf-8') as log_file:
+        lines = log_file.read().split('\n')
+
+    columns = {name: index for index, name in enumerate(lines[0].split('\t'))}
+    rows = [line.split('\t') for line in lines[1:] if len(line) > 0]
+    samples = np.zeros(len(rows), dtype=g_replay_dtype)
+    if len(rows) == 0:
+        return (samples, {})
+
+    def column(name, convert=lambda value: float(value.replace(',', '.'))):
+        return [convert(row[columns[name]]) for row in rows]
+
+    time_stamps = np.array(column('gaze_data_time_stamp', int), dtype=np.int64)
+    samples['time'] = (time_stamps - time_stamps[0]) / 1000000.0
+    for eye in ('left', 'right'):
+        samples[eye + '_gaze_ADCS'][:, 0] = column(eye + '_gaze_data_X_ADCS')
+        samples[eye + '_gaze_ADCS'][:, 1] = column(eye + '_gaze_data_Y_ADCS')
+        samples[eye + '_gaze_validity'] = column(eye + '_gaze_validity', lambda value: value == 'True')
+        samples[eye + '_pupil_diameter'] = column(eye + '_pupil_diameter')
+        samples[eye + '_pupil_validity'] = column(eye + '_pupil_validity', lambda value: value == 'True')
+    stimulus_on_screen = np.array(column('trial_phase', str)) == 'stimulus_on_screen'
+    samples['target'] = np.where(stimulus_on_screen, column('stimulus', int), 0)
+
+    stimulus_positions = {stim: (float(rows[0][columns['stimulus_%d_position_X_PCMCS' % stim]].replace(',', '.')),
+                                 float(rows[0][columns['stimulus_%d_position_Y_PCMCS' % stim]].replace(',', '.')))
+                          for stim in range(1, 5)}
+    return (samples, stimulus_positions)
+
+
+def read_gaze_store(file_path):
+    """Read the samples of a session file of gaze_store.py, the targets are set as in read_ET_log().
+
+       Returns with the samples and the stimulus positions.
+    """
+
+    (metadata, trials, store_samples) = gaze_store.read_gaze_store(file_path)
+    samples = np.zeros(len(store_samples), dtype=g_replay_dtype)
+    if len(store_samples) > 0:
+        samples['time'] = (store_samples['time_stamp'] - store_samples['time_stamp'][0]) / 1000000.0
+    for name in g_replay_dtype.names:
+        if name in store_samples.dtype.names:
+            samples[name] = store_samples[name]
+
+    stimulus_on_screen = store_samples['trial_phase'] == gaze_store.g_trial_phases.index('stimulus_on_screen')
+    stims = trials['stim'][store_samples['trial'] - metadata['first_trial']]
+    samples['target'] = np.where(stimulus_on_screen, stims, 0)
+
+    stimulus_positions = {stim: tuple(metadata['stimulus_positions'][stim - 1]) for stim in range(1, 5)}
+    return (samples, stimulus_positions)
+
+
+def read_samples(file_path):
+    """Read a gaze store file (.h5) or an ET log (any other file), see read_gaze_store() and read_ET_log()."""
+
+    if file_path.endswith('.h5'):
+        return read_gaze_store(file_path)
+    return read_ET_log(file_path)
+
+
+def synthetic_fixations(targets_ADCS, fixation_count=200, sampling_rate=600.0, fixation_duration=(0.2, 0.6),
+                        saccade_duration=0.04, noise=0.003, blink_probability=0.2, blink_duration=(0.05, 0.15),
+                        dropout_probability=0.01, seed=None):
+    """Generate fixations on randomly chosen targets (stimulus number -> ADCS position).
+
+       The gaze moves between two fixations with a linear saccade, during which the target is 0.
+       The positions of a fixation scatter around the target with the given standard deviation (ADCS),
+       a fixation contains a blink (both eyes are invalid) with blink_probability, and any sample
+       of an eye is lost with dropout_probability. The durations are in seconds, (min, max) ranges
+       are drawn uniformly.
+    """
+
+    random = np.random.default_rng(seed)
+    target_numbers = sorted(targets_ADCS.keys())
+    sample_time = 1.0 / sampling_rate
+
+    # target and gaze position (x, y) of the samples, built fixation by fixation
+    targets = []
+    positions = []
+    blinks = []
+    previous_position = None
+    for fixation in range(fixation_count):
+        target = target_numbers[random.integers(len(target_numbers))]
+        position = np.asarray(targets_ADCS[target], dtype=float)
+
+        if previous_position is not None:
+            saccade_samples = max(int(round(saccade_duration / sample_time)), 1)
+            steps = np.arange(1, saccade_samples + 1)[:, np.newaxis] / (saccade_samples + 1)
+            positions.append(previous_position + (position - previous_position) * steps)
+            targets.append(np.zeros(saccade_samples, dtype=np.int8))
+            blinks.append(np.zeros(saccade_samples, dtype=bool))
+
+        fixation_samples = int(round(random.uniform(*fixation_duration) / sample_time))
+        positions.append(position + random.normal(0.0, noise, (fixation_samples, 2)))
+        targets.append(np.full(fixation_samples, target, dtype=np.int8))
+        blink = np.zeros(fixation_samples, dtype=bool)
+        if random.random() < blink_probability:
+            blink_samples = min(int(round(random.uniform(*blink_duration) / sample_time)), fixation_samples)
+            blink_start = random.integers(fixation_samples - blink_samples + 1)
+            blink[blink_start:blink_start + blink_samples] = True
+        blinks.append(blink)
+        previous_position = position
+
+    positions = np.concatenate(positions)
+    blinks = np.concatenate(blinks)
+    samples = np.zeros(len(positions), dtype=g_replay_dtype)
+    samples['time'] = np.arange(len(positions)) * sample_time
+    samples['target'] = np.concatenate(targets)
+    for eye in ('left', 'right'):
+        valid = ~blinks & (random.random(len(positions)) >= dropout_probability)
+        samples[eye + '_gaze_ADCS'] = np.where(valid[:, np.newaxis], positions, np.nan)
+        samples[eye + '_gaze_validity'] = valid
+        samples[eye + '_pupil_diameter'] = np.where(valid, random.normal(3.5, 0.1, len(positions)), np.nan)
+        samples[eye + '_pupil_validity'] = valid
+    return samples
+
+
+class ReplayEyeTracker:
+    """Replays samples as the gaze data stream of a tobii_research EyeTracker."""
+
+    def __init__(self, samples, speed=1.0):
+        # samples to replay (array of g_replay_dtype)
+        self.samples = samples
+        # the recorded pace is multiplied by this, 0 replays as fast as possible
+        self.speed = speed
+        # set when all the samples were replayed
+        self.finished = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def subscribe_to(self, stream, callback, as_dictionary=True):
+        """Start replaying the samples into the callback (stream is ignored, only the gaze data stream is replayed)."""
+
+        assert as_dictionary
+        self.unsubscribe_from(stream, callback)
+        self.finished.clear()
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, args=(callback,), name='ReplayEyeTracker', daemon=True)
+        self.thread.start()
+
+    def unsubscribe_from(self, stream, callback=None):
+        """Stop the replay."""
+
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def __run(self, callback):
+        samples = self.samples
+        times = samples['time'].tolist()
+        columns = [samples[name].tolist() for name in ('left_gaze_ADCS', 'right_gaze_ADCS', 'left_gaze_validity', 'right_gaze_validity',
+                                                       'left_pupil_diameter', 'right_pupil_diameter',
+                                                       'left_pupil_validity', 'right_pupil_validity')]
+
+        start = time.perf_counter()
+        for (sample_time, left_ADCS, right_ADCS, left_validity, right_validity,
+             left_pupil_diameter, right_pupil_diameter, left_pupil_validity, right_pupil_validity) in zip(times, *columns):
+            if not self.running:
+                return
+            if self.speed > 0:
+                delay = start + sample_time / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            time_stamp = int(sample_time * 1000000)
+            callback({'device_time_stamp': time_stamp,
+                      'system_time_stamp': time_stamp,
+                      'left_gaze_point_on_display_area': tuple(left_ADCS),
+                      'right_gaze_point_on_display_area': tuple(right_ADCS),
+                      'left_gaze_point_validity': int(left_validity),
+                      'right_gaze_point_validity': int(right_validity),
+                      'left_pupil_diameter': left_pupil_diameter,
+                      'right_pupil_diameter': right_pupil_diameter,
+                      'left_pupil_validity': int(left_pupil_validity),
+                      'right_pupil_validity': int(right_pupil_validity)})
+        self.finished.set()
+
+
+class ReplayEyeLink:
+    """Replays samples as the newest samples of an EyeLink (gaze positions in screen pixels)."""
+
+    def __init__(self, samples, screen_size_pix, speed=1.0):
+        self.samples = samples
+        self.screen_size_pix = screen_size_pix
+        self.speed = speed
+        self.start = time.perf_counter()
+
+    def startRecording(self, *args):
+        """Restart the replay from the first sample."""
+
+        self.start = time.perf_counter()
+
+    def getNewestSample(self):
+        """Return with the last sample before the current time of the replay, None before the first one."""
+
+        if self.speed > 0:
+            replay_time = (time.perf_counter() - self.start) * self.speed
+            index = np.searchsorted(self.samples['time'], replay_time, side='right') - 1
+        else:
+            index = len(self.samples) - 1
+        if index < 0:
+            return None
+        return ReplayEyeLinkSample(self.samples[index], self.screen_size_pix)
+
+
+class ReplayEyeLinkSample:
+    """A replayed sample with the methods of pylink's Sample used by main.py."""
+
+    def __init__(self, sample, screen_size_pix):
+        self.sample = sample
+        self.screen_size_pix = screen_size_pix
+
+    def getTime(self):
+        return self.sample['time'] * 1000.0
+
+    def isLeftSample(self):
+        return bool(self.sample['left_gaze_validity'])
+
+    def isRightSample(self):
+        return bool(self.sample['right_gaze_validity'])
+
+    def getLeftEye(self):
+        return ReplayEyeLinkEye(self.sample['left_gaze_ADCS'], self.screen_size_pix)
+
+    def getRightEye(self):
+        return ReplayEyeLinkEye(self.sample['right_gaze_ADCS'], self.screen_size_pix)
+
+
+class ReplayEyeLinkEye:
+    def __init__(self, gaze_ADCS, screen_size_pix):
+        self.gaze = (gaze_ADCS[0] * screen_size_pix[0], gaze_ADCS[1] * screen_size_pix[1])
+
+    def getGaze(self):
+        return self.gaze
+
+
+class FixationBenchmark:
+    """The fixation check of asrt.py on replayed samples.
+
+       eye_data_callback() feeds the detector with gaze.gaze_position() and wakes up the checking thread like
+       asrt.Experiment.eye_data_callback() does, and run() decides with gaze.fixated_AOI() like
+       asrt.Experiment.wait_for_eye_response(), but on all the targets at once.
+       After a decision the detector is reset, as at the start of the next trial.
+    """
+
+    def __init__(self, screen, targets_PCMCS, AOI_size=3.0, dispersion_threshold=2.0, window_size=12):
+        # ScreenGeometry of the recording
+        self.screen = screen
+        # stimulus numbers and PCMCS positions of the AOI centers
+        self.target_numbers = sorted(targets_PCMCS.keys())
+        self.AOI_centers = [targets_PCMCS[target] for target in self.target_numbers]
+        # settings of the eye-tracking experiment (see asrt.ExperimentSettings)
+        self.AOI_size = AOI_size
+        self.dispersion_threshold = dispersion_threshold
+        self.window_size = window_size
+
+        self.shared_data_lock = threading.Lock()
+        self.new_gaze_sample = threading.Condition(self.shared_data_lock)
+        self.gaze_detector = FixationDetector(window_size)
+        self.gaze_sample_count = 0
+        # sequence number of the last sample checked by run()
+        self.checked_sample_count = None
+        # replaying as fast as possible, the samples are checked one by one (see run())
+        self.lockstep = False
+        # target of the last sample and perf_counter() time when the callback received it
+        self.last_target = 0
+        self.last_sample_time = None
+        # seconds of thread CPU time spent in the callback
+        self.callback_cpu_time = 0.0
+        # the target of the sample being replayed (set by run())
+        self.targets = None
+
+    def eye_data_callback(self, gazeData):
+        # in lockstep the next sample waits until the previous one is checked
+        if self.lockstep:
+            with self.new_gaze_sample:
+                self.new_gaze_sample.wait_for(lambda: self.checked_sample_count == self.gaze_sample_count)
+
+        received = time.perf_counter()
+        cpu_start = time.thread_time()
+
+        (x_coord, y_coord, valid) = gaze_position(gazeData)
+
+        with self.shared_data_lock:
+            self.gaze_detector.append(x_coord, y_coord, valid)
+
+            self.last_target = self.targets[self.gaze_sample_count]
+            self.last_sample_time = received
+            self.gaze_sample_count += 1
+            self.new_gaze_sample.notify()
+
+        self.callback_cpu_time += time.thread_time() - cpu_start
+
+    def fixated_target(self, fixation):
+        """The target whose AOI contains the fixation (see gaze.fixated_AOI()), None if there is no decision."""
+
+        AOI = fixated_AOI(fixation, self.AOI_centers, self.AOI_size, self.dispersion_threshold,
+                          self.screen.ADCS_to_PCMCS, self.screen.distance_ADCS_to_PCMCS)
+        if AOI is None:
+            return None
+        return self.target_numbers[AOI]
+
+    def run(self, samples, speed=1.0):
+        """Replay the samples through a ReplayEyeTracker and check for fixations until the replay ends.
+
+           With speed 0 the replay goes in lockstep with the check: every sample is checked before the next one
+           is sent, so the decisions do not depend on the thread scheduling (the wakeup latency still includes it).
+           Returns with a dictionary of the measured values (see print_results()).
+        """
+
+        self.targets = samples['target'].tolist()
+        self.gaze_detector.reset(self.window_size)
+        self.gaze_sample_count = 0
+        self.checked_sample_count = None
+        self.lockstep = speed == 0
+        self.callback_cpu_time = 0.0
+        # (sample index, decided target, target of the sample, wakeup latency in seconds)
+        decisions = []
+        # number of checks and the seconds spent in the fixation check (FixationDetector.fixation() and gaze.fixated_AOI())
+        check_count = 0
+        decision_time = 0.0
+
+        eye_tracker = ReplayEyeTracker(samples, speed)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        eye_tracker.subscribe_to(None, self.eye_data_callback, as_dictionary=True)
+
+        while True:
+            with self.new_gaze_sample:
+                self.new_gaze_sample.wait_for(lambda: self.gaze_sample_count != self.checked_sample_count or eye_tracker.finished.is_set(),
+                                              g_benchmark_wait_timeout)
+                if self.gaze_sample_count == self.checked_sample_count:
+                    if eye_tracker.finished.is_set():
+                        break
+                    continue
+                sample_count = self.gaze_sample_count
+                decision_start = time.perf_counter()
+                fixation = self.gaze_detector.fixation()
+                last_target = self.last_target
+                last_sample_time = self.last_sample_time
+
+            target = self.fixated_target(fixation)
+            decision_time += time.perf_counter() - decision_start
+            check_count += 1
+
+            with self.new_gaze_sample:
+                if target is not None:
+                    decisions.append((sample_count - 1, target, last_target, time.perf_counter() - last_sample_time))
+                    self.gaze_detector.reset(self.window_size)
+                self.checked_sample_count = sample_count
+                self.new_gaze_sample.notify_all()
+
+        check_cpu_time = time.thread_time() - cpu_start
+        wall_time = time.perf_counter() - wall_start
+        eye_tracker.unsubscribe_from(None)
+
+        return evaluate(samples, decisions, wall_time, self.callback_cpu_time, check_cpu_time, decision_time / max(check_count, 1))
+
+
+def evaluate(samples, decisions, wall_time, callback_cpu_time, check_cpu_time, decision_time_per_check):
+    """Compare the decisions with the targets of the samples.
+
+       A target segment (consecutive samples with the same, non-zero target) is detected if there is a decision
+       on its target inside it, its detection delay is the time from the segment's first sample to the first such decision.
+    """
+
+    targets = samples['target']
+    times = samples['time']
+    segment_starts = np.flatnonzero(np.diff(targets, prepend=0) != 0)
+    segment_starts = segment_starts[targets[segment_starts] != 0]
+
+    correct_count = 0
+    detection_delays = {}
+    for (index, target, expected_target, latency) in decisions:
+        if target == expected_target:
+            correct_count += 1
+            segment_start = segment_starts[np.searchsorted(segment_starts, index, side='right') - 1]
+            if segment_start not in detection_delays:
+                detection_delays[segment_start] = times[index] - times[segment_start]
+
+    latencies = np.array([decision[3] for decision in decisions])
+    delays = np.array(list(detection_delays.values()))
+    return {'samples': len(samples),
+            'wall_time': wall_time,
+            'decisions': len(decisions),
+            'correct_decisions': correct_count,
+            'segments': len(segment_starts),
+            'detected_segments': len(detection_delays),
+            'wakeup_latency_median': np.median(latencies) if len(latencies) > 0 else float('nan'),
+            'wakeup_latency_p99': np.percentile(latencies, 99) if len(latencies) > 0 else float('nan'),
+            'detection_delay_median': np.median(delays) if len(delays) > 0 else float('nan'),
+            'callback_cpu_per_sample': callback_cpu_time / max(len(samples), 1),
+            'check_cpu_load': check_cpu_time / wall_time,
+            'decision_time_per_check': decision_time_per_check}
+
+
+def print_results(results):
+    print('samples:                %d in %.2f s' % (results['samples'], results['wall_time']))
+    print('decisions:              %d, %d on the target of the sample' % (results['decisions'], results['correct_decisions']))
+    print('detected targets:       %d of %d' % (results['detected_segments'], results['segments']))
+    print('wakeup latency:         %.1f us median, %.1f us 99th percentile' % (results['wakeup_latency_median'] * 1000000,
+                                                                             results['wakeup_latency_p99'] * 1000000))
+    print('detection delay:        %.1f ms median (from the start of the target)' % (results['detection_delay_median'] * 1000))
+    print('callback CPU:           %.1f us per sample' % (results['callback_cpu_per_sample'] * 1000000))
+    print('fixation check CPU:     %.1f %%' % (results['check_cpu_load'] * 100))
+    print('fixation check time:    %.1f us per check' % (results['decision_time_per_check'] * 1000000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay gaze samples through the fixation detection of asrt.py and measure it.')
+    parser.add_argument('file', nargs='?', default=None, help='ET log or gaze store (.h5) file (default: synthetic samples)')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0: as fast as possible (default: 1)')
+    parser.add_argument('--monitor-width', type=float, default=34.5, help='monitor width in cm (default: 34.5)')
+    parser.add_argument('--monitor-size', type=int, nargs=2, default=[1920, 1080], help='monitor size in pixels (default: 1920 1080)')
+    parser.add_argument('--AOI-size', type=float, default=3.0, help='side of the AOI squares in cm (default: 3)')
+    parser.add_argument('--dispersion-threshold', type=float, default=2.0, help='dispersion threshold in cm (default: 2)')
+    parser.add_argument('--window-size', type=int, default=12, help='fixation threshold in samples (default: 12)')
+    parser.add_argument('--sampling-rate', type=float, default=600.0, help='sampling rate of the synthetic samples (default: 600)')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the synthetic samples')
+    args = parser.parse_args()
+
+    screen = ScreenGeometry(args.monitor_width, args.monitor_size)
+    if args.file is None:
+        # stimulus positions of the eye-tracking ASRT with the default distance of 10 cm
+        stimulus_positions = {1: (-5.0, -5.0), 2: (5.0, -5.0), 3: (-5.0, 5.0), 4: (5.0, 5.0)}
+        samples = synthetic_fixations({stim: screen.PCMCS_to_ADCS(pos) for stim, pos in stimulus_positions.items()},
+                                      sampling_rate=args.sampling_rate, seed=args.seed)
+    else:
+        (samples, stimulus_positions) = read_samples(args.file)
+
+    benchmark = FixationBenchmark(screen, stimulus_positions, args.AOI_size, args.dispersion_threshold, args.window_size)
+    print_results(benchmark.run(samples, args.speed))
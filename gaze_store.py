@@ -0,0 +1,81 @@
+"""Columnar store of the eye-tracking samples of the ASRT script.
+
+One HDF5 file is written per session (needs PyTables). Everything which is the same
+for all samples (subject, monitor, frame rate, stimulus positions and the trial table
+of the session) is stored once, as attributes and arrays of the file. The samples are
+kept in a typed table which grows with one append per block:
+
+    /trials     trial table rows of the session (see asrt.g_trial_dtype)
+    /samples    one row per gaze sample (see g_sample_dtype)
+    /blocks     one row per append: block number, first sample and number of samples
+
+The tab-separated log of asrt.py is still written, it can be used as the export format.
+"""
+
+import numpy as np
+
+try:
+    import tables
+    g_tables_available = True
+except:
+    g_tables_available = False
+
+# trial phases stored in the samples table as their index in this tuple
+g_trial_phases = ('before_stimulus', 'stimulus_on_screen', 'after_reaction')
+
+# one row per gaze sample
+#   trial: global trial number the sample belongs to (the trial on screen or the next one)
+#   RSI_time: measured RSI of the trial (-1 before the stimulus), trial_phase: index in g_trial_phases
+#   *_ADCS / *_PCMCS: gaze position in the tobii active display / PsychoPy cm coordinate system
+#   time_stamp: tobii system time stamp of the sample
+g_sample_dtype = np.dtype([('trial', np.int32),
+                           ('RSI_time', np.float64),
+                           ('trial_phase', np.int8),
+                           ('left_gaze_ADCS', np.float64, (2,)),
+                           ('right_gaze_ADCS', np.float64, (2,)),
+                           ('left_gaze_PCMCS', np.float64, (2,)),
+                           ('right_gaze_PCMCS', np.float64, (2,)),
+                           ('left_gaze_validity', np.bool_),
+                           ('right_gaze_validity', np.bool_),
+                           ('left_pupil_diameter', np.float64),
+                           ('right_pupil_diameter', np.float64),
+                           ('left_pupil_validity', np.bool_),
+                           ('right_pupil_validity', np.bool_),
+                           ('time_stamp', np.int64)])
+
+g_block_dtype = np.dtype([('block', np.int16), ('first_sample', np.int64), ('sample_count', np.int64)])
+
+
+class GazeSampleStore:
+    """Appends the samples of the blocks of one session into the session's HDF5 file."""
+
+    def __init__(self, file_path):
+        # path of the HDF5 file of the session
+        self.file_path = file_path
+
+    def append_block(self, block, samples, trials, metadata):
+        """Append the samples (array of g_sample_dtype) of a block.
+
+           The trial table rows of the session and the metadata (a dictionary of constant values)
+           are written only when the file is created.
+        """
+
+        with tables.open_file(self.file_path, 'a') as store:
+            if '/samples' not in store:
+                for name, value in metadata.items():
+                    store.root._v_attrs[name] = value
+                store.create_array(store.root, 'trials', trials)
+                store.create_table(store.root, 'samples', description=g_sample_dtype, expectedrows=max(len(samples), 1) * 100,
+                                   filters=tables.Filters(complevel=5, complib='blosc'))
+                store.create_table(store.root, 'blocks', description=g_block_dtype)
+
+            store.root.blocks.append(np.array([(block, store.root.samples.nrows, len(samples))], dtype=g_block_dtype))
+            store.root.samples.append(samples)
+
+
+def read_gaze_store(file_path):
+    """Read a session file, returns with the metadata dictionary, the trial table rows and the samples."""
+
+    with tables.open_file(file_path, 'r') as store:
+        metadata = {name: store.root._v_attrs[name] for name in store.root._v_attrs._f_list('user')}
+        return (metadata, store.root.trials.read(), store.root.samples.read())
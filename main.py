@@ -3,9 +3,8 @@ import psychtoolbox as ptb
 # import pygame
 # import pygame_menu
 # from pygame_menu import widgets
-from serial import Serial
+from serial import serial_for_url
 import time
-import shelve
 import codecs
 import os
 import pyglet
@@ -14,15 +13,26 @@ from datetime import datetime
 from io import StringIO
 import threading
 import os.path as op
-import pandas as pd
 import numpy as np
 from math import atan2, degrees, fabs
+import sequence_engine
+from background_writer import BackgroundWriter
+import trial_journal
+import storage
+from stim_cache import StimulusCache, update_stim
+from response_input import ResponseKeyboard, SerialResponseBox
+from triggers import TriggerScheduler
 
 debug_mode = False
 meg_session = False
 eyetracking = False
 tutorial = True
 resting_state = False
+# serial port of the MEG response box, 'loop://' runs without the box (see SerialResponseBox.simulate_press())
+response_box_port = 'COM1'
+# storage of the settings and subject states: 'files' (shelve files) or 'sqlite' (one SQLite database in WAL mode,
+# which also stores the output rows, see storage.py), the text logs are written with both
+storage_backend = 'files'
 
 if debug_mode:
     mouse_visible = True
@@ -43,19 +53,41 @@ if eyetracking:
     import sys
     from string import ascii_letters, digits
 
+# names of the output columns stored for every trial
+output_column_names = ['subject_number',
+                       'subject_sex',
+                       'subject_age',
+
+                       'session',
+                       'block',
+                       'trial',
+
+                       'RSI_time',
+                       'frame_rate',
+                       'frame_time',
+                       'frame_sd',
+                       'time',
+                       'date',
+
+                       'trial_type',
+                       'RT',
+                       'error',
+                       'stimulus',
+                       'response']
+
 def serial_port(port='COM1', baudrate=9600, timeout=0):
     """
     Create serial port interface.
 
-    str port: Which port to interface with.
+    str port: Which port to interface with (or a pyserial URL, e.g. 'loop://' for testing without hardware).
     baudrate: Rate at which information is transferred in bits per second.
     int timeout: Waiting time in seconds for the port to respond.
     return: serial port interface
     """
 
-    open_port = Serial(port, baudrate, timeout=timeout)
+    open_port = serial_for_url(port, baudrate, timeout=timeout)
     open_port.close()
-    open_port = Serial(port, baudrate, timeout=timeout)
+    open_port.open()
     open_port.flush()
     return open_port
 
@@ -66,7 +98,7 @@ if meg_session:
         addressPortParallel = '0x3FF8'
     print(addressPortParallel)
     #receive responses
-    port_s = serial_port()
+    port_s = serial_port(response_box_port)
     # send triggers
     port = parallel.ParallelPort(address=addressPortParallel)
 
@@ -80,6 +112,33 @@ def ensure_dir(dirpath):
     if not os.path.exists(dirpath):
         os.makedirs(dirpath)
 
+# one row per trial (index is the global trial number, row 0 is unused)
+#   session, block, trial: position of the trial in the experiment
+#   end_at: first trial of the next session
+#   stim: stimulus number, type: trial type code (see sequence_engine.TRIAL_TYPES)
+trial_dtype = np.dtype([('session', np.int16), ('block', np.int16), ('trial', np.int32),
+                        ('end_at', np.int32), ('stim', np.int8), ('type', np.int8)])
+
+# boundary flags indexed by the trial number (see ExperimentSettings.get_trial_flags())
+#   session_start: first trial of a session
+#   rest: first trial of a block followed by a resting period only
+#   feedback: first trial of a block followed by a resting period and feedback
+trial_flags_dtype = np.dtype([('session_start', np.bool_), ('rest', np.bool_), ('feedback', np.bool_)])
+
+# one journal record per output row (see trial_journal.py)
+journal_dtype = np.dtype([('kind', np.int8), ('N', np.int32), ('RSI_time', np.float64), ('time', 'S15'), ('date', 'S10'),
+                          ('RT', np.float64), ('error', np.int8), ('response', np.int8), ('respRT', np.float64),
+                          ('tresptrig', np.int32)])
+
+def trial_table_from_dicts(stim_sessionN, stimblock, stimtrial, end_at, stimlist, stimpr):
+    """Convert the per-trial dictionaries saved by older versions into a trial table."""
+
+    trials = np.zeros(max(stim_sessionN.keys()) + 1, dtype=trial_dtype)
+    for N in stim_sessionN.keys():
+        trials[N] = (stim_sessionN[N], stimblock[N], stimtrial[N], end_at[N],
+                     stimlist[N], sequence_engine.TYPE_CODES[stimpr[N]])
+    return trials
+
     
 class ExperimentSettings:
     """
@@ -87,7 +146,8 @@ class ExperimentSettings:
         These settings apply to all subjects in the specific experiment.
     """
 
-    def __init__(self, settings_file_path, reminder_file_path, sequence_file_path):
+    def __init__(self, settings_file_path, reminder_file_path, sequence_file_path, transitions_file_path=None,
+                 data_storage=None):
 
         self.numsessions = 2 # number of sessions
         self.current_session = None # current session
@@ -121,6 +181,7 @@ class ExperimentSettings:
         self.sessionstarts = None
         self.blockstarts = None
         self.fb_block = None
+        self.trial_flags = None
         
         self.el_tracker = None
         # AOI (area of interest) is a square with the same origin as the stimuli, this size means the size of this square's side
@@ -133,6 +194,13 @@ class ExperimentSettings:
         self.settings_file_path = settings_file_path
         self.reminder_file_path = reminder_file_path
         self.sequence_file_path = sequence_file_path
+        # storage backend the settings are read from and written into (see storage.py)
+        if data_storage is None:
+            data_storage = storage.FileStorage()
+        self.storage = data_storage
+        # optional json file describing the transition matrix of the task (see sequence_engine.DEFAULT_DESIGN)
+        self.transitions_file_path = transitions_file_path
+        self.transitions = None
 
     def read_from_file(self):
         """Open settings shelve file in read-only mode and read all settings from it.
@@ -143,7 +211,7 @@ class ExperimentSettings:
         """
 
         try:
-            with shelve.open(self.settings_file_path, 'r') as settings_file:
+            with self.storage.open(self.settings_file_path, 'r') as settings_file:
 
                 self.numsessions = settings_file['numsessions']
 
@@ -179,13 +247,14 @@ class ExperimentSettings:
                     self.dispersion_threshold = settings_file['dispersion_threshold']
 
         except Exception as exception:
-            self.__init__(self.settings_file_path, self.reminder_file_path, self.sequence_file_path)
+            self.__init__(self.settings_file_path, self.reminder_file_path, self.sequence_file_path,
+                          self.transitions_file_path, data_storage=self.storage)
             raise exception
 
     def write_to_file(self):
         """Create a new settings file and write all settings into it."""
 
-        with shelve.open(self.settings_file_path, 'n') as settings_file:
+        with self.storage.open(self.settings_file_path, 'n') as settings_file:
             settings_file['numsessions'] = self.numsessions
 
             settings_file['blocks_in_session'] = self.blocks_in_session
@@ -327,6 +396,38 @@ class ExperimentSettings:
 
         return self.sessionstarts
 
+    def get_trial_flags(self):
+        """Returns with an array indexed by the trial number (from 0 to get_maxtrial('trainTest') + 1),
+           flagging session starts and the blocks ending with a resting period or a feedback."""
+
+        if self.trial_flags is None:
+            flags = np.zeros(self.get_maxtrial('trainTest') + 2, dtype=trial_flags_dtype)
+
+            def flagged(trial_numbers):
+                trial_numbers = np.asarray(trial_numbers, dtype=int)
+                is_flagged = np.zeros(len(flags), dtype=bool)
+                is_flagged[trial_numbers[(trial_numbers >= 0) & (trial_numbers < len(flags))]] = True
+                return is_flagged
+
+            fb_block = self.get_fb_block()
+            flags['session_start'] = flagged(self.get_session_starts())
+            flags['rest'] = flagged(self.get_block_starts()) & ~flagged(fb_block)
+            flags['feedback'] = flagged(fb_block[1:])
+            self.trial_flags = flags
+
+        return self.trial_flags
+
+    def get_transitions(self):
+        """Return with the transition matrix of the task, read from the transitions file if there is one."""
+
+        if self.transitions == None:
+            if self.transitions_file_path is not None and os.path.isfile(self.transitions_file_path):
+                self.transitions = sequence_engine.TransitionMatrix.from_file(self.transitions_file_path)
+            else:
+                self.transitions = sequence_engine.DEFAULT_TRANSITIONS
+
+        return self.transitions
+
     def get_key_list(self):
         return (self.key1, self.key2, self.key3, self.key4, self.key5, self.key_quit)
 
@@ -435,6 +536,8 @@ class InstructionHelper:
         self.train_end = []
 
         self.instructions_file_path = instructions_file_path
+        # text stimulus of the messages, reused by every message (created with the first one)
+        self.stim_cache = None
 
     def read_insts_from_file(self):
         """Read instruction strings from the instruction file using the special structure of this file.
@@ -481,8 +584,10 @@ class InstructionHelper:
             print("Feedback message was not specified!")
 
     def __print_to_screen(self, mytext, mywindow):
-        text_stim = visual.TextStim(mywindow, text=mytext,
-                                    units='cm', height=0.7, wrapWidth=20, color='black')
+        if self.stim_cache is None or self.stim_cache.window is not mywindow:
+            self.stim_cache = StimulusCache(mywindow)
+        text_stim = self.stim_cache.text('message', mytext,
+                                         units='cm', height=0.7, wrapWidth=20, color='black')
         text_stim.draw()
         mywindow.flip()
 
@@ -536,7 +641,8 @@ class InstructionHelper:
 class PersonDataHandler:
     """Class for handle subject related settings and data."""
 
-    def __init__(self, subject_id, all_settings_file_path, all_IDs_file_path, sequence_file_path, subject_list_file_path, output_file_path):
+    def __init__(self, subject_id, all_settings_file_path, all_IDs_file_path, sequence_file_path, subject_list_file_path, output_file_path,
+                 data_storage=None):
         # generated, unique ID of the subject (consist of a name, a number and an optional group name
         self.subject_id = subject_id
         # path to the settings file of the current subject storing the state of the experiment
@@ -551,121 +657,165 @@ class PersonDataHandler:
         self.output_file_path = output_file_path
         # we store all neccessary data in this list of lists to be able to generate the output at the end of all blocks
         self.output_data_buffer = []
+        # I/O thread writing the output and settings files, so the presentation does not wait for the disk
+        self.writer = BackgroundWriter()
+        # storage backend of the subject's state and output rows (see storage.py)
+        if data_storage is None:
+            data_storage = storage.FileStorage()
+        self.storage = data_storage
+        # journal of the trials since the last settings save (used only on the I/O thread)
+        self.journal = trial_journal.TrialJournal(all_settings_file_path + '_journal', journal_dtype)
+        # journaled records of the completed trials read on startup (the presentation continues its block's feedback with them)
+        self.journaled_records = np.zeros(0, dtype=journal_dtype)
 
     def load_person_settings(self, experiment):
         """Open settings file of the current subject and read the current state."""
 
         try:
-            with shelve.open(self.all_settings_file_path, 'r') as this_person_settings:
+            with self.storage.open(self.all_settings_file_path, 'r') as this_person_settings:
 
                 experiment.subject_age = this_person_settings['subject_age']
                 experiment.subject_sex = this_person_settings['subject_sex']
 
-                experiment.stim_sessionN = this_person_settings['stim_sessionN']
-                experiment.stimblock = this_person_settings['stimblock']
-                experiment.stimtrial = this_person_settings['stimtrial']
+                if 'trials' in this_person_settings:
+                    experiment.trials = this_person_settings['trials']
+                else:
+                    experiment.trials = trial_table_from_dicts(this_person_settings['stim_sessionN'],
+                                                               this_person_settings['stimblock'],
+                                                               this_person_settings['stimtrial'],
+                                                               this_person_settings['end_at'],
+                                                               this_person_settings['stimlist'],
+                                                               this_person_settings['stimpr'])
                 
                 experiment.unique_seq = this_person_settings['unique_seq']
-                experiment.stimlist = this_person_settings['stimlist']
-                experiment.stimpr = this_person_settings['stimpr']
                 experiment.last_N = this_person_settings['last_N']
                 experiment.last_session = this_person_settings['last_session']
-                experiment.end_at = this_person_settings['end_at']
         except:
             experiment.subject_age = None
             experiment.subject_sex = None
-            experiment.stim_sessionN = {}
-            experiment.stimblock = {}
-            experiment.stimtrial = {}
+            experiment.trials = None
             experiment.unique_seq = None
-            experiment.stimlist = []
-            experiment.stimpr = []
             experiment.last_N = 0
             experiment.last_session = 0
-            experiment.end_at = {}
+            return
+
+        self.replay_journal(experiment)
+
+    def replay_journal(self, experiment):
+        """Continue from the last journaled trial, the rows which did not reach the output file are buffered again."""
+
+        (trial_records, unwritten_records) = trial_journal.read_journal(self.journal.file_path, journal_dtype)
+
+        completed_N = trial_records['N'][trial_records['error'] == 0]
+        if len(completed_N) > 0:
+            experiment.last_N = max(experiment.last_N, int(completed_N[-1]))
+
+        # the wrong responses of an unfinished trial are dropped, the trial is repeated
+        if np.any(trial_records['N'] > experiment.last_N):
+            trial_journal.drop_trials_after(self.journal.file_path, journal_dtype, experiment.last_N)
+            (trial_records, unwritten_records) = trial_journal.read_journal(self.journal.file_path, journal_dtype)
+        self.journaled_records = trial_records
+
+        self.output_data_buffer = [[int(record['N']), float(record['RSI_time']), record['time'].decode(), record['date'].decode(),
+                                    float(record['RT']), int(record['error']), int(record['response']),
+                                    None, float(record['respRT']), int(record['tresptrig'])] for record in unwritten_records]
+
+    def add_trial_output(self, output_data):
+        """Buffer the output data of a trial, and append it to the journal on the I/O thread."""
+
+        self.output_data_buffer.append(output_data)
+        (N, stim_RSI, stim_RT_time, stim_RT_date, stimRT, stimACC, response, respKeys, respRT, tresptrig) = output_data
+        self.writer.submit(self.journal.append, (N, stim_RSI, stim_RT_time.encode(), stim_RT_date.encode(), stimRT,
+                                                 stimACC, response, respRT, tresptrig))
+
+    def checkpoint(self, experiment):
+        """Write out the buffered output data at the end of a block (the progress is journaled trial by trial)."""
+
+        self.flush_data_to_output(experiment)
 
     def save_person_settings(self, experiment):
         """Write out the current state of the experiment run with current subject,
-           so we can continue the experiment from that point where the subject finished it."""
+           so we can continue the experiment from that point where the subject finished it.
+
+           The state is taken now and written on the I/O thread, returns with the write's Future.
+        """
 
-        with shelve.open(self.all_settings_file_path, 'n') as this_person_settings:
+        person_settings = {'subject_age': experiment.subject_age,
+                           'subject_sex': experiment.subject_sex,
+                           'trials': experiment.trials,
+                           'unique_seq': experiment.unique_seq,
+                           'last_N': experiment.last_N,
+                           'last_session': experiment.last_session}
+        return self.writer.submit(self.write_person_settings, person_settings)
 
-            this_person_settings['subject_age'] = experiment.subject_age
-            this_person_settings['subject_sex'] = experiment.subject_sex
+    def write_person_settings(self, person_settings):
+        with self.storage.open(self.all_settings_file_path, 'n') as this_person_settings:
+            for key, value in person_settings.items():
+                this_person_settings[key] = value
 
-            this_person_settings['stim_sessionN'] = experiment.stim_sessionN
-            this_person_settings['stimblock'] = experiment.stimblock
-            this_person_settings['stimtrial'] = experiment.stimtrial
+        # the saved settings contain the journaled progress
+        self.journal.reset()
 
-            this_person_settings['unique_seq'] = experiment.unique_seq
-            this_person_settings['stimlist'] = experiment.stimlist
-            this_person_settings['stimpr'] = experiment.stimpr
-            this_person_settings['last_N'] = experiment.last_N
-            this_person_settings['last_session'] = experiment.last_session
-            this_person_settings['end_at'] = experiment.end_at
+    def wait_for_writes(self):
+        """Wait until everything submitted to the I/O thread is written out."""
+
+        self.writer.submit(self.journal.sync)
+        self.writer.drain()
 
     def update_all_subject_attributes_files(self, subject_sex, subject_age):
-        """Add the new subject's attributes into the list of all subject data and save it into file.
-           Also generate a text file with the list of all subjects participating in the experiment.
+        """Add the new subject's attributes into the registry of all subjects (see storage.SubjectRegistry).
+           Also append the subject to the text file with the list of all subjects participating in the experiment.
         """
 
-        all_IDs = []
-        with shelve.open(self.all_IDs_file_path) as all_subject_file:
-            try:
-                all_IDs = all_subject_file['ids']
-            except:
-                all_IDs = []
-
-            if self.subject_id not in all_IDs:
-                all_IDs.append(self.subject_id)
-                all_subject_file['ids'] = all_IDs
-                all_subject_file[self.subject_id] = [subject_sex, subject_age]
-
-        with shelve.open(self.all_IDs_file_path, 'r') as all_subject_file:
-            with codecs.open(self.subject_list_file_path, 'w', encoding='utf-8') as subject_list_file:
-                subject_list_IO = StringIO()
-                # write header
-                subject_list_IO.write('subject_id\tsubject_sex\tsubject_age\n')
-
-                # write subject data
-                for id in all_IDs:
-                    id_segmented = id.replace('_', '\t', 2)
-                    subject_list_IO.write(id_segmented)
-                    subject_list_IO.write('\t')
-                    subject_list_IO.write(all_subject_file[id][0])
-                    subject_list_IO.write('\t')
-                    subject_list_IO.write(all_subject_file[id][1])
-                    subject_list_IO.write('\n')
-
-                subject_list_file.write(subject_list_IO.getvalue())
-                subject_list_IO.close()
+        registry = storage.SubjectRegistry(self.all_IDs_file_path + '.sqlite3', self.subject_list_file_path,
+                                           'subject_id\tsubject_sex\tsubject_age', self.all_IDs_file_path)
+        registry.register(self.subject_id, [str(subject_sex), str(subject_age)])
 
     def append_to_output_file(self, string_to_append):
-        """ Append a string to the end on the output text file."""
+        """ Append a string to the end on the output text file (on the I/O thread), returns with the write's Future."""
 
+        return self.writer.submit(self.write_to_output_file, string_to_append)
+
+    def write_to_output_file(self, string_to_append):
         if not os.path.isfile(self.output_file_path):
             with codecs.open(self.output_file_path, 'w', encoding='utf-8') as output_file:
                 self.add_heading_to_output(output_file)
                 output_file.write(string_to_append)
+                output_file.flush()
+                os.fsync(output_file.fileno())
         else:
             with codecs.open(self.output_file_path, 'a+', encoding='utf-8') as output_file:
                 output_file.write(string_to_append)
+                output_file.flush()
+                os.fsync(output_file.fileno())
 
     def flush_data_to_output(self, experiment):
+        """Hand the buffered output data over to the I/O thread, returns with the write's Future."""
+
+        with experiment.shared_data_lock:
+            output_data_buffer = self.output_data_buffer
+            self.output_data_buffer = []
+
+        flushed = self.writer.submit(self.write_data_to_output, experiment, output_data_buffer)
+        self.writer.submit(self.journal.checkpoint)
+        return flushed
+
+    def write_data_to_output(self, experiment, output_data_buffer):
         """ Write out the ouptut date of the current trial into the output text file (reaction-time exp. type)."""
 
         output_buffer = StringIO()
-        for data in self.output_data_buffer:
+        rows = []
+        for data in output_data_buffer:
             N = data[0]
-            session = experiment.stim_sessionN[N]
+            trial = experiment.trials[N]
 
             output_data = [str(experiment.subject_number).zfill(2),
                            experiment.subject_sex,
                            experiment.subject_age,
 
-                           experiment.stim_sessionN[N],
-                           experiment.stimblock[N],
-                           experiment.stimtrial[N],
+                           trial['session'],
+                           trial['block'],
+                           trial['trial'],
 
                            data[1],
                            experiment.frame_rate,
@@ -674,11 +824,12 @@ class PersonDataHandler:
                            data[2],
                            data[3],
 
-                           experiment.stimpr[N],
+                           sequence_engine.TRIAL_TYPES[trial['type']],
                            data[4],
                            data[5],
-                           experiment.stimlist[N],
+                           trial['stim'],
                            data[6]]
+            rows.append(output_data)
             output_buffer.write("\n")
             for data in output_data:
                 if isinstance(data, numbers.Number):
@@ -688,37 +839,14 @@ class PersonDataHandler:
                     data = str(data)
                 output_buffer.write(data + '\t')
 
-        self.append_to_output_file(output_buffer.getvalue())
+        self.write_to_output_file(output_buffer.getvalue())
         output_buffer.close()
-        self.output_data_buffer.clear()
+        self.storage.append_rows('output', self.subject_id, output_column_names, rows)
 
     def add_heading_to_output(self, output_file):
         """Add the first line to the ouput with the names of the different variables (reaction-time exp. type)."""
 
-        heading_list = ['subject_number',
-                        'subject_sex',
-                        'subject_age',
-
-                        'session',
-                        'block',
-                        'trial',
-
-                        'RSI_time',
-                        'frame_rate',
-                        'frame_time',
-                        'frame_sd',
-                        'time',
-                        'date',
-
-                        'trial_type',
-                        'RT',
-                        'error',
-                        'stimulus',
-                        'response',
-                        'respKeys',
-                        'respRT',
-                        'tresptrig',
-                        'quit_log']
+        heading_list = output_column_names + ['respKeys', 'respRT', 'tresptrig', 'quit_log']
 
         for h in heading_list:
             output_file.write(h + '\t')
@@ -742,6 +870,14 @@ class Experiment:
         self.pressed_dict = None
         # image to display
         self.image_dict = None
+        # stimuli built once for the window: stimulus images, pre-rendered layers, texts and shapes (see stim_cache.py)
+        self.stim_cache = None
+        # key presses with hardware timestamps, RTs are measured from the stimulus onset flip (see response_input.py)
+        self.response_keyboard = None
+        # MEG trigger pulses written to the parallel port by a scheduler thread (see triggers.py)
+        self.triggers = None
+        # button presses of the MEG response box, timestamped by a reader thread (see response_input.py)
+        self.response_box = None
 
         self.fixation_cross = None
 
@@ -767,20 +903,11 @@ class Experiment:
 
         # serial number of the next line in the output file (e.g. 10)
         # self.stim_output_line = None
-        # global trial number -> session number mapping (e.g. {1 : 1, 2 : 1, 3 : 2, 4 : 2} - two sessions with two trials in each)
-        self.stim_sessionN = None
-        # global trial number -> block number mapping (e.g. {1 : 1, 2 : 2, 3 : 2, 4 : 2} - two blocks with two trials in each)
-        self.stimblock = None
-        # global trial number -> trial number inside the block mapping (e.g. {1 : 1, 2 : 2, 3 : 1, 4 : 2} - two blocks with two trials in each)
-        self.stimtrial = None
-        # global trial number -> stimulus number mapping (e.g. {1 : 1, 2 : 2, 3 : 2, 4 : 4})
-        self.stimlist = None
+        # trial table (numpy structured array of trial_dtype), global trial number -> session, block, trial number,
+        # first trial of the next session, stimulus number and trial type code (e.g. self.trials['stim'][N])
+        self.trials = None
         # participant's unique sequence base on his number
         self.unique_seq = None
-        # global trial number -> first trial of the next session mapping (e. g.{1 : 3, 2 : 3, 3 : 5, 4 : 5} - two sessions with two trials in each)
-        self.end_at = None
-        # global trial number -> pattern or random stimulus mapping (e. g.{1 : 'pattern', 2 : 'random', 3 : 'pattern', 4 : 'random'} - two sessions with two trials in each)
-        self.stimpr = None
         # number of the last trial (it is 0 in the beggining and it is always equal with the last displayed stimulus's serial number
         self.last_N = None
         # number of the last session
@@ -837,9 +964,9 @@ class Experiment:
             expstart11 = gui.Dlg(title='Starting task...')
             expstart11.addText("Already have participant's data")
             expstart11.addText('Continue from here...')
-            expstart11.addText('Session: ' + str(self.stim_sessionN[self.last_N + 1]))
+            expstart11.addText('Session: ' + str(self.trials['session'][self.last_N + 1]))
             # expstart11.addText('Session: ' + str(self.last_session))
-            expstart11.addText('Block: ' + str(self.stimblock[self.last_N + 1]))
+            expstart11.addText('Block: ' + str(self.trials['block'][self.last_N + 1]))
             expstart11.show()
             if not expstart11.OK:
                 core.quit()
@@ -879,159 +1006,43 @@ class Experiment:
             core.quit()
 
     def create_sequence(self):
-        """Generates csv file with list of stimuli for current session."""
+        """Generates the sequence files (binary and csv) with list of stimuli for current session."""
 
         keys = [1, 2, 3, 4, 5]
+        if self.unique_seq is None:
+            # the key order might have been drawn already by the batch generator (python sequence_engine.py)
+            self.unique_seq = sequence_engine.read_keys(self.settings.sequence_file_path, self.subject_number)
         # maybe need to create a loop to iter until finds a seq that was not used yet
         if self.unique_seq is None: 
             np.random.shuffle(keys)
             self.unique_seq = keys
+            sequence_engine.write_keys(self.settings.sequence_file_path, self.subject_number, keys)
         else:
             keys = self.unique_seq
         
-        trials = np.arange(1, self.settings.get_maxtrial('trainTest') + 2)
-        half = self.settings.get_maxtrial('test')/2
-        data = pd.DataFrame({'trials': trials,
-                             'trial_keys': np.zeros(len(trials), dtype=int),
-                             'trial_type': ['to_define']*len(trials)})
-
-
-        if self.settings.current_session == 1:
-            for trial in trials:
-                if trial in np.arange((self.settings.trials_in_tBlock + half + 1), (len(trials) + 1), self.settings.trials_in_block):
-                    data.trial_keys.at[trial] = np.random.choice(keys)
-                    data.trial_type.at[trial] = 'no transition'
-                elif trial in np.arange(1, (self.settings.trials_in_tBlock + 1)):
-                    data.trial_type.at[trial] = 'training'
-                    if data.trial_keys.at[trial-1] == keys[0]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([1, 2, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[1]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 2, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[2]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[3]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 2, 4])]
-                    else:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 2, 3])]
-                elif trial in np.arange((self.settings.trials_in_tBlock + 1), (self.settings.trials_in_tBlock + half + 1)):
-                    data.trial_type.at[trial] = 'random'
-                    if data.trial_keys.at[trial-1] == keys[0]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([1, 2, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[1]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 2, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[2]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[3]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 2, 4])]
-                    else:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 2, 3])]
-                else:
-                    if data.trial_keys[trial-1] == keys[0]:
-                        data.trial_keys.at[trial] = keys[1]
-                        data.trial_type.at[trial] = 'deterministic'
-                    elif data.trial_keys[trial-1] == keys[0]:
-                        data.trial_keys.at[trial] = keys[1]
-                        data.trial_type.at[trial] = 'deterministic'
-                    elif data.trial_keys[trial-1] == keys[1]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 2, 3, 4])]
-                        data.trial_type.at[trial] = 'pseudo-random'
-                    elif data.trial_keys[trial-1] == keys[2]:
-                        if np.random.random() < 3/4:
-                            data.trial_keys.at[trial] = keys[4]
-                            data.trial_type.at[trial] = 'high_prob'
-                        else:
-                            data.trial_keys.at[trial] = keys[0]
-                            data.trial_type.at[trial] = 'low_prob'
-                    elif data.trial_keys[trial-1] == keys[3]:
-                        if np.random.random() < 1/2:
-                            data.trial_keys.at[trial] = keys[0]
-                            data.trial_type.at[trial] = 'medium_prob'
-                        else:
-                            data.trial_keys.at[trial] = keys[2]
-                            data.trial_type.at[trial] = 'medium_prob'
-                    elif data.trial_keys.at[trial-1] == keys[4]:
-                        if np.random.random() < 3/4:
-                            data.trial_keys.at[trial] = keys[3]
-                            data.trial_type.at[trial] = 'high_prob'
-                        else:
-                            data.trial_keys.at[trial] = keys[2]
-                            data.trial_type.at[trial] = 'low_prob'
-        else:
-            for trial in trials:
-                if trial in np.arange((self.settings.trials_in_tBlock + 1), (self.settings.trials_in_tBlock + half + 1), self.settings.trials_in_block):
-                    data.trial_keys.at[trial] = np.random.choice(keys)
-                    data.trial_type.at[trial] = 'no transition'
-                elif trial in np.arange(1, (self.settings.trials_in_tBlock + 1)):
-                    data.trial_type.at[trial] = 'training'
-                    if data.trial_keys.at[trial-1] == keys[0]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([1, 2, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[1]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 2, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[2]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[3]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 2, 4])]
-                    else:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 2, 3])]
-                elif trial in np.arange((self.settings.trials_in_tBlock + half + 1), (len(trials) + 1)):
-                    data.trial_type.at[trial] = 'random'
-                    if data.trial_keys.at[trial-1] == keys[0]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([1, 2, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[1]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 2, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[2]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 3, 4])]
-                    elif data.trial_keys.at[trial-1] == keys[3]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 2, 4])]
-                    else:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 1, 2, 3])]
-                else:
-                    if data.trial_keys[trial-1] == keys[0]:
-                        data.trial_keys.at[trial] = keys[1]
-                        data.trial_type.at[trial] = 'deterministic'
-                    elif data.trial_keys[trial-1] == keys[0]:
-                        data.trial_keys.at[trial] = keys[1]
-                        data.trial_type.at[trial] = 'deterministic'
-                    elif data.trial_keys[trial-1] == keys[1]:
-                        data.trial_keys.at[trial] = keys[np.random.choice([0, 2, 3, 4])]
-                        data.trial_type.at[trial] = 'pseudo-random'
-                    elif data.trial_keys[trial-1] == keys[2]:
-                        if np.random.random() < 3/4:
-                            data.trial_keys.at[trial] = keys[4]
-                            data.trial_type.at[trial] = 'high_prob'
-                        else:
-                            data.trial_keys.at[trial] = keys[0]
-                            data.trial_type.at[trial] = 'low_prob'
-                    elif data.trial_keys[trial-1] == keys[3]:
-                        if np.random.random() < 1/2:
-                            data.trial_keys.at[trial] = keys[0]
-                            data.trial_type.at[trial] = 'medium_prob'
-                        else:
-                            data.trial_keys.at[trial] = keys[2]
-                            data.trial_type.at[trial] = 'medium_prob'
-                    elif data.trial_keys.at[trial-1] == keys[4]:
-                        if np.random.random() < 3/4:
-                            data.trial_keys.at[trial] = keys[3]
-                            data.trial_type.at[trial] = 'high_prob'
-                        else:
-                            data.trial_keys.at[trial] = keys[2]
-                            data.trial_type.at[trial] = 'low_prob'
-
-        data.to_csv(f'{self.settings.sequence_file_path}/{str(self.subject_number).zfill(2)}_seq_{self.settings.current_session}.csv')
+        # the former trial-by-trial generator also drew one trial after the end of the session (and dropped it),
+        # we keep drawing it so that a seeded run still reproduces the same sequence files
+        n_trials = self.settings.get_maxtrial('trainTest') + 1
+        (trial_keys, trial_types) = sequence_engine.generate_session(keys, self.settings.current_session, n_trials,
+                                                                     self.settings.trials_in_tBlock,
+                                                                     self.settings.trials_in_block,
+                                                                     self.settings.get_maxtrial('test'),
+                                                                     transitions=self.settings.get_transitions())
+        sequence_engine.save_sequence(self.settings.sequence_file_path, self.subject_number,
+                                      self.settings.current_session, trial_keys, trial_types, n_trials)
 
     def open_sequence(self):
-        """Returns lists of stimuli sequence and type for current session."""
+        """Returns stimuli sequence and type codes for current session (memory-mapped from the sequence file)."""
 
-        try:
-            data = pd.read_csv(f'{self.settings.sequence_file_path}/{str(self.subject_number).zfill(2)}_seq_{self.settings.current_session}.csv',
-                           sep=',', header=0, encoding='utf8')
-        except:
+        data = sequence_engine.load_sequence(self.settings.sequence_file_path, self.subject_number,
+                                             self.settings.current_session)
+        if data is None:
             self.create_sequence()
-            data = pd.read_csv(f'{self.settings.sequence_file_path}/{str(self.subject_number).zfill(2)}_seq_{self.settings.current_session}.csv',
-                sep=',', header=0, encoding='utf8')
+            data = sequence_engine.load_sequence(self.settings.sequence_file_path, self.subject_number,
+                                                 self.settings.current_session)
 
-        seq = list(data['trial_keys'])
-        stim_type = list(data['trial_type'])
+        seq = data['key']
+        stim_type = data['type']
 
         return seq, stim_type
 
@@ -1039,41 +1050,22 @@ class Experiment:
     def calculate_stim_properties(self, session_num):
         """Calculate all variables used during the trials before the presentation starts."""
 
-        (self.stimlist, self.stimpr) = self.open_sequence()
-
-        all_trial_Nr = 0
-        block_num = 0
+        (stimlist, stimpr) = self.open_sequence()
 
+        maxtrial = self.settings.get_maxtrial('trainTest')
         sessionsstarts = self.settings.get_session_starts()
-        # for trial_num in range(1, self.settings.get_maxtrial('trainTest') + 1):
-        #     for session_num in range(1, len(sessionsstarts)+1):
-        #         if trial_num >= sessionsstarts[session_num - 1] and trial_num < sessionsstarts[session_num]:
-        #             self.stim_sessionN[trial_num] = session_num
-        #             self.end_at[trial_num] = sessionsstarts[session_num]
-        
-        for trial_num in range(1, self.settings.get_maxtrial('trainTest') + 1):
-            self.stim_sessionN[trial_num] = session_num
-            self.end_at[trial_num] = sessionsstarts[1]
-        
-        current_trial_num = 0
-        
-        # training
-        for train in range(1, self.settings.trials_in_tBlock + 1):
-            current_trial_num += 1
-            all_trial_Nr += 1
 
-            self.stimtrial[all_trial_Nr] = current_trial_num
-            self.stimblock[all_trial_Nr] = 0
-        
-        # test
-        for block in range(1, self.settings.blocks_in_session + 1):
-            block_num += 1
-
-            for test in range(1, self.settings.trials_in_block + 1):
-                current_trial_num += 1
-                all_trial_Nr += 1
-                self.stimtrial[all_trial_Nr] = current_trial_num
-                self.stimblock[all_trial_Nr] = block_num
+        trials = np.zeros(maxtrial + 1, dtype=trial_dtype)
+        trials['session'][1:] = session_num
+        trials['end_at'][1:] = sessionsstarts[1]
+        # trial numbers are counted on from the training to the end of the test blocks
+        trials['trial'][1:] = np.arange(1, maxtrial + 1)
+        # training trials are in block 0
+        trials['block'][self.settings.trials_in_tBlock + 1:] = np.repeat(np.arange(1, self.settings.blocks_in_session + 1),
+                                                                         self.settings.trials_in_block)
+        trials['stim'] = stimlist[:maxtrial + 1]
+        trials['type'] = stimpr[:maxtrial + 1]
+        self.trials = trials
 
     def pixel_to_degrees(self, size_px):
         """
@@ -1113,7 +1105,7 @@ class Experiment:
         output_file_path = os.path.join(self.workdir_path, "logs", subject_id + '_log.csv')
         self.person_data = PersonDataHandler(subject_id, all_settings_file_path,
                                             all_IDs_file_path, sequence_file_path, subject_list_file_path,
-                                            output_file_path)
+                                            output_file_path, self.storage)
 
         # try to load settings and progress for the given subject ID
         self.person_data.load_person_settings(self)
@@ -1356,9 +1348,9 @@ class Experiment:
     def print_to_screen(self, mytext):
         """Display any string on the screen."""
 
-        xtext = visual.TextStim(self.mywindow, text=mytext,
-                                units="cm", height=0.7, wrapWidth=20,
-                                color="black")
+        xtext = self.stim_cache.text('message', mytext,
+                                     units="cm", height=0.7, wrapWidth=20,
+                                     color="black")
         xtext.draw()
         self.mywindow.flip()
 
@@ -1418,21 +1410,21 @@ class Experiment:
         percent = round((progress/10))
         text = f"{percent}%"
         
-        bar_outline = visual.Rect(win=self.mywindow, units='pix',
-                            pos=(0, -300),
-                            size=(1004, 65),
-                            fillColor=None,
-                            lineColor='black', lineWidth=3)
-        bar = visual.Rect(win=self.mywindow, units='pix',
-                    pos=((-500+progress/2), -300),
-                    size=(progress, 60),
-                    fillColor='green',
-                    lineWidth=0)
-        completed = visual.TextStim(self.mywindow, text=text,
-                                units="pix", height=50, wrapWidth=20,
-                                anchorHoriz='center',
-                                pos=(0, -300),
-                                color="black")
+        # the progress bar is built once and updated in place (this is called in a loop until the rest ends)
+        bar_outline = self.stim_cache.stim('feedback_bar_outline', visual.Rect, units='pix',
+                                           pos=(0, -300),
+                                           size=(1004, 65),
+                                           fillColor=None,
+                                           lineColor='black', lineWidth=3)
+        bar = self.stim_cache.stim('feedback_bar', visual.Rect, units='pix',
+                                   fillColor='green',
+                                   lineWidth=0)
+        update_stim(bar, pos=((-500+progress/2), -300), size=(progress, 60))
+        completed = self.stim_cache.text('feedback_percent', text,
+                                         units="pix", height=50, wrapWidth=20,
+                                         anchorHoriz='center',
+                                         pos=(0, -300),
+                                         color="black")
     
         bar.draw()
         bar_outline.draw()
@@ -1441,12 +1433,12 @@ class Experiment:
         whatnow = self.instructions.feedback_RT_acc(
             rt_mean, rt_mean_str, acc_for_the_whole, acc_for_the_whole_str, self.mywindow, self.settings)
 
-    def wait_for_response_1(self, expected_response, response_clock, eye_used, old_sample, new_sample, in_hit_region, minimum_duration, gaze_start):
+    def wait_for_response_1(self, expected_response, eye_used, old_sample, new_sample, in_hit_region, minimum_duration, gaze_start):
         """ for eyetracker """
-        press = []
+        press = None
         in_hit_region = None
         s = sound.Sound('A', secs=.5, stereo=True, hamming=True, volume=1.0)
-        while len(press) == 0:
+        while press is None:
             new_sample = self.el_tracker.getNewestSample()
             if new_sample is not None:
                 if old_sample is not None:
@@ -1480,44 +1472,45 @@ class Experiment:
                             gaze_start = -1
                 # update the "old_sample"
                 old_sample = new_sample
-            press = event.getKeys(keyList=self.settings.get_key_list(), timeStamped=response_clock)
+            press = self.response_keyboard.get_press()
+            if press is None:
+                # yield the CPU until the next sample / key press, both are timestamped without polling
+                time.sleep(self.response_keyboard.poll_interval)
             # self.in_or_out(eye_used, old_sample, new_sample, in_hit_region, minimum_duration, gaze_start)
-        if press[0][0] == 'q':
-            return (-1, press[0][1])
-        return (self.pressed_dict[press[0][0]], press[0][1])
+        if press[0] == 'q':
+            return (-1, press[1])
+        return (self.pressed_dict[press[0]], press[1])
 
-    def wait_for_response_3(self, expected_response,  response_clock):
+    def wait_for_response_3(self, expected_response):
         """ without eyetracking """
         
-        press = []
-        while len(press) == 0:
-            press = event.getKeys(keyList=self.settings.get_key_list(), timeStamped=response_clock)
-        print(press)
-        if press[0][0] == 'q':
-            return (-1, press[0][1])
-        return (self.pressed_dict[press[0][0]], press[0][1])
+        press = self.response_keyboard.wait_for_press()
+        if debug_mode:
+            print(press)
+        if press[0] == 'q':
+            return (-1, press[1])
+        return (self.pressed_dict[press[0]], press[1])
 
     def wait_for_response_2(self, tStart, k=0, r=0, t=0): # create a while loop and insert eyetracking function
         """ with response box, to merge with wait_for_response_1 """
         
-        key_from_serial2 = str(port_s.readline())[2:-1]
-        if len(key_from_serial2) > 0:
-            key_from_serial2 = key_from_serial2[3]
-            if ((key_from_serial2 == '1') or (key_from_serial2 == '2')):
-                k = key_from_serial2 # just the last key pressed
-                r = ptb.GetSecs() - tStart
-                t = ptb.GetSecs()
-                port.setData(50) # response ppt
+        press = self.response_box.get_press()
+        while press is not None:
+            (k, t) = press # just the last key pressed
+            r = t - tStart
+            self.triggers.send(50) # response ppt
+            press = self.response_box.get_press()
         return k, r, t
 
-    def send_trigger(self, N, trigg_value):    
-        port.setData(trigg_value)
-        time.sleep(.005)
-        port.setData(0)
+    def send_trigger(self, N, trigg_value):
+        """Send the trigger of a stimulus at the next flip (it does not wait for the pulse)."""
+
+        self.triggers.send_on_flip(self.mywindow, trigg_value)
                 
     def quit_presentation(self):
         self.print_to_screen("Exiting...\nSaving data...")
         self.person_data.append_to_output_file('userquit')
+        self.person_data.wait_for_writes()
         core.wait(3)
         if eyetracking:
             self.EL_disconnect()
@@ -1542,7 +1535,7 @@ class Experiment:
         cross.draw()
         inner.draw()
     
-    def resting_period(self, outer, cross, inner, experiment):
+    def resting_period(self, fixation, experiment):
         """Resting time with eyes closed."""
 
         self.print_to_screen("Fermez vos yeux")
@@ -1559,27 +1552,23 @@ class Experiment:
             # self.mywindow.flip()
         rest_time = core.CountdownTimer(self.settings.rest_time)
         while rest_time.getTime() > 1:
-            outer.draw()
-            cross.draw()
-            inner.draw()
+            fixation.draw()
             self.mywindow.flip()
         if not debug_mode:
             s.play()
         while rest_time.getTime() > 0:
-            outer.draw()
-            cross.draw()
-            inner.draw()
+            fixation.draw()
             self.mywindow.flip()
         
-    def close_to_break(self, outer, cross, inner, experiment, 
+    def close_to_break(self, fixation, experiment, 
                        eye_used, old_sample, new_sample, minimum_duration, gaze_start):
         closed = False
         s = sound.Sound('A', secs=.5, stereo=True, hamming=True, volume=1.0)
         in_hit_region = None
         
+        # the message stays on the screen, the loop below only polls the eye-tracker
+        self.print_to_screen("Fermez vos yeux pour lancer la pause")
         while not closed:
-            self.print_to_screen("Fermez vos yeux pour lancer la pause")
-            
             # timer = core.CountdownTimer(10)
             # while timer.getTime() > 0:
     
@@ -1591,7 +1580,8 @@ class Experiment:
                             g_x, g_y = new_sample.getRightEye().getGaze()
                         if eye_used == 0 and new_sample.isLeftSample():
                             g_x, g_y = new_sample.getLeftEye().getGaze()
-                        print('x:', g_x, 'y:', g_y)
+                        if debug_mode:
+                            print('x:', g_x, 'y:', g_y)
                         # fix_x, fix_y = (screen_width/2.0, screen_height/2.0)
                         # if (fabs(g_x - fix_x) < 64 and fabs(g_y - fix_y) < 64):
                         if (g_x == -32768.0 or g_y == -32768.0):
@@ -1609,19 +1599,17 @@ class Experiment:
                                 in_hit_region = False
                                 gaze_start = -1
                 old_sample = new_sample
+            if not closed:
+                time.sleep(self.response_keyboard.poll_interval)
         
         rest_time = core.CountdownTimer(self.settings.rest_time)
         while rest_time.getTime() > 1:
-            outer.draw()
-            cross.draw()
-            inner.draw()
+            fixation.draw()
             self.mywindow.flip()
         if not debug_mode:
             s.play()
         while rest_time.getTime() > 0:
-            outer.draw()
-            cross.draw()
-            inner.draw()
+            fixation.draw()
             self.mywindow.flip()
     
     def set_audio(self):
@@ -1629,17 +1617,8 @@ class Experiment:
         prefs.hardware['audioDevice'] = 'Haut-parleurs (Sound Blaster Audigy 5/Rx)'
         prefs.hardware['audioLatencyMode'] = 4
 
-    def circle_bg(self, stimbg, dict_pos):
-        """ Draw empty stimulus circles. """
-
-        for i in range(1, 6):
-            stimbg.setPos(dict_pos[i])
-            stimbg.draw()
-
     def super_tutorial(self, sizep, outer, inner, cross):
                         
-        trial_clock = core.Clock()
-        
         dict_pos = {1: (-100, -250),
                     2: (0, -250),
                     3: (100, -250),
@@ -1648,10 +1627,9 @@ class Experiment:
                 
         n = 1
         
-        stim = visual.ImageStim(win=self.mywindow, image=self.image_dict[n],
-                                pos=(0,0), units='deg', size=(sizep, sizep), opacity=0)
-        circle_bg = visual.Circle(win=self.mywindow, radius=25, units="pix",
-                                  fillColor=None, lineColor='black', lineWidth=5)
+        # empty stimulus circles
+        circles_bg = [visual.Circle(win=self.mywindow, radius=25, units="pix", pos=dict_pos[i],
+                                    fillColor=None, lineColor='black', lineWidth=5) for i in range(1, 6)]
         correct = visual.Circle(win=self.mywindow, radius=24, units="pix", fillColor='green')
         wrong = visual.Circle(win=self.mywindow, radius=24, units="pix", fillColor='red', opacity=.6)
         
@@ -1662,39 +1640,37 @@ class Experiment:
                 2, 4, 1, 5, 1,
                 5, 1, 4, 2, 3]
         dict_t = {i+1 : tuto[i] for i in range(0, len(tuto))}
+
+        # pre-rendered screens: the empty circles, and a stimulus with its highlighted circle
+        self.stim_cache.add_layer('tutorial', [outer, cross, inner] + circles_bg)
+        for stim_num in range(1, 6):
+            correct.setPos(dict_pos[stim_num])
+            self.stim_cache.add_layer(('tutorial', stim_num),
+                                      [self.stim_cache.image(stim_num), outer, cross, inner] + circles_bg + [correct])
         
         while True:
-            outer.draw()
-            cross.draw()
-            inner.draw()
-            self.circle_bg(circle_bg, dict_pos)
+            self.stim_cache.layer('tutorial').draw()
             self.mywindow.flip()
-            stim.draw()
 
+            wrong_response = None
             while True:
-                stim = visual.ImageStim(win=self.mywindow, image=self.image_dict[dict_t[n]],
-                                        pos=(0,0), units='deg', size=(sizep, sizep), opacity=1)
-                correct.setPos(dict_pos[dict_t[n]])
-
-                stim.draw()
-                outer.draw()
-                cross.draw()
-                inner.draw()
-                self.circle_bg(circle_bg, dict_pos)
-                correct.draw()
-                self.mywindow.flip()
+                self.stim_cache.layer(('tutorial', dict_t[n])).draw()
+                if wrong_response is not None:
+                    # mark the last wrong response (under the outline of its circle)
+                    wrong.draw()
+                    circles_bg[wrong_response - 1].draw()
+                self.response_keyboard.flip(self.mywindow)
                 
-                response = self.wait_for_response_3(dict_t[n], trial_clock)[0]
+                response = self.wait_for_response_3(dict_t[n])[0]
                 if response == dict_t[n]:
-                    stim.setOpacity(0)
                     self.mywindow.flip()
                     n += 1
                     break
                 elif response == self.settings.key_quit:
                     core.quit()
                 else:
+                    wrong_response = response
                     wrong.setPos(dict_pos[response])
-                    wrong.draw()
             
             if n == self.settings.trials_in_pretrain+1:
                 break
@@ -1715,9 +1691,8 @@ class Experiment:
         size = self.pixel_to_degrees(128)
         sizep = self.pixel_to_degrees(254)
 
-        # stimulus init
-        stim = visual.ImageStim(win=self.mywindow, image=self.image_dict[self.stimlist[1]],
-                                pos=(0,0), units='deg', size=(sizep, sizep), opacity=0)
+        # stimulus init: all the images are decoded and uploaded here, the trials only choose one of them
+        self.stim_cache.load_images(self.image_dict, pos=(0,0), units='deg', size=(sizep, sizep))
 
 
         # fixation cross init
@@ -1739,6 +1714,12 @@ class Experiment:
             lineWidth=.5,  lineColor='white', fillColor='white',
             opacity=.7, depth=-8.0, interpolate=True)
         
+        # the fixation is drawn on every frame, it is pre-rendered into one layer (alone and over every stimulus)
+        self.stim_cache.add_layer('fixation', [outer, cross, inner])
+        for stim_num in self.image_dict:
+            self.stim_cache.add_layer(('stimulus', stim_num), [self.stim_cache.image(stim_num), outer, cross, inner])
+        fixation = self.stim_cache.layer('fixation')
+
         # Photodiode configuration
         pixel = visual.Rect(win=self.mywindow, units='pix',
                             pos=(0, screen_height/2),
@@ -1796,18 +1777,49 @@ class Experiment:
 
         RSI = core.StaticPeriod(screenHz=self.frame_rate)
         RSI_clock = core.Clock()
-        trial_clock = core.Clock()
 
         first_trial_in_block = True
 
         self.trial_phase = "before_stimulus"
         self.last_RSI = -1
         
+        trial_flags = self.settings.get_trial_flags()
+
+        # a block interrupted by a crash goes on with the counters of its journaled responses (they are in its feedback)
+        counter_starts = np.flatnonzero(trial_flags['session_start'][:N + 1] | trial_flags['feedback'][:N + 1])
+        journaled_records = self.person_data.journaled_records
+        if len(counter_starts) > 0:
+            journaled_records = journaled_records[journaled_records['N'] >= counter_starts[-1]]
+        for record in journaled_records:
+            stim_type = sequence_engine.TRIAL_TYPES[self.trials['type'][record['N']]]
+            stimRT = float(record['RT'])
+            stimACC = int(record['error'])
+            responses_in_block += 1
+            accs_in_block.append(stimACC)
+            if stim_type == 'random':
+                num_of_random += 1
+                RT_random_list.append(stimRT)
+                err_random += stimACC
+            elif stim_type == 'deterministic':
+                num_of_deter += 1
+                RT_deter_list.append(stimRT)
+                err_deter += stimACC
+            elif stim_type == 'high_prob':
+                num_of_high += 1
+                RT_high_list.append(stimRT)
+                err_high += stimACC
+            elif stim_type == 'low_prob':
+                num_of_low += 1
+                RT_low_list.append(stimRT)
+                err_low += stimACC
+            RT_all_list.append(stimRT)
+            err_all += stimACC
+
         if eyetracking:
             self.EL_calibration()
 
         # show instructions or continuation message
-        if N in self.settings.get_session_starts():
+        if trial_flags['session_start'][N]:
             self.print_to_screen("Bienvenue !")
             core.wait(5)
             self.mywindow.flip()
@@ -1820,9 +1832,7 @@ class Experiment:
             
                 timer = core.CountdownTimer(self.settings.rs_time)
                 while timer.getTime() > 0:
-                    outer.draw()
-                    cross.draw()
-                    inner.draw()
+                    fixation.draw()
                     self.mywindow.flip()
             
             self.instructions.show_instructions(self)
@@ -1867,11 +1877,8 @@ class Experiment:
 
         while True:
             
-            stim.draw()
             # fixation_cross.draw()
-            outer.draw()
-            cross.draw()
-            inner.draw()
+            fixation.draw()
 
             # if eyetracking:
             #     self.in_or_out(eye_used, old_sample, new_sample, in_hit_region, minimum_duration, gaze_start)
@@ -1886,6 +1893,8 @@ class Experiment:
             RSI.complete()
 
             cycle = 0
+            stim_num = int(self.trials['stim'][N])
+            stim_type = sequence_engine.TRIAL_TYPES[self.trials['type'][N]]
 
             while True:
                 cycle += 1
@@ -1895,18 +1904,15 @@ class Experiment:
                 respRT = 0
                 respKeys = None
 
-                stim = visual.ImageStim(win=self.mywindow, image=self.image_dict[self.stimlist[N]],
-                                        pos=(0,0), units='deg', size=(sizep, sizep), opacity=1)
-                stim.draw()
+                # the stimulus with the fixation over it
+                self.stim_cache.layer(('stimulus', stim_num)).draw()
                 # pixel.setAutoDraw(False)
                 # fixation_cross.draw()
-                outer.draw()
-                cross.draw()
-                inner.draw()
-                trigg_value = d[self.stimpr[N]][self.stimlist[N]-1]
-                self.mywindow.flip()
+                trigg_value = d[stim_type][stim_num-1]
+                # the RT is measured from the first onset of the stimulus (repeated after wrong responses)
                 if meg_session:
                     self.send_trigger(N, trigg_value)
+                self.response_keyboard.flip(self.mywindow, reset_clock=(cycle == 1))
                 if cycle == 1: # check next time if 0 or 1
                     if first_trial_in_block:
                         stim_RSI = 0.0
@@ -1917,12 +1923,10 @@ class Experiment:
                     self.trial_phase = "stimulus_on_screen"
                     self.last_RSI = stim_RSI
 
-                if cycle == 1:
-                    trial_clock.reset()
                 if eyetracking:
-                    (response, time_stamp) = self.wait_for_response_1(self.stimlist[N], trial_clock, eye_used, old_sample, new_sample, in_hit_region, minimum_duration, gaze_start)
+                    (response, time_stamp) = self.wait_for_response_1(stim_num, eye_used, old_sample, new_sample, in_hit_region, minimum_duration, gaze_start)
                 else:
-                    (response, time_stamp) = self.wait_for_response_3(self.stimlist[N], trial_clock)
+                    (response, time_stamp) = self.wait_for_response_3(stim_num)
 
                 # if meg_session:
                 #     (respKeys, respRT, tresptrig) = self.wait_for_response_2(tStart)
@@ -1945,40 +1949,34 @@ class Experiment:
                     self.quit_presentation()
 
                 # correct response
-                elif response == self.stimlist[N]:
-                # elif str(respKeys) == str(self.stimlist[N]):
+                elif response == stim_num:
+                # elif str(respKeys) == str(stim_num):
                     if meg_session:
-                        port.setData(202) # trigger if good response
-                        time.sleep(.005)
-                        port.setData(0)
+                        self.triggers.send(202) # trigger if good response
                     # start of the RSI timer and offset of the stimulus
-                    stim.setOpacity(0)
                     # pixel.setAutoDraw(True)
-                    stim.draw()
                     self.mywindow.flip()
                     RSI_clock.reset()
                     RSI.start(self.settings.RSI_time)
                     stimACC = 0
                     accs_in_block.append(0)
-                    if self.stimpr[N] == 'training':
+                    if stim_type == 'training':
                         timer = core.CountdownTimer(.2)
                         while timer.getTime() > 0:
                             # fixation_cross.draw()
-                            outer.draw()
-                            cross.draw()
-                            inner.draw()
+                            fixation.draw()
                             green.draw()
                             self.mywindow.flip()
-                    elif self.stimpr[N] == 'random':
+                    elif stim_type == 'random':
                         num_of_random += 1
                         RT_random_list.append(stimRT)
-                    elif self.stimpr[N] == 'deterministic':
+                    elif stim_type == 'deterministic':
                         num_of_deter += 1
                         RT_deter_list.append(stimRT)
-                    elif self.stimpr[N] == 'high_prob':
+                    elif stim_type == 'high_prob':
                         num_of_high += 1
                         RT_high_list.append(stimRT)
-                    elif self.stimpr[N] == 'low_prob':
+                    elif stim_type == 'low_prob':
                         num_of_low += 1
                         RT_low_list.append(stimRT)
                     RT_all_list.append(stimRT)
@@ -1986,33 +1984,29 @@ class Experiment:
                 # wrong response --> let's wait for the next response
                 else:
                     if meg_session:
-                        port.setData(404) # trigger if bad response
-                        time.sleep(.005)
-                        port.setData(0)
+                        self.triggers.send(404) # trigger if bad response
                     stimACC = 1
                     accs_in_block.append(1)
-                    if self.stimpr[N] == 'training':
+                    if stim_type == 'training':
                         timer = core.CountdownTimer(.2)
                         while timer.getTime() > 0:
                             # fixation_cross.draw()
-                            outer.draw()
-                            cross.draw()
-                            inner.draw()
+                            fixation.draw()
                             red.draw()
                             self.mywindow.flip()
-                    elif self.stimpr[N] == 'random':
+                    elif stim_type == 'random':
                         num_of_random += 1
                         RT_random_list.append(stimRT)
                         err_random += 1
-                    elif self.stimpr[N] == 'deterministic':
+                    elif stim_type == 'deterministic':
                         num_of_deter += 1
                         RT_deter_list.append(stimRT)
                         err_deter += 1
-                    elif self.stimpr[N] == 'high_prob':
+                    elif stim_type == 'high_prob':
                         num_of_high += 1
                         RT_high_list.append(stimRT)
                         err_high += 1
-                    elif self.stimpr[N] == 'low_prob':
+                    elif stim_type == 'low_prob':
                         num_of_low += 1
                         RT_low_list.append(stimRT)
                         err_low += 1
@@ -2020,8 +2014,8 @@ class Experiment:
                     err_all += 1
 
                 # save data of the last trial
-                self.person_data.output_data_buffer.append([N, stim_RSI, stim_RT_time, stim_RT_date,
-                                                                stimRT, stimACC, response, respKeys, respRT, tresptrig])
+                self.person_data.add_trial_output([N, stim_RSI, stim_RT_time, stim_RT_date,
+                                                   stimRT, stimACC, response, respKeys, respRT, tresptrig])
 
                 if stimACC == 0:
                     if eyetracking:
@@ -2031,7 +2025,7 @@ class Experiment:
                     break
 
             # resting period only
-            if N in self.settings.get_block_starts() and N not in self.settings.get_fb_block():
+            if trial_flags['rest'][N]:
 
                 with self.shared_data_lock:
                     self.last_N = N - 1
@@ -2039,18 +2033,17 @@ class Experiment:
                     self.last_RSI = - 1
 
                 if eyetracking:
-                    self.close_to_break(outer, cross, inner, self.settings, eye_used, old_sample, new_sample, minimum_duration, gaze_start)
+                    self.close_to_break(fixation, self.settings, eye_used, old_sample, new_sample, minimum_duration, gaze_start)
                     core.wait(2)
                 else:
-                    self.resting_period(outer, cross, inner, self.settings)
+                    self.resting_period(fixation, self.settings)
                     core.wait(2)
-                self.person_data.flush_data_to_output(self)
-                self.person_data.save_person_settings(self)
+                self.person_data.checkpoint(self)
 
                 first_trial_in_block = True
 
             # resting period and feedback
-            if N in self.settings.get_fb_block()[1:]:
+            if trial_flags['feedback'][N]:
 
                 with self.shared_data_lock:
                     self.last_N = N - 1
@@ -2058,28 +2051,21 @@ class Experiment:
                     self.last_RSI = - 1
 
                 if eyetracking:
-                    self.close_to_break(outer, cross, inner, self.settings, eye_used, old_sample, new_sample, minimum_duration, gaze_start)
+                    self.close_to_break(fixation, self.settings, eye_used, old_sample, new_sample, minimum_duration, gaze_start)
                 else:
-                    self.resting_period(outer, cross, inner, self.settings)
+                    self.resting_period(fixation, self.settings)
                 if meg_session:
                     # stop MEG recordings for recalibration
                     time.sleep(2)
-                    port.setData(253)
-                    time.sleep(.005)
-                    port.setData(0)
-                self.person_data.flush_data_to_output(self)
-                self.person_data.save_person_settings(self)
+                    self.triggers.send(253)
+                self.person_data.checkpoint(self)
 
                 if meg_session:
                     self.show_feedback(N, responses_in_block, accs_in_block, RT_all_list)
                     press = event.waitKeys(keyList=self.settings.key_resume)
                     if self.settings.key_resume in press:
                         # restart the MEG recordings
-                        port.setData(0)
-                        time.sleep(.005)
-                        port.setData(252)
-                        time.sleep(.005)
-                        port.setData(0)
+                        self.triggers.send(252)
                         self.mywindow.flip()
                     self.print_to_screen('Appuyez sur une touche pour reprendre.')
                     press_1 = event.waitKeys(keyList=self.settings.get_key_list())
@@ -2094,9 +2080,7 @@ class Experiment:
                     if press_1 in self.settings.get_key_list():
                         self.mywindow.flip()
 
-                outer.draw()
-                cross.draw()
-                inner.draw()
+                fixation.draw()
                 self.mywindow.flip()
                 core.wait(1)
 
@@ -2111,18 +2095,12 @@ class Experiment:
                     self.print_to_screen("Fin de l'entraînement !\n\nReposez-vous.")
                     # stop MEG recordings for recalibration
                     time.sleep(2)
-                    port.setData(253)
-                    time.sleep(.005)
-                    port.setData(0)
+                    self.triggers.send(253)
                                     
                     press = event.waitKeys(keyList=self.settings.key_resume)
                     if self.settings.key_resume in press:
                         # restart the MEG recordings
-                        port.setData(0)
-                        time.sleep(.005)
-                        port.setData(252)
-                        time.sleep(.005)
-                        port.setData(0)
+                        self.triggers.send(252)
                         self.mywindow.flip()
                     self.print_to_screen('Appuyez sur une touche pour lancer la vraie tâche.')
                     press_1 = event.waitKeys(keyList=self.settings.get_key_list())
@@ -2136,7 +2114,7 @@ class Experiment:
                         core.quit()
 
             # end of session
-            if N == self.end_at[N - 1]:
+            if N == self.trials['end_at'][N - 1]:
                 # ending resting state
                 if resting_state:
                     self.print_to_screen("Fixez la croix de fixation")
@@ -2144,9 +2122,7 @@ class Experiment:
                     self.mywindow.flip()
                     timer = core.CountdownTimer(self.settings.rs_time)
                     while timer.getTime() > 0:
-                        outer.draw()
-                        cross.draw()
-                        inner.draw()
+                        fixation.draw()
                         self.mywindow.flip()
 
                 if self.settings.current_session == self.settings.numsessions:
@@ -2172,9 +2148,12 @@ class Experiment:
         all_settings_file_path = os.path.join(self.workdir_path, "settings", "settings")
         reminder_file_path = os.path.join(self.workdir_path, "settings", "settings_reminder.txt")
         sequence_file_path = os.path.join(self.workdir_path, "sequences")
+        transitions_file_path = os.path.join(self.workdir_path, "settings", "transitions.json")
         if eyetracking:
             results_folder_path = os.path.join(self.workdir_path, "results")
-        self.settings = ExperimentSettings(all_settings_file_path, reminder_file_path, sequence_file_path)
+        self.storage = storage.open_storage(storage_backend, os.path.join(self.workdir_path, "settings", "experiment.sqlite3"))
+        self.settings = ExperimentSettings(all_settings_file_path, reminder_file_path, sequence_file_path,
+                                           transitions_file_path, self.storage)
         self.all_settings_def()
 
         self.pressed_dict = {self.settings.key1: 1, self.settings.key2: 2,
@@ -2215,6 +2194,8 @@ class Experiment:
                            monitor=self.mymonitor, units="pix", gammaErrorPolicy=window_gammaErrorPolicy) as self.mywindow:
 
             self.mywindow.mouseVisible = mouse_visible
+            self.stim_cache = StimulusCache(self.mywindow)
+            self.response_keyboard = ResponseKeyboard(self.settings.get_key_list())
 
             self.set_audio()
 
@@ -2237,11 +2218,10 @@ class Experiment:
             
             if meg_session:
                 # Start the MEG recordings
-                port.setData(0)
-                time.sleep(.005)
-                port.setData(252)
-                time.sleep(.005)
-                port.setData(0)
+                self.triggers = TriggerScheduler(port, os.path.join(self.workdir_path, "logs",
+                                                                    str(self.subject_number).zfill(2) + '_triggers.txt'))
+                self.triggers.send(252)
+                self.response_box = SerialResponseBox(port_s)
 
 
             # show experiment screen
@@ -2250,6 +2230,7 @@ class Experiment:
             # save user data
             self.person_data.save_person_settings(self)
             self.person_data.append_to_output_file('sessionend_planned_quit')
+            self.person_data.wait_for_writes()
 
             # show ending screen
             # self.instructions.show_ending(self)
@@ -2261,9 +2242,8 @@ class Experiment:
             if meg_session:
                 # Stop MEG recordings
                 time.sleep(2)
-                port.setData(253)
-                time.sleep(.005)
-                port.setData(0)
+                self.triggers.send(253)
+                self.triggers.close()
 
 if __name__ == "__main__":
     thispath = os.path.split(os.path.abspath(__file__))[0]
@@ -0,0 +1,412 @@
+"""Sequence generation for the probabilistic SRT task.
+
+The stimulus sequence of a session is a Markov chain over the five response
+keys. Which transition applies to a trial depends on the part of the session
+the trial belongs to (training, random half, structured half, or the first
+trial of a block, which has no transition). The transitions are described by
+a transition matrix (see TransitionMatrix) instead of being spelled out trial by trial,
+so changing the design is a data edit.
+
+Sequences can be generated in advance for a whole batch of participants:
+
+    python sequence_engine.py 40            (participants 1-40, all sessions)
+    python sequence_engine.py 10 --start 41 --seed 1234
+"""
+
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import codecs
+import json
+import os
+import shelve
+import numpy as np
+
+# trial type labels, the position in this tuple is the trial type code
+TRIAL_TYPES = ('to_define',
+               'training',
+               'no transition',
+               'random',
+               'deterministic',
+               'high_prob',
+               'medium_prob',
+               'low_prob',
+               'pseudo-random')
+TYPE_CODES = {name: code for code, name in enumerate(TRIAL_TYPES)}
+
+# rules telling which part of the transition matrix applies to a trial, the position in this tuple is the rule code
+RULES = ('training', 'random', 'structured', 'no transition')
+RULE_TRAINING = 0
+RULE_RANDOM = 1
+RULE_STRUCTURED = 2
+RULE_NO_TRANSITION = 3
+
+# state of the chain before any key was drawn (position of the key in the participant's key order otherwise)
+NO_KEY = 5
+STATE_NAMES = ('0', '1', '2', '3', '4', 'start')
+
+# design of the task as it was originally hard-coded
+#   transitions: rule -> previous key position -> next key positions ("next"),
+#                probabilities ("p", equiprobable choice if missing) and trial type(s) ("type")
+#                a missing previous key position means that the chain does not move
+#   sessions: session number (or "default") -> which half of the test blocks is structured (1 or 2)
+DEFAULT_DESIGN = {
+    'transitions': {
+        'training': {'0': {'next': [1, 2, 3, 4], 'type': 'training'},
+                     '1': {'next': [0, 2, 3, 4], 'type': 'training'},
+                     '2': {'next': [0, 1, 3, 4], 'type': 'training'},
+                     '3': {'next': [0, 1, 2, 4], 'type': 'training'},
+                     '4': {'next': [0, 1, 2, 3], 'type': 'training'},
+                     'start': {'next': [0, 1, 2, 3], 'type': 'training'}},
+        'random': {'0': {'next': [1, 2, 3, 4], 'type': 'random'},
+                   '1': {'next': [0, 2, 3, 4], 'type': 'random'},
+                   '2': {'next': [0, 1, 3, 4], 'type': 'random'},
+                   '3': {'next': [0, 1, 2, 4], 'type': 'random'},
+                   '4': {'next': [0, 1, 2, 3], 'type': 'random'},
+                   'start': {'next': [0, 1, 2, 3], 'type': 'random'}},
+        'structured': {'0': {'next': [1], 'type': 'deterministic'},
+                       '1': {'next': [0, 2, 3, 4], 'type': 'pseudo-random'},
+                       '2': {'next': [4, 0], 'p': [3/4, 1/4], 'type': ['high_prob', 'low_prob']},
+                       '3': {'next': [0, 2], 'p': [1/2, 1/2], 'type': 'medium_prob'},
+                       '4': {'next': [3, 2], 'p': [3/4, 1/4], 'type': ['high_prob', 'low_prob']}},
+        'no transition': {state: {'next': [0, 1, 2, 3, 4], 'type': 'no transition'} for state in STATE_NAMES},
+    },
+    'sessions': {'1': {'structured_half': 2},
+                 'default': {'structured_half': 1}},
+}
+
+
+class TransitionMatrix:
+    """Declarative description of the transition structure of the task.
+
+       The design is a plain dictionary (see DEFAULT_DESIGN), so it can be passed directly
+       or read from a json file. It is validated and compiled once into lookup rows
+       (next key positions, cumulative probabilities, trial type codes), one row per rule and previous key.
+    """
+
+    def __init__(self, design):
+        self.design = design
+        self.table = self.compile()
+
+    @classmethod
+    def from_file(cls, file_path):
+        """Read a design from a json file."""
+
+        with codecs.open(file_path, 'r', encoding='utf-8') as design_file:
+            return cls(json.load(design_file))
+
+    def to_file(self, file_path):
+        """Write the design into a json file, e.g. to get a template for a new design."""
+
+        with codecs.open(file_path, 'w', encoding='utf-8') as design_file:
+            json.dump(self.design, design_file, indent=4)
+
+    def compile(self):
+        """Validate the design and turn it into lookup rows."""
+
+        table = []
+        for rule in RULES:
+            if rule not in self.design['transitions']:
+                raise ValueError("Transitions are missing for the '%s' trials!" % rule)
+            rule_spec = self.design['transitions'][rule]
+            rows = []
+            for state in STATE_NAMES:
+                row = rule_spec.get(state)
+                if row is None:
+                    rows.append(None)
+                    continue
+
+                nexts = tuple(int(n) for n in row['next'])
+                if len(nexts) == 0 or any(n < 0 or n >= NO_KEY for n in nexts):
+                    raise ValueError("Invalid next key positions for '%s' trials after %s: %s" % (rule, state, row['next']))
+
+                types = row['type']
+                if isinstance(types, str):
+                    types = [types] * len(nexts)
+                if len(types) != len(nexts) or any(t not in TYPE_CODES for t in types):
+                    raise ValueError("Invalid trial types for '%s' trials after %s: %s" % (rule, state, row['type']))
+
+                cumulative = None
+                if 'p' in row:
+                    probs = np.asarray(row['p'], dtype=float)
+                    if len(probs) != len(nexts) or np.any(probs < 0) or abs(probs.sum() - 1.0) > 1e-9:
+                        raise ValueError("Invalid probabilities for '%s' trials after %s: %s" % (rule, state, row['p']))
+                    cumulative = tuple(np.cumsum(probs).tolist())
+
+                rows.append((nexts, cumulative, tuple(TYPE_CODES[t] for t in types)))
+            table.append(rows)
+
+        for session, layout in self.design['sessions'].items():
+            if layout.get('structured_half') not in (1, 2):
+                raise ValueError("The structured half of session %s must be 1 or 2!" % session)
+
+        return table
+
+    def structured_half(self, session):
+        """Return which half of the test blocks is structured in the given session."""
+
+        sessions = self.design['sessions']
+        layout = sessions.get(str(session), sessions.get('default'))
+        if layout is None:
+            raise ValueError("The design has no layout for session %s!" % session)
+        return layout['structured_half']
+
+
+DEFAULT_TRANSITIONS = TransitionMatrix(DEFAULT_DESIGN)
+
+
+def session_rules(structured_half, n_trials, trials_in_tBlock, trials_in_block, test_trials):
+    """Return the rule of every trial of the session (index is the trial number, index 0 is unused)."""
+
+    trials = np.arange(1, n_trials + 1)
+    half = test_trials / 2
+    training = np.isin(trials, np.arange(1, trials_in_tBlock + 1))
+    if structured_half == 2:
+        no_transition = np.isin(trials, np.arange(trials_in_tBlock + half + 1, n_trials + 1, trials_in_block))
+        random = np.isin(trials, np.arange(trials_in_tBlock + 1, trials_in_tBlock + half + 1))
+    else:
+        no_transition = np.isin(trials, np.arange(trials_in_tBlock + 1, trials_in_tBlock + half + 1, trials_in_block))
+        random = np.isin(trials, np.arange(trials_in_tBlock + half + 1, n_trials + 1))
+
+    rules = np.select([no_transition, training, random],
+                      [RULE_NO_TRANSITION, RULE_TRAINING, RULE_RANDOM], RULE_STRUCTURED)
+    return np.concatenate(([RULE_NO_TRANSITION], rules)).astype(np.int8)
+
+
+def sample_chain(rules, table, rng=np.random):
+    """Walk the Markov chain along the given rules and return key positions and trial type codes.
+
+       Random numbers are drawn in the same order as numpy.random.choice would draw them
+       (an integer for equiprobable rows, a uniform number for weighted rows, nothing for single outcomes),
+       so a seeded generator gives the same sequence as the former trial-by-trial implementation.
+    """
+
+    n = len(rules)
+    positions = np.full(n, NO_KEY, dtype=np.int8)
+    types = np.zeros(n, dtype=np.int8)
+
+    prev = NO_KEY
+    for trial, rule in enumerate(rules.tolist()):
+        if trial == 0:
+            continue
+        row = table[rule][prev]
+        if row is None:
+            positions[trial] = prev
+            continue
+        nexts, cumulative, codes = row
+        if len(nexts) == 1:
+            i = 0
+        elif cumulative is None:
+            i = rng.randint(0, len(nexts))
+        else:
+            i = min(bisect_right(cumulative, rng.random_sample()), len(nexts) - 1)
+        prev = nexts[i]
+        positions[trial] = prev
+        types[trial] = codes[i]
+
+    return positions, types
+
+
+def generate_session(keys, session, n_trials, trials_in_tBlock, trials_in_block, test_trials, rng=np.random,
+                     transitions=DEFAULT_TRANSITIONS):
+    """Generate the stimulus sequence of one session.
+
+       keys: the participant's key order (e.g. [3, 1, 5, 2, 4])
+       transitions: TransitionMatrix describing the design
+       return: array of stimulus numbers and array of trial type codes (index is the trial number, 0 means no stimulus)
+    """
+
+    rules = session_rules(transitions.structured_half(session), n_trials, trials_in_tBlock, trials_in_block, test_trials)
+    positions, types = sample_chain(rules, transitions.table, rng)
+    key_lookup = np.array(list(keys) + [0], dtype=np.int8)
+    return key_lookup[positions], types
+
+
+# layout of the binary sequence files: stimulus number and trial type code of every trial (index is the trial number)
+SEQUENCE_DTYPE = np.dtype([('key', np.int8), ('type', np.int8)])
+
+
+def sequence_file_path(sequence_dir, subject_number, session, extension='.csv'):
+    """Path of the sequence file of the given participant and session
+       (.csv for the human readable export, .npy for the binary file loaded by the experiment)."""
+
+    return os.path.join(sequence_dir, '%s_seq_%s%s' % (str(subject_number).zfill(2), session, extension))
+
+
+def keys_file_path(sequence_dir, subject_number):
+    """Path of the file storing the participant's key order."""
+
+    return os.path.join(sequence_dir, '%s_keys.txt' % str(subject_number).zfill(2))
+
+
+def read_keys(sequence_dir, subject_number):
+    """Return the stored key order of the participant or None if there is no such file."""
+
+    path = keys_file_path(sequence_dir, subject_number)
+    if not os.path.isfile(path):
+        return None
+    with codecs.open(path, 'r', encoding='utf-8') as keys_file:
+        return [int(k) for k in keys_file.read().split(',')]
+
+
+def write_keys(sequence_dir, subject_number, keys):
+    """Store the participant's key order, so later sessions use the same one."""
+
+    with codecs.open(keys_file_path(sequence_dir, subject_number), 'w', encoding='utf-8') as keys_file:
+        keys_file.write(','.join(str(k) for k in keys))
+
+
+def write_sequence_csv(path, trial_keys, trial_types, n_rows):
+    """Write the first n_rows trials of a sequence in the csv layout main.py has always used
+       (unnamed index column, trials, trial_keys, trial_type)."""
+
+    with codecs.open(path, 'w', encoding='utf-8') as csv_file:
+        csv_file.write(',trials,trial_keys,trial_type\n')
+        for i in range(n_rows):
+            csv_file.write('%d,%d,%d,%s\n' % (i, i + 1, trial_keys[i], TRIAL_TYPES[trial_types[i]]))
+
+
+def read_sequence_csv(path):
+    """Read a csv sequence file into the binary layout."""
+
+    with codecs.open(path, 'r', encoding='utf-8') as csv_file:
+        rows = [line.rstrip('\r\n').split(',') for line in csv_file.readlines()[1:] if line.strip()]
+    sequence = np.zeros(len(rows), dtype=SEQUENCE_DTYPE)
+    sequence['key'] = [int(row[2]) for row in rows]
+    sequence['type'] = [TYPE_CODES[row[3]] for row in rows]
+    return sequence
+
+
+def write_sequence_npy(npy_path, sequence):
+    """Write a sequence as a binary file."""
+
+    # write to a temporary file first, so a half-written binary file is never picked up by the experiment
+    with open(npy_path + '.tmp', 'wb') as npy_file:
+        np.save(npy_file, sequence)
+    os.replace(npy_path + '.tmp', npy_path)
+
+
+def save_sequence(sequence_dir, subject_number, session, trial_keys, trial_types, n_rows):
+    """Write the first n_rows trials of a sequence both as a binary file and as a csv export."""
+
+    sequence = np.zeros(n_rows, dtype=SEQUENCE_DTYPE)
+    sequence['key'] = trial_keys[:n_rows]
+    sequence['type'] = trial_types[:n_rows]
+
+    write_sequence_npy(sequence_file_path(sequence_dir, subject_number, session, '.npy'), sequence)
+    write_sequence_csv(sequence_file_path(sequence_dir, subject_number, session), trial_keys, trial_types, n_rows)
+
+
+def load_sequence(sequence_dir, subject_number, session):
+    """Return the sequence of the given participant and session memory-mapped from its binary file,
+       or None if it was not generated yet.
+
+       Sequences that only exist as csv (generated by an older version) are converted to a binary file first.
+    """
+
+    npy_path = sequence_file_path(sequence_dir, subject_number, session, '.npy')
+    if not os.path.isfile(npy_path):
+        csv_path = sequence_file_path(sequence_dir, subject_number, session)
+        if not os.path.isfile(csv_path):
+            return None
+        write_sequence_npy(npy_path, read_sequence_csv(csv_path))
+
+    return np.load(npy_path, mmap_mode='r')
+
+
+def subject_rng(entropy, subject_number, stream):
+    """Independent, reproducible random stream of a participant (stream 0: key order, stream N: session N)."""
+
+    seed_sequence = np.random.SeedSequence(entropy, spawn_key=(subject_number, stream))
+    return np.random.RandomState(np.random.MT19937(seed_sequence))
+
+
+def _generate_one(job):
+    """Process pool worker: generate and write one session of one participant."""
+
+    (sequence_dir, subject_number, session, keys, design, entropy,
+     trials_in_tBlock, trials_in_block, blocks_in_session) = job
+
+    n_trials = trials_in_tBlock + trials_in_block * blocks_in_session + 1
+    (trial_keys, trial_types) = generate_session(keys, session, n_trials, trials_in_tBlock, trials_in_block,
+                                                 trials_in_block * blocks_in_session,
+                                                 rng=subject_rng(entropy, subject_number, session),
+                                                 transitions=TransitionMatrix(design))
+    save_sequence(sequence_dir, subject_number, session, trial_keys, trial_types, n_trials)
+    return sequence_file_path(sequence_dir, subject_number, session, '.npy')
+
+
+def pregenerate(sequence_dir, subject_numbers, numsessions, trials_in_tBlock, trials_in_block, blocks_in_session,
+                transitions=DEFAULT_TRANSITIONS, entropy=None, max_workers=None, overwrite=False):
+    """Generate the sequences of all given participants and sessions in parallel.
+
+       Every participant and session gets its own random stream derived from entropy, so the result
+       does not depend on the number of workers or on which other participants are in the batch.
+       Existing sequence files (and key orders) are kept unless overwrite is set.
+       return: the entropy used (to reproduce the batch) and the list of written files
+    """
+
+    if entropy is None:
+        entropy = np.random.SeedSequence().entropy
+
+    jobs = []
+    for subject_number in subject_numbers:
+        keys = read_keys(sequence_dir, subject_number)
+        if keys is None or overwrite:
+            keys = [1, 2, 3, 4, 5]
+            subject_rng(entropy, subject_number, 0).shuffle(keys)
+            write_keys(sequence_dir, subject_number, keys)
+
+        for session in range(1, numsessions + 1):
+            if not overwrite and os.path.isfile(sequence_file_path(sequence_dir, subject_number, session, '.npy')):
+                continue
+            jobs.append((sequence_dir, subject_number, session, keys, transitions.design, entropy,
+                         trials_in_tBlock, trials_in_block, blocks_in_session))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        written = list(executor.map(_generate_one, jobs))
+
+    return entropy, written
+
+
+def read_design_settings(settings_file_path):
+    """Read the block / trial numbers from the experiment settings saved by main.py."""
+
+    with shelve.open(settings_file_path, 'r') as settings_file:
+        # older settings files store the number of trials per block under 'trial_in_block'
+        if 'trials_in_block' in settings_file:
+            trials_in_block = settings_file['trials_in_block']
+        else:
+            trials_in_block = settings_file['trial_in_block']
+        return (settings_file['numsessions'], settings_file['trials_in_tBlock'],
+                trials_in_block, settings_file['blocks_in_session'])
+
+
+if __name__ == "__main__":
+    workdir_path = os.path.split(os.path.abspath(__file__))[0]
+
+    parser = argparse.ArgumentParser(description='Pre-generate the sequences of a batch of participants.')
+    parser.add_argument('count', type=int, help='number of participants')
+    parser.add_argument('--start', type=int, default=1, help='number of the first participant (default: 1)')
+    parser.add_argument('--seed', type=int, default=None, help='entropy of the batch (default: a fresh one, printed)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--overwrite', action='store_true', help='regenerate existing sequence files')
+    args = parser.parse_args()
+
+    (numsessions, trials_in_tBlock, trials_in_block, blocks_in_session) = read_design_settings(
+        os.path.join(workdir_path, "settings", "settings"))
+
+    transitions_file_path = os.path.join(workdir_path, "settings", "transitions.json")
+    if os.path.isfile(transitions_file_path):
+        transitions = TransitionMatrix.from_file(transitions_file_path)
+    else:
+        transitions = DEFAULT_TRANSITIONS
+
+    sequence_dir = os.path.join(workdir_path, "sequences")
+    if not os.path.exists(sequence_dir):
+        os.makedirs(sequence_dir)
+
+    (entropy, written) = pregenerate(sequence_dir, range(args.start, args.start + args.count), numsessions,
+                                     trials_in_tBlock, trials_in_block, blocks_in_session, transitions,
+                                     entropy=args.seed, max_workers=args.workers, overwrite=args.overwrite)
+    print('%d sequence files written, seed: %d' % (len(written), entropy))
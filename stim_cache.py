@@ -0,0 +1,200 @@
+"""Stimuli built once and reused by the presentation loops of the experiment scripts.
+
+Creating a PsychoPy stimulus decodes its image file and uploads a new GL texture, which
+is slow and happens right before the flip the stimulus onset is time-locked to. The
+StimulusCache builds the stimuli once, when the window is ready, and the trial loops
+only choose which of the pre-built stimuli they draw.
+
+Static screens drawn on every frame (the fixation cross, the empty stimulus circles) are
+rendered once into a layer, a snapshot of the window (visual.BufferImageStim), so the
+per-frame loops draw a single textured quad instead of every shape one by one. A layer
+covers only the bounding box of its stimuli, so the texture filled on every frame is not
+bigger than the stimuli themselves (the rest of the window is cleared by the flip). A layer
+contains the window's background too, so it is always the first thing drawn in a frame.
+
+measure_draw_time() compares the ways of drawing a frame on the actual GPU, e.g. the
+shapes one by one and their layer, and layer_pixel_difference() checks that a layer is drawn
+at the same pixels as its stimuli (python stim_cache.py runs both).
+
+Texts and shapes which change between the calls (messages, feedback) are kept by a key and
+updated in place: only the attributes whose value changed are set again, so e.g. the glyph
+layout of a text stimulus runs only when its text is different.
+"""
+
+import time
+import numpy as np
+from psychopy import visual
+from pyglet import gl
+
+# pixels added around the bounding box of a layer's stimuli (the outlines are drawn outside of the vertices)
+g_layer_margin = 8
+
+
+def update_stim(stim, **values):
+    """Set the given attributes of a stimulus, skipping the ones which have the same value already."""
+
+    for name, value in values.items():
+        current_value = getattr(stim, name)
+        if current_value is None or value is None or not np.array_equal(current_value, value):
+            setattr(stim, name, value)
+
+
+class StimulusCache:
+    """Pre-built stimuli of one window."""
+
+    def __init__(self, window):
+        # visual.Window the stimuli are drawn on
+        self.window = window
+        # stimulus number -> visual.ImageStim with the already uploaded texture of the stimulus image
+        self.images = {}
+        # layer key -> visual.BufferImageStim with the pre-rendered stimuli
+        self.layers = {}
+        # key -> text or shape stimulus updated in place
+        self.stims = {}
+
+    def load_images(self, image_dict, **image_params):
+        """Decode the stimulus images (stimulus number -> image file path) and upload their textures.
+
+           image_params are passed to every visual.ImageStim (e.g. units, size and pos).
+        """
+
+        for stim_num, image_path in image_dict.items():
+            self.images[stim_num] = visual.ImageStim(win=self.window, image=image_path, **image_params)
+
+    def image(self, stim_num):
+        """The image stimulus of the given stimulus number."""
+
+        return self.images[stim_num]
+
+    def add_layer(self, key, stims):
+        """Render the stimuli (drawn in the given order, over the background) into one layer of their bounding box.
+
+           The back buffer is cleared, so layers should be built before drawing the next frame.
+        """
+
+        self.layers[key] = bounded_layer(self.window, stims)
+
+    def layer(self, key):
+        """The pre-rendered layer of the given key."""
+
+        return self.layers[key]
+
+    def stim(self, key, stim_class, **stim_params):
+        """The stimulus of the given key, created as stim_class(**stim_params) on the first call only.
+
+           Use update_stim() to change the attributes which vary between the calls.
+        """
+
+        stim = self.stims.get(key)
+        if stim is None:
+            stim = stim_class(win=self.window, **stim_params)
+            self.stims[key] = stim
+        return stim
+
+    def text(self, key, text, **text_params):
+        """The text stimulus of the given key showing the given text (text_params are used on the first call only)."""
+
+        text_stim = self.stim(key, visual.TextStim, text=text, **text_params)
+        update_stim(text_stim, text=text)
+        return text_stim
+
+
+def bounding_box_pix(window, stims, margin=g_layer_margin):
+    """The rectangle around the stimuli as [left, top, right, bottom] in whole pixels of the window from its top left corner."""
+
+    vertices = np.concatenate([np.asarray(stim.verticesPix, dtype=float).reshape(-1, 2) for stim in stims])
+    (width, height) = window.size
+    (left, right) = (np.floor(vertices[:, 0].min() - margin + width / 2), np.ceil(vertices[:, 0].max() + margin + width / 2))
+    (top, bottom) = (np.floor(height / 2 - vertices[:, 1].max() - margin), np.ceil(height / 2 - vertices[:, 1].min() + margin))
+    return [int(max(left, 0)), int(max(top, 0)), int(min(right, width)), int(min(bottom, height))]
+
+
+def bounding_rect(window, stims, margin=g_layer_margin):
+    """The rectangle around the stimuli as [left, top, right, bottom] in norm units (the rect of visual.BufferImageStim).
+
+       The corners are moved by half a pixel into the pixels of bounding_box_pix(), so the truncation of the
+       window's pixel coordinates in BufferImageStim captures exactly those pixels.
+    """
+
+    (width, height) = window.size
+    (left, top, right, bottom) = bounding_box_pix(window, stims, margin)
+    return [(left + 0.5) / width * 2 - 1, 1 - (top + 0.5) / height * 2,
+            (right + 0.5) / width * 2 - 1, 1 - (bottom + 0.5) / height * 2]
+
+
+def bounded_layer(window, stims, margin=g_layer_margin):
+    """Render the stimuli into a visual.BufferImageStim of their bounding box, drawn where the stimuli are.
+
+       BufferImageStim uses its rect only for the capture and draws the image at pos (0, 0) by default,
+       so the layer is moved to the center of the captured pixels (its units are pix).
+    """
+
+    stims = list(stims)
+    (width, height) = window.size
+    (left, top, right, bottom) = bounding_box_pix(window, stims, margin)
+    layer = visual.BufferImageStim(window, stim=stims, rect=bounding_rect(window, stims, margin), interpolate=False)
+    layer.pos = ((left + right) / 2.0 - width / 2.0, height / 2.0 - (top + bottom) / 2.0)
+    return layer
+
+
+def layer_pixel_difference(window, stims, layer):
+    """The largest difference of a color value between drawing the stimuli one by one and drawing their layer.
+
+       Both are drawn into the back buffer and read back, the frame is not shown (0: the layer is drawn at the same pixels).
+    """
+
+    frames = []
+    for draw_frame in (lambda: [stim.draw() for stim in stims], layer.draw):
+        window.clearBuffer()
+        draw_frame()
+        frames.append(np.asarray(window._getRegionOfFrame(buffer='back'), dtype=int))
+    window.clearBuffer()
+    return np.abs(frames[0] - frames[1]).max()
+
+
+def measure_draw_time(window, draw_frame, frame_count=300):
+    """Return with the median and the 99th percentile of the seconds of drawing a frame with draw_frame().
+
+       The flips do not wait for the vertical blank, but for the GPU to finish the frame, so the time
+       includes the GPU's work and not the waiting for the screen.
+    """
+
+    wait_blanking = window.waitBlanking
+    window.waitBlanking = False
+    draw_times = []
+    try:
+        for frame in range(frame_count):
+            start = time.perf_counter()
+            draw_frame()
+            window.flip()
+            gl.glFinish()
+            draw_times.append(time.perf_counter() - start)
+    finally:
+        window.waitBlanking = wait_blanking
+    return (np.median(draw_times), np.percentile(draw_times, 99))
+
+
+if __name__ == "__main__":
+    # the empty stimulus circles of the eye-tracking ASRT (default distance and size) drawn one by one, as a full-window layer and as a layer of their bounding box
+    window = visual.Window(fullscr=True, units='cm', monitor='myMon', color='Ivory')
+    circles = [visual.Circle(win=window, radius=1.0, units="cm", pos=(x, y), fillColor=None, lineColor='black')
+               for (x, y) in ((-5.0, -5.0), (5.0, -5.0), (-5.0, 5.0), (5.0, 5.0))]
+    full_window_layer = visual.BufferImageStim(window, stim=circles, interpolate=False)
+    bounded_circles = bounded_layer(window, circles)
+
+    def draw_circles():
+        for circle in circles:
+            circle.draw()
+
+    for (name, draw_frame) in (('circles one by one', draw_circles),
+                               ('full-window layer', full_window_layer.draw),
+                               ('bounding box layer', bounded_circles.draw)):
+        (median, percentile_99) = measure_draw_time(window, draw_frame)
+        print('%-20s %.3f ms median, %.3f ms 99th percentile' % (name, median * 1000, percentile_99 * 1000))
+
+    # a layer whose bounding box is not centered on the origin (the lower circles of the SRT tutorial) is drawn where its stimuli are
+    off_center = [visual.Circle(win=window, radius=24, units="pix", pos=(x, y), fillColor=None, lineColor='black')
+                  for (x, y) in ((-300, -250), (-150, -300), (0, -250), (150, -300), (300, -250))]
+    difference = layer_pixel_difference(window, off_center, bounded_layer(window, off_center))
+    print('off-center layer     %s (largest color difference: %d)' % ('OK' if difference == 0 else 'MISPLACED', difference))
+    window.close()
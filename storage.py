@@ -0,0 +1,303 @@
+"""Storage of the experiment scripts' data.
+
+The scripts keep their settings and the state of the subjects in shelve-like mappings
+opened through a storage backend (open_storage()):
+
+    FileStorage      the original layout, one shelve file per mapping, the output rows are in the text logs only
+    SQLiteStorage    a single SQLite database file in WAL mode, holding the mappings and also the output rows
+                     (batched inserts per block, indexed by subject, session and block); the text logs are still written
+
+SubjectRegistry keeps the list of all subjects of an experiment in an SQLite database
+with a unique index on the subject ID, so it can be shared by several experiment
+computers (e.g. on a network drive) and registering a subject does not read or rewrite
+the whole list.
+"""
+
+from collections.abc import MutableMapping
+import codecs
+import os
+import pickle
+import shelve
+import sqlite3
+import numpy as np
+
+# seconds to wait for another experiment computer holding the database lock
+g_lock_timeout = 30
+
+# marks a deleted key among the changes of an SQLiteMapping
+g_deleted = object()
+
+
+def open_storage(backend, database_file_path):
+    """Return with the storage backend of the given name ('files' or 'sqlite')."""
+
+    if backend == 'files':
+        return FileStorage()
+    elif backend == 'sqlite':
+        return SQLiteStorage(database_file_path)
+    else:
+        raise ValueError('unknown storage backend: ' + str(backend))
+
+
+class FileStorage:
+    """Mappings are shelve files, output rows are not stored (they are in the text logs)."""
+
+    def open(self, file_path, flag='c'):
+        return shelve.open(file_path, flag)
+
+    def append_rows(self, table, subject_id, column_names, rows):
+        pass
+
+
+class SQLiteStorage:
+    """All mappings and output rows in one SQLite database file (WAL mode).
+
+       A mapping opened with a file path is stored under the file name of the path,
+       so the scripts can use the same paths for both backends.
+    """
+
+    def __init__(self, database_file_path):
+        # path of the SQLite database file
+        self.database_file_path = database_file_path
+        # output tables created already (table name -> column names)
+        self.tables = {}
+
+    def connect(self):
+        """Open a new connection (connections are not shared between the presentation and the I/O thread)."""
+
+        connection = sqlite3.connect(self.database_file_path, timeout=g_lock_timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS mappings ('
+                           'mapping TEXT NOT NULL, '
+                           'key TEXT NOT NULL, '
+                           'value BLOB NOT NULL, '
+                           'PRIMARY KEY (mapping, key))')
+        return connection
+
+    def open(self, file_path, flag='c'):
+        return SQLiteMapping(self, os.path.basename(file_path), flag)
+
+    def append_rows(self, table, subject_id, column_names, rows):
+        """Insert the output rows of a block (lists of values in the order of column_names) in one transaction."""
+
+        if len(rows) == 0:
+            return
+
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            if self.tables.get(table) != column_names:
+                self.__create_table(connection, table, column_names)
+            connection.executemany('INSERT INTO "' + table + '" VALUES (' + ', '.join(['?'] * (len(column_names) + 1)) + ')',
+                                   ([subject_id] + [sql_value(value) for value in row] for row in rows))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def __create_table(self, connection, table, column_names):
+        connection.execute('CREATE TABLE IF NOT EXISTS "' + table + '" (subject_id TEXT NOT NULL, ' +
+                           ', '.join('"' + name + '"' for name in column_names) + ')')
+        index_columns = ['subject_id'] + [name for name in ('session', 'block') if name in column_names]
+        connection.execute('CREATE INDEX IF NOT EXISTS "' + table + '_index" ON "' + table + '" (' + ', '.join(index_columns) + ')')
+        self.tables[table] = list(column_names)
+
+
+class SQLiteMapping(MutableMapping):
+    """Shelve-like mapping stored in the database of an SQLiteStorage (values are pickled).
+
+       Opened with flag 'r' it is read-only and the mapping must exist already, with flag 'n' it starts empty.
+       Changes are written in one transaction when the mapping is closed.
+    """
+
+    def __init__(self, sqlite_storage, name, flag='c'):
+        self.name = name
+        self.flag = flag
+        self.connection = sqlite_storage.connect()
+        # changes since opening (key -> value, g_deleted for deleted keys)
+        self.changes = {}
+        if flag == 'n':
+            self.changes = {key: g_deleted for key in self.__stored_keys()}
+        elif flag == 'r' and self.connection.execute('SELECT 1 FROM mappings WHERE mapping = ? LIMIT 1', (name,)).fetchone() is None:
+            self.connection.close()
+            raise KeyError(name)
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            if self.changes[key] is g_deleted:
+                raise KeyError(key)
+            return self.changes[key]
+
+        row = self.connection.execute('SELECT value FROM mappings WHERE mapping = ? AND key = ?', (self.name, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        assert self.flag != 'r'
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        assert self.flag != 'r'
+        self[key]
+        self.changes[key] = g_deleted
+
+    def __iter__(self):
+        keys = set(self.__stored_keys())
+        for key, value in self.changes.items():
+            if value is g_deleted:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return iter(sorted(keys))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def close(self):
+        if self.connection is None:
+            return
+
+        try:
+            if len(self.changes) > 0:
+                self.connection.execute('BEGIN IMMEDIATE')
+                for key, value in self.changes.items():
+                    if value is g_deleted:
+                        self.connection.execute('DELETE FROM mappings WHERE mapping = ? AND key = ?', (self.name, key))
+                    else:
+                        self.connection.execute('INSERT OR REPLACE INTO mappings (mapping, key, value) VALUES (?, ?, ?)',
+                                                (self.name, key, pickle.dumps(value)))
+                self.connection.execute('COMMIT')
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __stored_keys(self):
+        return [row[0] for row in self.connection.execute('SELECT key FROM mappings WHERE mapping = ?', (self.name,))]
+
+
+def sql_value(value):
+    """Convert an output value to a type SQLite can store."""
+
+    if isinstance(value, np.generic):
+        return value.item()
+    elif value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    else:
+        return str(value)
+
+
+class SubjectRegistry:
+    """Registry of all subjects participating in the experiment.
+
+       Every newly registered subject is appended to the text list of the subjects,
+       which is generated from the registry only if it does not exist yet.
+    """
+
+    def __init__(self, registry_file_path, subject_list_file_path, subject_list_header, legacy_IDs_file_path=None):
+        # path of the SQLite database file
+        self.registry_file_path = registry_file_path
+        # path of the text list of the subjects
+        self.subject_list_file_path = subject_list_file_path
+        # first line of the text list (tab separated column names)
+        self.subject_list_header = subject_list_header
+        # shelve file of the subject IDs used by older versions, imported into an empty registry
+        self.legacy_IDs_file_path = legacy_IDs_file_path
+
+    def register(self, subject_id, attributes):
+        """Register a new subject with its attributes (list of strings written after the ID into the subject list).
+
+           Returns with False if the subject is already registered (the attributes are not changed then).
+        """
+
+        connection = self.__connect()
+        try:
+            # lock the database for writing, so only one computer registers a subject at a time
+            connection.execute('BEGIN IMMEDIATE')
+            self.__import_legacy_IDs(connection)
+            cursor = connection.execute('INSERT OR IGNORE INTO subjects (subject_id, attributes) VALUES (?, ?)',
+                                        (subject_id, '\t'.join(attributes)))
+            registered = cursor.rowcount == 1
+            if registered:
+                self.__append_to_subject_list(connection, subject_id, attributes)
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+        return registered
+
+    def get_attributes(self, subject_id):
+        """Returns with the attributes of a registered subject or None for an unknown subject."""
+
+        connection = self.__connect()
+        try:
+            row = connection.execute('SELECT attributes FROM subjects WHERE subject_id = ?', (subject_id,)).fetchone()
+        finally:
+            connection.close()
+
+        if row is None:
+            return None
+        return row[0].split('\t')
+
+    def export_subject_list(self):
+        """Write the whole text list of the subjects again."""
+
+        connection = self.__connect()
+        try:
+            self.__write_subject_list(connection)
+        finally:
+            connection.close()
+
+    def __connect(self):
+        connection = sqlite3.connect(self.registry_file_path, timeout=g_lock_timeout, isolation_level=None)
+        connection.execute('CREATE TABLE IF NOT EXISTS subjects ('
+                           'registration_order INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'subject_id TEXT NOT NULL UNIQUE, '
+                           'attributes TEXT NOT NULL)')
+        return connection
+
+    def __import_legacy_IDs(self, connection):
+        if self.legacy_IDs_file_path is None or connection.execute('SELECT 1 FROM subjects LIMIT 1').fetchone() is not None:
+            return
+
+        try:
+            with shelve.open(self.legacy_IDs_file_path, 'r') as all_subject_file:
+                for id in all_subject_file['ids']:
+                    attributes = [str(value) for value in all_subject_file[id]]
+                    connection.execute('INSERT OR IGNORE INTO subjects (subject_id, attributes) VALUES (?, ?)',
+                                       (id, '\t'.join(attributes)))
+        except:
+            # no subjects registered by older versions
+            pass
+
+    def __append_to_subject_list(self, connection, subject_id, attributes):
+        if not os.path.isfile(self.subject_list_file_path):
+            self.__write_subject_list(connection)
+            return
+
+        with codecs.open(self.subject_list_file_path, 'a', encoding='utf-8') as subject_list_file:
+            subject_list_file.write(subject_line(subject_id, attributes))
+
+    def __write_subject_list(self, connection):
+        with codecs.open(self.subject_list_file_path, 'w', encoding='utf-8') as subject_list_file:
+            subject_list_file.write(self.subject_list_header + '\n')
+            for (subject_id, attributes) in connection.execute('SELECT subject_id, attributes FROM subjects ORDER BY registration_order'):
+                subject_list_file.write(subject_line(subject_id, attributes.split('\t')))
+
+
+def subject_line(subject_id, attributes):
+    """One line of the subject list: the segments of the subject ID and the attributes, tab separated."""
+
+    return subject_id.replace('_', '\t', 2) + '\t' + '\t'.join(attributes) + '\n'
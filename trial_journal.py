@@ -0,0 +1,118 @@
+"""Append-only journal of the trials, for resuming a subject after a crash.
+
+Every output row of a trial is appended to the journal as a fixed-size binary record
+(a NumPy structured dtype given by the script), and the file is fsync-ed after every
+sync_every records. When the buffered rows are written out into the output file, a
+checkpoint record is appended. So a checkpoint costs only the records written since
+the last one, and the settings shelve does not have to be rewritten after every block.
+
+On startup read_journal() gives back the records; the rows after the last checkpoint
+are the ones which did not reach the output file yet. The responses of a trial which was
+not completed before the crash are removed by drop_trials_after(), the trial is repeated.
+The journal is emptied when the settings shelve is saved again (that already contains the
+journaled progress).
+"""
+
+import os
+import numpy as np
+
+# record kinds (value of the 'kind' field every record dtype starts with)
+g_trial_record = 0
+g_checkpoint_record = 1
+
+
+class TrialJournal:
+    """Writes the records of one subject's journal file (not thread-safe, use it from a single thread)."""
+
+    def __init__(self, file_path, record_dtype, sync_every=10):
+        # path of the journal file
+        self.file_path = file_path
+        # record layout, the first field is the record kind
+        self.record_dtype = np.dtype(record_dtype)
+        # the journal is fsync-ed after this many records
+        self.sync_every = sync_every
+        self.unsynced_records = 0
+        self.journal_file = None
+
+    def append(self, record):
+        """Append a trial record (a tuple of the fields after 'kind')."""
+
+        self.__write(np.array([(g_trial_record,) + tuple(record)], dtype=self.record_dtype))
+        if self.unsynced_records >= self.sync_every:
+            self.sync()
+
+    def checkpoint(self):
+        """Mark that all the records so far are written out into the output file."""
+
+        record = np.zeros(1, dtype=self.record_dtype)
+        record['kind'] = g_checkpoint_record
+        self.__write(record)
+        self.sync()
+
+    def sync(self):
+        if self.journal_file is not None and self.unsynced_records > 0:
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            self.unsynced_records = 0
+
+    def reset(self):
+        """Empty the journal (the progress is saved somewhere else)."""
+
+        self.close()
+        with open(self.file_path, 'wb') as journal_file:
+            os.fsync(journal_file.fileno())
+
+    def close(self):
+        if self.journal_file is not None:
+            self.sync()
+            self.journal_file.close()
+            self.journal_file = None
+
+    def __write(self, record):
+        if self.journal_file is None:
+            self.journal_file = open(self.file_path, 'ab')
+        self.journal_file.write(record.tobytes())
+        self.unsynced_records += 1
+
+
+def read_journal(file_path, record_dtype):
+    """Read the records of a journal file, returns with (all trial records, trial records after the last checkpoint).
+
+       A partly written record at the end of the file (crash during writing) is dropped.
+    """
+
+    record_dtype = np.dtype(record_dtype)
+    if not os.path.isfile(file_path):
+        empty = np.zeros(0, dtype=record_dtype)
+        return (empty, empty)
+
+    with open(file_path, 'rb') as journal_file:
+        data = journal_file.read()
+    records = np.frombuffer(data[:len(data) - len(data) % record_dtype.itemsize], dtype=record_dtype)
+
+    checkpoints = np.flatnonzero(records['kind'] == g_checkpoint_record)
+    if len(checkpoints) > 0:
+        unwritten = records[checkpoints[-1] + 1:]
+    else:
+        unwritten = records
+    return (records[records['kind'] == g_trial_record], unwritten[unwritten['kind'] == g_trial_record])
+
+
+def drop_trials_after(file_path, record_dtype, last_N):
+    """Remove the trial records of the trials after last_N from a journal file (the 'N' field of the records).
+
+       The checkpoints are kept, the file is replaced at once (a crash leaves the old or the new journal).
+    """
+
+    record_dtype = np.dtype(record_dtype)
+    with open(file_path, 'rb') as journal_file:
+        data = journal_file.read()
+    records = np.frombuffer(data[:len(data) - len(data) % record_dtype.itemsize], dtype=record_dtype)
+    kept = records[(records['kind'] != g_trial_record) | (records['N'] <= last_N)]
+
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as journal_file:
+        journal_file.write(kept.tobytes())
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(tmp_path, file_path)
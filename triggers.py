@@ -0,0 +1,126 @@
+"""Parallel-port trigger pulses sent by a scheduler thread.
+
+Sending a trigger is a pulse on the parallel port: the code is written, held for a few
+milliseconds and the port is reset to 0. The presentation thread only queues the pulses
+(send(), or send_on_flip() for a pulse at the next flip of the window), the writes and the
+waiting are done by the scheduler's own thread, which runs at a raised priority if the
+operating system allows it.
+
+The pulses are written in the order of their onsets and never overlap: a pulse whose onset
+falls into the previous one is delayed until the port is reset. The actual write times are
+logged in memory and saved into a tab-separated text file when the scheduler is closed
+(one line per pulse, under a heading line of g_log_column_names).
+"""
+
+import atexit
+import codecs
+import heapq
+import itertools
+import os
+import threading
+import psychtoolbox as ptb
+
+# seconds the code is held on the port
+g_pulse_duration = 0.005
+# the scheduler thread sleeps until this many seconds before an onset, then waits precisely with ptb.WaitSecs
+g_precise_wait = 0.002
+# columns of the log file: the code, its requested onset, the time it was written and the time the port was reset (ptb.GetSecs() times)
+g_log_column_names = ['code', 'onset', 'set_time', 'reset_time']
+
+
+class TriggerScheduler:
+    """Writes the queued trigger pulses to a parallel port (e.g. psychopy.parallel.ParallelPort) on its own thread."""
+
+    def __init__(self, port, log_file_path=None, pulse_duration=g_pulse_duration):
+        # object with a setData(code) method
+        self.port = port
+        # tab separated file the write times are saved into on close() (None: not saved)
+        self.log_file_path = log_file_path
+        # default duration of a pulse in seconds
+        self.pulse_duration = pulse_duration
+        # queued pulses: heap of (onset, serial number, code, duration)
+        self.pulses = []
+        self.serial_numbers = itertools.count()
+        self.condition = threading.Condition()
+        self.closing = False
+        # written pulses: (code, requested onset, time the code was written, time the port was reset), ptb.GetSecs() times
+        self.written = []
+        self.thread = threading.Thread(target=self.__run, name='TriggerScheduler', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def send(self, code, onset=None, duration=None):
+        """Queue a pulse of the given code at the given onset (ptb.GetSecs() time, None: as soon as possible)."""
+
+        if onset is None:
+            onset = ptb.GetSecs()
+        if duration is None:
+            duration = self.pulse_duration
+        with self.condition:
+            heapq.heappush(self.pulses, (onset, next(self.serial_numbers), code, duration))
+            self.condition.notify()
+
+    def send_on_flip(self, window, code, duration=None):
+        """Queue a pulse of the given code right after the next flip of the window."""
+
+        window.callOnFlip(self.send, code, None, duration)
+
+    def close(self):
+        """Send the queued pulses, stop the scheduler thread and save the log."""
+
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+
+        if self.log_file_path is not None:
+            add_heading = not os.path.isfile(self.log_file_path)
+            with codecs.open(self.log_file_path, 'a', encoding='utf-8') as log_file:
+                if add_heading:
+                    log_file.write('\t'.join(g_log_column_names) + '\n')
+                for (code, onset, set_time, reset_time) in self.written:
+                    log_file.write('%d\t%.6f\t%.6f\t%.6f\n' % (code, onset, set_time, reset_time))
+
+    def __run(self):
+        raise_thread_priority()
+
+        while True:
+            with self.condition:
+                while True:
+                    if len(self.pulses) == 0:
+                        if self.closing:
+                            return
+                        self.condition.wait()
+                        continue
+
+                    # sleep until shortly before the next onset, a new earlier pulse wakes the thread up
+                    time_left = self.pulses[0][0] - ptb.GetSecs()
+                    if time_left <= g_precise_wait:
+                        break
+                    self.condition.wait(time_left - g_precise_wait)
+
+                (onset, serial_number, code, duration) = heapq.heappop(self.pulses)
+
+            time_left = onset - ptb.GetSecs()
+            if time_left > 0:
+                ptb.WaitSecs(time_left)
+            self.port.setData(code)
+            set_time = ptb.GetSecs()
+            ptb.WaitSecs(duration)
+            self.port.setData(0)
+            reset_time = ptb.GetSecs()
+            self.written.append((code, onset, set_time, reset_time))
+
+
+def raise_thread_priority():
+    """Raise the priority of the calling thread (Windows only, elsewhere nothing happens)."""
+
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # THREAD_PRIORITY_TIME_CRITICAL
+        kernel32.SetThreadPriority(kernel32.GetCurrentThread(), 15)
+    except:
+        pass